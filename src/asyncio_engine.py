@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio_engine.py
+
+an optional event engine built on asyncio (python 3 only).
+
+The inotify file descriptor is read from the event loop's reader callback,
+instead of a thread polling check_events and handing each event through a
+queue.Queue. Idle detection (inotify_idle) runs from a loop timer, and
+redis is reached through the redis.asyncio client, so redis I/O overlaps
+with reading events.
+
+The startup scans still use the synchronous redis connection, in an
+executor thread, so events are read while they run.
+"""
+import asyncio
+from collections import deque
+import logging
+import sys
+import threading
+import time
+
+from batch_dispatch import queue_batch_commands, \
+                           check_batch_results, \
+                           batch_failed
+from batch_script import BatchScript
+from event_names import inotify_idle
+from event_processor import dispatch_step, \
+                            up_to_date_step, \
+                            idle_step, \
+                            overflow_step
+from inotify_setup import notifier_file_descriptor
+from key_index import first_error
+from log_limiter import RateLimitedLog, log_suppressed_counts
+from redis_connection import create_async_redis_connection
+from write_ahead_buffer import is_connection_error, all_connection_errors
+
+# seconds without events before we report the notifier idle, the same as
+# the check_events timeout of the notifier thread
+_idle_interval = 1.0
+
+class _EventBuffer(object):
+    """
+    stands in for the file name queue. put() is called by pyinotify from the
+    reader callback, and by the startup scan from an executor thread.
+    """
+    def __init__(self, loop):
+        self._loop = loop
+        self._loop_thread_id = threading.current_thread().ident
+        self._entries = deque()
+        self._ready = asyncio.Event()
+
+    def put(self, entry):
+        if threading.current_thread().ident == self._loop_thread_id:
+            self._put(entry)
+        else:
+            self._loop.call_soon_threadsafe(self._put, entry)
+
+    def put_many(self, entries):
+        """
+        put a whole read of the direct notifier, from the loop thread
+        """
+        if len(entries) > 0:
+            self._entries.extend(entries)
+            self._ready.set()
+
+    def qsize(self):
+        return len(self._entries)
+
+    def _put(self, entry):
+        self._entries.append(entry)
+        self._ready.set()
+
+    async def get_batch(self, batch_size, max_latency):
+        """
+        wait for at least one entry, then wait up to max_latency seconds
+        for up to batch_size of them
+        """
+        while len(self._entries) == 0:
+            self._ready.clear()
+            await self._ready.wait()
+
+        if len(self._entries) < batch_size and max_latency > 0.0:
+            deadline = self._loop.time() + max_latency
+            while len(self._entries) < batch_size:
+                remaining = deadline - self._loop.time()
+                if remaining <= 0.0:
+                    break
+                self._ready.clear()
+                try:
+                    await asyncio.wait_for(self._ready.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+
+        batch = list()
+        while len(batch) < batch_size and len(self._entries) > 0:
+            batch.append(self._entries.popleft())
+        return batch
+
+class AsyncioEngine(object):
+    """
+    run the notifier and the dispatcher in one asyncio event loop
+    """
+    def __init__(self, args, coalescer, halt_event):
+        self._log = logging.getLogger("AsyncioEngine")
+        self._failure_log = RateLimitedLog(self._log, 
+                                           logging.ERROR, 
+                                           "dispatch failure")
+        self._args = args
+        self._coalescer = coalescer
+        self.metrics = None
+        self.write_buffer = None
+        self.completion_notifier = None
+        self.key_index = None
+        self.set_mirror = None
+        self._halt_event = halt_event
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self.event_buffer = _EventBuffer(self._loop)
+        self._notifier = None
+        self._redis = None
+        self._batch_script = None
+        self._idle_timer = None
+
+    def _start_idle_timer(self):
+        self._idle_timer = self._loop.call_later(_idle_interval, self._idle)
+
+    def _idle(self):
+        self.event_buffer.put((None, inotify_idle, None, ))
+        self._start_idle_timer()
+
+    def _read_events(self):
+        """
+        reader callback for the inotify file descriptor
+        """
+        self._idle_timer.cancel()
+        self._notifier.read_events()
+        try:
+            self._notifier.process_events()
+        except Exception:
+            self._log.exception("process_events")
+            self._halt_event.set()
+            self.event_buffer.put((None, inotify_idle, None, ))
+            return
+        self._start_idle_timer()
+
+    async def _execute_script(self, entries, up_to_date_time):
+        batch_script = self._batch_script
+        failures = list()
+        for keys, args, sent_commands, rule_entries in \
+            batch_script.calls(entries, up_to_date_time):
+            try:
+                result = await batch_script.script(keys=keys, args=args)
+            except Exception:
+                result = sys.exc_info()[1]
+            batch_script.call_count += 1
+            failures.extend(batch_script.check_result(sent_commands,
+                                                      rule_entries,
+                                                      result))
+        return failures
+
+    async def _send_entries(self, entries, up_to_date_time=None):
+        if self._batch_script is not None:
+            return await self._execute_script(entries, up_to_date_time)
+
+        key_index = self.key_index
+        pipeline = self._redis.pipeline(transaction=False)
+        sent_commands = queue_batch_commands(pipeline, entries)
+        if key_index is not None:
+            redis_keys = key_index.queue_counts(pipeline, sent_commands)
+        try:
+            results = await pipeline.execute(raise_on_error=False)
+        except Exception:
+            return batch_failed(entries, sys.exc_info()[1])
+
+        failures = check_batch_results(sent_commands, results)
+        if key_index is None or len(failures) > 0:
+            return failures
+
+        counts = results[len(sent_commands):]
+        instance = first_error(counts)
+        if instance is None:
+            pipeline = self._redis.pipeline(transaction=False)
+            key_index.queue_updates(pipeline, redis_keys, counts)
+            try:
+                instance = first_error(
+                    await pipeline.execute(raise_on_error=False))
+            except Exception:
+                instance = sys.exc_info()[1]
+        if instance is not None:
+            return batch_failed(entries, instance)
+        return failures
+
+    async def _dispatch_entries(self, entries, up_to_date_time=None):
+        if self._coalescer is not None:
+            entries = self._coalescer.coalesce(entries)
+
+        if len(entries) == 0:
+            return True
+
+        write_buffer = self.write_buffer
+        if write_buffer is not None and write_buffer.pending():
+            return write_buffer.append(entries)
+
+        failures = await self._send_entries(entries, up_to_date_time)
+        if write_buffer is not None and all_connection_errors(failures):
+            return write_buffer.append(entries, failures[0][2])
+
+        for file_name, event_name, instance in failures:
+            self._failure_log("{0} {1} {2}", file_name, event_name, instance)
+        return len(failures) == 0
+
+    async def _replay_buffer(self, rules):
+        """
+        once its retry is due, send what the write-ahead buffer holds.
+        return False on an error that is not a connection error
+        """
+        write_buffer = self.write_buffer
+        if not write_buffer.retry_due():
+            return True
+
+        if not write_buffer.up_to_date_cleared:
+            try:
+                for rule in rules:
+                    await self._redis.set(rule.up_to_date_timestamp_key, "0")
+            except Exception:
+                instance = sys.exc_info()[1]
+                if not is_connection_error(instance):
+                    self._log.exception("clearing up to date timestamps")
+                    return False
+                write_buffer.retry_failed(instance)
+                return True
+            write_buffer.up_to_date_cleared = True
+
+        while write_buffer.pending():
+            chunk = write_buffer.next_chunk()
+            failures = await self._send_entries(chunk)
+            if all_connection_errors(failures):
+                write_buffer.retry_failed(failures[0][2])
+                return True
+            for file_name, event_name, instance in failures:
+                self._failure_log("{0} {1} {2}", 
+                                  file_name, 
+                                  event_name, 
+                                  instance)
+            if len(failures) > 0:
+                return False
+            write_buffer.chunk_sent(len(chunk))
+
+        return True
+
+    async def _mark_up_to_date(self, rules):
+        current_time = int(time.time())
+        for rule in rules:
+            self._log.debug("setting {0} to {1}".format(
+                            rule.up_to_date_timestamp_key, current_time))
+            await self._redis.set(rule.up_to_date_timestamp_key,
+                                  str(current_time))
+
+    async def _run(self, processor, startup_scans, overflow_recovery, rules):
+        for startup_scan in startup_scans:
+            succeeded = await self._loop.run_in_executor(None, startup_scan)
+            if not succeeded:
+                self._halt_event.set()
+                return 1
+
+        self._log.info("main loop starts")
+        while not self._halt_event.is_set():
+            batch = await self.event_buffer.get_batch(self._args.batch_size,
+                                                      self._args.batch_latency)
+            for step, entries in processor.process_batch(batch):
+                if step == dispatch_step:
+                    start_time = time.time()
+                    # once we are up to date, the batch script moves the
+                    # timestamp along with each batch that empties the queue
+                    up_to_date_time = None
+                    if self._batch_script is not None and \
+                       processor.up_to_date and \
+                       self.event_buffer.qsize() == 0:
+                        up_to_date_time = int(start_time)
+                    sent_entries = entries
+                    if overflow_recovery.pending:
+                        # the reconcile will scan the directories after
+                        # these
+                        sent_entries = list()
+                    elif self.set_mirror is not None:
+                        sent_entries = self.set_mirror.filter(entries)
+                    succeeded = await self._dispatch_entries(sent_entries,
+                                                             up_to_date_time)
+                    if self.metrics is not None:
+                        self.metrics.observe_redis_latency(
+                            time.time() - start_time)
+                    if not succeeded:
+                        self._halt_event.set()
+                        return 1
+                    if self.completion_notifier is not None:
+                        self.completion_notifier.observe(entries)
+                elif step == up_to_date_step:
+                    if overflow_recovery.pending:
+                        # we are up to date after the reconcile
+                        processor.up_to_date = False
+                    elif self.write_buffer is None:
+                        await self._mark_up_to_date(rules)
+                    elif self.write_buffer.pending():
+                        # we are up to date when the buffer has drained
+                        processor.up_to_date = False
+                    else:
+                        try:
+                            await self._mark_up_to_date(rules)
+                        except Exception:
+                            instance = sys.exc_info()[1]
+                            if not is_connection_error(instance):
+                                raise
+                            self._log.warn("unable to mark up to date: " \
+                                           "{0}".format(instance))
+                            processor.up_to_date = False
+                elif step == idle_step:
+                    if self.metrics is not None:
+                        self.metrics.mark_idle()
+                    if self._coalescer is not None:
+                        self._coalescer.log_statistics()
+                    if self.set_mirror is not None:
+                        self.set_mirror.log_statistics()
+                    log_suppressed_counts()
+                elif step == overflow_step:
+                    overflow_recovery.overflowed()
+
+            if overflow_recovery.retry_due():
+                # events keep being read while we resync
+                succeeded = await self._loop.run_in_executor(
+                    None, overflow_recovery.recover)
+                if not succeeded:
+                    self._halt_event.set()
+                    return 1
+
+            if self.write_buffer is not None and \
+               self.write_buffer.pending() and \
+               not overflow_recovery.pending:
+                if not await self._replay_buffer(rules):
+                    self._halt_event.set()
+                    return 1
+                if not self.write_buffer.pending():
+                    # redis has caught up: mark it up to date at the next idle
+                    processor.up_to_date = False
+
+            if self.completion_notifier is not None and \
+               self.completion_notifier.check_due() and \
+               (self.write_buffer is None or not self.write_buffer.pending()):
+                # this uses the synchronous connection
+                await self._loop.run_in_executor(
+                    None, self.completion_notifier.check)
+
+        return 0
+
+    def run(self, notifier, processor, startup_scans, overflow_recovery, rules):
+        """
+        run the startup scans and the event loop until halt_event is set
+        The return value will be the returncode for the program
+        """
+        self._notifier = notifier
+        try:
+            self._redis = create_async_redis_connection(
+                socket_path=self._args.redis_socket,
+                socket_timeout=self._args.redis_timeout,
+                connect_timeout=self._args.redis_connect_timeout,
+                max_connections=self._args.redis_max_connections,
+                cluster=self._args.cluster)
+        except Exception:
+            self._log.exception("Unable to connect to redis")
+            return 1
+        if self._args.atomic_batches:
+            self._batch_script = BatchScript(self._redis, 
+                                             rules, 
+                                             self._args.index)
+
+        file_descriptor = notifier_file_descriptor(notifier)
+        self._loop.add_reader(file_descriptor, self._read_events)
+        self._start_idle_timer()
+        try:
+            return_code = self._loop.run_until_complete(
+                self._run(processor, startup_scans, overflow_recovery, rules))
+        except KeyboardInterrupt:
+            self._log.warn("KeyboardInterrupt: halting")
+            self._halt_event.set()
+            return_code = 0
+        finally:
+            self._idle_timer.cancel()
+            self._loop.remove_reader(file_descriptor)
+            self._loop.run_until_complete(self._close_redis())
+            self._loop.close()
+
+        return return_code
+
+    async def _close_redis(self):
+        close = getattr(self._redis, "aclose", None) or self._redis.close
+        await close()
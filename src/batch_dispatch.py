@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+batch_dispatch.py
+
+drain events from the file name queue in batches and send each batch to
+redis as a single pipeline, with one multi-member SADD or SREM per key
+"""
+from collections import OrderedDict
+import logging
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import sys
+import time
+
+from event_names import incoming_event_names, outgoing_event_names
+from key_index import first_error
+
+def collect_batch(file_name_queue, first_entry, batch_size, max_latency):
+    """
+    starting with first_entry, take entries off the queue until we have
+    batch_size of them, or until max_latency seconds have passed
+    """
+    batch = [first_entry, ]
+    deadline = time.time() + max_latency
+    while len(batch) < batch_size:
+        remaining = deadline - time.time()
+        try:
+            if remaining > 0.0:
+                entry = file_name_queue.get(block=True, timeout=remaining)
+            else:
+                entry = file_name_queue.get_nowait()
+        except queue.Empty:
+            break
+        batch.append(entry)
+
+    return batch
+
+def _group_commands(entries):
+    """
+    group (redis_key, file_name, event_name) entries into runs of the same
+    command for each key. Order is preserved within a key, so an add
+    followed by a remove of the same file still ends up removed.
+    """
+    commands = OrderedDict()
+    for redis_key, file_name, event_name in entries:
+        if event_name in incoming_event_names:
+            command = "sadd"
+        elif event_name in outgoing_event_names:
+            command = "srem"
+        else:
+            raise KeyError(event_name)
+
+        runs = commands.setdefault(redis_key, [])
+        if len(runs) > 0 and runs[-1][0] == command:
+            runs[-1][1].append((file_name, event_name, ))
+        else:
+            runs.append((command, [(file_name, event_name, ), ], ))
+
+    return commands
+
+def batch_commands(entries):
+    """
+    turn a list of (redis_key, file_name, event_name) entries into a list
+    of (redis_key, command, members, run_entries) commands, one for each
+    run of SADD or SREM on a key
+    """
+    sent_commands = list()
+    for redis_key, runs in _group_commands(entries).items():
+        for command, run_entries in runs:
+            members = list(OrderedDict.fromkeys(
+                file_name for file_name, _ in run_entries))
+            sent_commands.append((redis_key, command, members, run_entries, ))
+    return sent_commands
+
+def queue_batch_commands(pipeline, entries):
+    """
+    queue the SADD/SREM commands for a list of (redis_key, file_name, 
+    event_name) entries on a pipeline.
+    returns the list of sent commands, for check_batch_results
+    """
+    sent_commands = batch_commands(entries)
+    for redis_key, command, members, _ in sent_commands:
+        getattr(pipeline, command)(redis_key, *members)
+    return sent_commands
+
+def check_batch_results(sent_commands, results):
+    """
+    match pipeline results with the commands that were sent.
+    returns a list of (file_name, event_name, exception) for the entries
+    that failed
+    """
+    log = logging.getLogger("check_batch_results")
+
+    failures = list()
+    for sent_command, result in zip(sent_commands, results):
+        redis_key, command, members, run_entries = sent_command
+        if isinstance(result, Exception):
+            failures.extend([(file_name, event_name, result, )
+                             for file_name, event_name in run_entries])
+        # this is probably some form of duplicate, so we don't abort
+        elif command == "sadd" and result < len(members):
+            log.warn("sadd({0}, {1} members) returned add count {2}".format(
+                     redis_key, len(members), result))
+
+    return failures
+
+def batch_failed(entries, instance):
+    """
+    we never got results for any command: the whole batch failed
+    """
+    return [(file_name, event_name, instance, )
+            for _, file_name, event_name in entries]
+
+def execute_batch(redis, entries, key_index=None):
+    """
+    send a list of (redis_key, file_name, event_name) entries to redis
+    as one pipeline, and update the key index if there is one.
+
+    returns a list of (file_name, event_name, exception) for the entries
+    that failed; an empty list means the whole batch succeeded
+    """
+    pipeline = redis.pipeline(transaction=False)
+    sent_commands = queue_batch_commands(pipeline, entries)
+    if key_index is not None:
+        redis_keys = key_index.queue_counts(pipeline, sent_commands)
+
+    try:
+        results = pipeline.execute(raise_on_error=False)
+    except Exception:
+        return batch_failed(entries, sys.exc_info()[1])
+
+    failures = check_batch_results(sent_commands, results)
+    if key_index is None or len(failures) > 0:
+        return failures
+
+    counts = results[len(sent_commands):]
+    instance = first_error(counts)
+    if instance is None:
+        pipeline = redis.pipeline(transaction=False)
+        key_index.queue_updates(pipeline, redis_keys, counts)
+        try:
+            instance = first_error(pipeline.execute(raise_on_error=False))
+        except Exception:
+            instance = sys.exc_info()[1]
+    if instance is not None:
+        return batch_failed(entries, instance)
+    return failures
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+batch_script.py
+
+apply a batch with one call to a redis script for each rule, instead of a
+pipeline of separate commands. The script does the SADDs and SREMs, updates
+the key index (if there is one) and, once we are up to date and the batch
+empties the queue, moves the up-to-date timestamp along. Redis runs a
+script without running any other command, so a consumer sees all of a
+batch or none of it, and never a timestamp that is ahead of the sets.
+
+    KEYS  up-to-date key, index key, count key, then the sets in the batch
+    ARGV  up-to-date time ('' to leave it), 1 to update the index, score,
+          then for each command: set number, 'sadd' or 'srem',
+          member count, members...
+
+The script returns the result of each command. A command that fails
+(WRONGTYPE) aborts the script, but what it had already done stays done:
+redis scripts are atomic, not transactional.
+
+In Redis Cluster every key of a script must be in the same slot, so the
+key template must put a hash tag around the prefix.
+"""
+import sys
+import time
+
+from batch_dispatch import batch_commands, check_batch_results
+
+# members per SADD/SREM call inside the script, well below the limit on
+# the number of arguments unpack() can put on the Lua stack
+_members_per_call = 1000
+
+_batch_source = """
+local up_to_date = ARGV[1]
+local indexed = ARGV[2] == "1"
+local score = ARGV[3]
+local results = {}
+local i = 4
+while i <= #ARGV do
+    local key = KEYS[tonumber(ARGV[i])]
+    local command = ARGV[i + 1]
+    local last = i + 2 + tonumber(ARGV[i + 2])
+    local result = 0
+    for first = i + 3, last, %(members_per_call)d do
+        local chunk_last = math.min(first + %(members_per_call)d - 1, last)
+        result = result + redis.call(command, key,
+                                     unpack(ARGV, first, chunk_last))
+    end
+    results[#results + 1] = result
+    i = last + 1
+end
+if indexed then
+    for k = 4, #KEYS do
+        local count = redis.call("scard", KEYS[k])
+        if count > 0 then
+            redis.call("zadd", KEYS[2], score, KEYS[k])
+            redis.call("hset", KEYS[3], KEYS[k], count)
+        else
+            redis.call("zrem", KEYS[2], KEYS[k])
+            redis.call("hdel", KEYS[3], KEYS[k])
+        end
+    end
+end
+if up_to_date ~= "" then
+    redis.call("set", KEYS[1], up_to_date)
+end
+return results
+""" % {"members_per_call" : _members_per_call, }
+
+class BatchScript(object):
+    """
+    send batches of (redis_key, file_name, event_name) entries to redis
+    through the batch script. With the asyncio client, the engine makes
+    the calls itself, from calls() and check_result().
+    """
+    def __init__(self, redis, rules, indexed):
+        self.script = redis.register_script(_batch_source)
+        self._indexed = indexed
+        self._rules = rules
+        self.call_count = 0
+
+    def _rule(self, redis_key):
+        for rule in self._rules:
+            if rule.owns_key(redis_key):
+                return rule
+        raise KeyError(redis_key)
+
+    def calls(self, entries, up_to_date_time):
+        """
+        generate (keys, args, sent_commands, rule_entries) for each script
+        call. Every rule gets a call if there is an up-to-date time to set
+        """
+        rule_entries = dict()
+        for entry in entries:
+            rule_entries.setdefault(self._rule(entry[0]), []).append(entry)
+        if up_to_date_time is not None:
+            for rule in self._rules:
+                rule_entries.setdefault(rule, [])
+
+        score = "{0:.6f}".format(time.time())
+        for rule, entries in rule_entries.items():
+            sent_commands = batch_commands(entries)
+            keys = [rule.up_to_date_timestamp_key,
+                    rule.index_key,
+                    rule.count_key, ]
+            key_numbers = dict()
+            args = [("" if up_to_date_time is None else str(up_to_date_time)),
+                    ("1" if self._indexed else "0"),
+                    score, ]
+            for redis_key, command, members, _ in sent_commands:
+                if not redis_key in key_numbers:
+                    keys.append(redis_key)
+                    # Lua counts from 1
+                    key_numbers[redis_key] = len(keys)
+                args.extend([key_numbers[redis_key], command, len(members), ])
+                args.extend(members)
+            yield keys, args, sent_commands, entries
+
+    def check_result(self, sent_commands, entries, result):
+        if isinstance(result, Exception):
+            return [(file_name, event_name, result, )
+                    for _, file_name, event_name in entries]
+        return check_batch_results(sent_commands, result)
+
+    def execute(self, entries, up_to_date_time=None):
+        """
+        send entries through the synchronous client, and set the up-to-date
+        timestamps to up_to_date_time if it is not None.
+        returns a list of (file_name, event_name, exception) for the entries
+        that failed
+        """
+        failures = list()
+        for keys, args, sent_commands, rule_entries in \
+            self.calls(entries, up_to_date_time):
+            try:
+                result = self.script(keys=keys, args=args)
+            except Exception:
+                result = sys.exc_info()[1]
+            self.call_count += 1
+            failures.extend(self.check_result(sent_commands,
+                                              rule_entries,
+                                              result))
+        return failures
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+bounded_queue.py
+
+a file name queue with a limit on its entries, its memory, or both, so a
+slow redis can't make the process grow without end.
+
+When the queue is full, the overload policy decides what happens to an
+event:
+
+    block   the notifier waits for room. inotify keeps queueing events in
+            the kernel, and overflows if that fills up too
+    drop    the event is dropped, and its file name remembered. A marker
+            on the queue has the dispatcher look at each remembered name
+            when it gets there, and send an add or a remove for whatever
+            the directory holds then. Each marker has its own names, so
+            a name is looked at after every event for it that was queued
+            before the drop. If too many names pile up, they are
+            forgotten and the queue gets an inotify_overflow instead, for
+            a full resync. While that is the last entry in the queue,
+            there is no need to remember anything
+
+Only inotify events are held back: the markers (idle, scan finished,
+overflow), and the startup scan, which fills the queue before the
+dispatcher starts taking from it, always go in.
+
+The memory of an entry is estimated as the size of its tuple and its file
+name; the event names are shared constants.
+"""
+from collections import deque
+import logging
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import sys
+import time
+
+from event_names import found_at_startup, \
+                        events_dropped, \
+                        inotify_overflow
+
+block_policy = "block"
+drop_policy = "drop"
+
+# dropped names we remember before we give up and resync everything
+_max_dropped_names = 100000
+
+def _entry_bytes(entry):
+    file_name = entry[0]
+    if file_name is None:
+        return sys.getsizeof(entry)
+    return sys.getsizeof(entry) + sys.getsizeof(file_name)
+
+class BoundedQueue(queue.Queue):
+    """
+    a queue.Queue of (file_name, event_name, watch_descriptor) entries
+    that holds at most max_entries entries and max_bytes bytes (0 for no
+    limit). put() ignores its block and timeout arguments: the policy
+    decides
+    """
+    def __init__(self, max_entries, max_bytes, overload_policy):
+        self._log = logging.getLogger("BoundedQueue")
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._overload_policy = overload_policy
+        self._released = False
+        # marker generation -> watch descriptor -> set of file names
+        # whose events were dropped
+        self._dropped = dict()
+        self._dropped_name_count = 0
+        self._generation = 0
+        # the marker new drops go to, while it is at the end of the queue
+        self._open_marker = None
+        # the inotify_overflow that covers new drops, while it is at the
+        # end of the queue
+        self._resync_marker = None
+        self.byte_count = 0
+        self.high_water_entries = 0
+        self.high_water_bytes = 0
+        self.blocked_count = 0
+        self.blocked_seconds = 0.0
+        self.dropped_count = 0
+        self.rescanned_count = 0
+        self.resync_count = 0
+        queue.Queue.__init__(self)
+
+    def _init(self, maxsize):
+        self.queue = deque()
+
+    def _put(self, entry):
+        self.queue.append(entry)
+        self.byte_count += _entry_bytes(entry)
+        if len(self.queue) > self.high_water_entries:
+            self.high_water_entries = len(self.queue)
+        if self.byte_count > self.high_water_bytes:
+            self.high_water_bytes = self.byte_count
+
+    def _get(self):
+        entry = self.queue.popleft()
+        self.byte_count -= _entry_bytes(entry)
+        return entry
+
+    def _full(self):
+        return (self._max_entries > 0 and \
+                len(self.queue) >= self._max_entries) or \
+               (self._max_bytes > 0 and self.byte_count >= self._max_bytes)
+
+    def put(self, entry, block=True, timeout=None):
+        with self.not_full:
+            if entry[0] is not None and entry[1] != found_at_startup and \
+               self._full():
+                if self._overload_policy == drop_policy:
+                    self._drop(entry)
+                    return
+                self.blocked_count += 1
+                start_time = time.time()
+                while self._full() and not self._released:
+                    self.not_full.wait(1.0)
+                self.blocked_seconds += time.time() - start_time
+            self._put(entry)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _put_marker(self, marker):
+        self._put(marker)
+        self.unfinished_tasks += 1
+        self.not_empty.notify()
+
+    def _drop(self, entry):
+        """
+        remember the name of a dropped event. Called holding the mutex
+        """
+        file_name, _, watch_descriptor = entry
+        self.dropped_count += 1
+        last_entry = (self.queue[-1] if len(self.queue) > 0 else None)
+        if last_entry is not None and last_entry is self._resync_marker:
+            return
+        if self._dropped_name_count >= _max_dropped_names:
+            self._log.warn("{0} dropped names: resyncing".format(
+                           self._dropped_name_count))
+            self._dropped.clear()
+            self._dropped_name_count = 0
+            self.resync_count += 1
+            self._resync_marker = (None, inotify_overflow, None, )
+            self._put_marker(self._resync_marker)
+            return
+
+        if last_entry is None or last_entry is not self._open_marker:
+            # the dispatcher takes the names when it gets to the marker,
+            # whose third element is its generation
+            self._generation += 1
+            self._open_marker = (None, events_dropped, self._generation, )
+            self._put_marker(self._open_marker)
+            self._dropped[self._generation] = dict()
+        file_names = self._dropped[self._generation].setdefault(
+            watch_descriptor, set())
+        if not file_name in file_names:
+            file_names.add(file_name)
+            self._dropped_name_count += 1
+
+    def take_dropped(self, generation):
+        """
+        return the (file_name, watch_descriptor) of every event dropped
+        for the marker of a generation, and forget them
+        """
+        with self.mutex:
+            dropped = self._dropped.pop(generation, dict())
+            result = [(file_name, watch_descriptor, )
+                      for watch_descriptor, file_names in dropped.items()
+                      for file_name in file_names]
+            self._dropped_name_count -= len(result)
+        self.rescanned_count += len(result)
+        return result
+
+    def release(self):
+        """
+        stop blocking put(), so the notifier can see that we are halting
+        """
+        with self.not_full:
+            self._released = True
+            self.not_full.notify_all()
+
+    def log_statistics(self):
+        self._log.info("high water {0} entries {1} bytes; blocked {2} " \
+                       "times for {3:.3f} secs; dropped {4} events, " \
+                       "rescanned {5} names, resynced {6} times".format(
+                       self.high_water_entries,
+                       self.high_water_bytes,
+                       self.blocked_count,
+                       self.blocked_seconds,
+                       self.dropped_count,
+                       self.rescanned_count,
+                       self.resync_count))
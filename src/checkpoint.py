@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+checkpoint.py
+
+keep a local checkpoint of the redis sets, so a restart can bring them up
+to date by sending only what changed while we were down, instead of
+clearing the namespace and loading every file name again.
+
+The checkpoint is a gzipped JSON file holding, for each rule, the file
+names of every set, the identity (device, inode) and mtime of the watch
+directory, and the settings that decide the key names. It is written
+periodically while redis has caught up, and at shutdown, to a temporary
+file that is renamed into place.
+
+Each write also gets a random token, which is stored in redis under
+<prefix>_checkpoint once the file is in place. The first change we send
+to redis after a write deletes the tokens, so after a crash they only
+match the file if redis has not changed since it was written. On restart
+a rule is restored from the checkpoint only if its token, settings and
+directory identity all match; the token is deleted before anything else
+is sent. Otherwise the rule is rebuilt by reconciling its sets with a
+directory scan.
+
+A restored rule still has its directory scanned, names only, and the
+differences from the checkpoint applied. The scan is skipped for a
+non-recursive rule whose directory mtime has not changed, if the
+checkpoint was written when no events had arrived for a while (otherwise
+a change just before the write might not be in it yet).
+"""
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+
+from event_names import incoming_event_names
+from reconcile import scan_directory_sets, \
+                      reconcile_directory, \
+                      apply_set_differences
+from write_ahead_buffer import is_connection_error
+
+_checkpoint_version = 1
+# secs without events before we trust the directory mtime to cover
+# every change in the checkpoint
+_settle_time = 2.0
+
+def _to_text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+def _rule_settings(rule):
+    """
+    the settings that must not have changed for a checkpoint to be used
+    """
+    return {"watch_path"    : rule.watch_path,
+            "redis_prefix"  : rule.redis_prefix,
+            "key_regex"     : rule.key_regex.pattern,
+            "key_template"  : rule.key_template,
+            "recursive"     : rule.recursive, }
+
+def _directory_identity(watch_path):
+    stat_result = os.stat(watch_path)
+    mtime = getattr(stat_result, "st_mtime_ns", None)
+    if mtime is None:
+        mtime = int(stat_result.st_mtime * 1000000000)
+    return stat_result.st_dev, stat_result.st_ino, mtime
+
+class Checkpoint(object):
+    """
+    follow the contents of the redis sets, and write and restore them
+    """
+    def __init__(self, args, rules):
+        self._log = logging.getLogger("Checkpoint")
+        self._args = args
+        self._path = args.checkpoint_path
+        self._interval = args.checkpoint_interval
+        self._rules = rules
+        # rule name -> redis_key -> set of file names, as sent to redis
+        self._sets = dict((rule.name, dict(), ) for rule in rules)
+        # rule name -> the checkpoint entry we are able to restore from
+        self._restorable = dict()
+        self._tokens_valid = False
+        self._last_observe_time = 0.0
+        self._next_write_time = time.time() + self._interval
+        self.write_count = 0
+        self.restored_count = 0
+
+    def _rule_sets(self, redis_key):
+        for rule in self._rules:
+            if rule.owns_key(redis_key):
+                return self._sets[rule.name]
+        raise KeyError(redis_key)
+
+    def load(self, redis):
+        """
+        read the checkpoint file, and find out which rules can be restored
+        from it. Then delete the tokens in redis: from now on redis and the
+        file differ
+        """
+        try:
+            with gzip.open(self._path, "rb") as checkpoint_file:
+                contents = json.loads(checkpoint_file.read().decode("utf-8"))
+        except (IOError, OSError, EOFError, ValueError, ):
+            instance = sys.exc_info()[1]
+            self._log.warn("no usable checkpoint in {0}: {1}".format(
+                           self._path, instance))
+            contents = None
+
+        if contents is not None and \
+           contents.get("version") != _checkpoint_version:
+            self._log.warn("checkpoint {0} has version {1}, not {2}".format(
+                           self._path,
+                           contents.get("version"),
+                           _checkpoint_version))
+            contents = None
+
+        if contents is not None:
+            rule_entries = dict((entry["name"], entry, )
+                                for entry in contents["rules"])
+            for rule in self._rules:
+                reason = self._check_rule(redis,
+                                          rule,
+                                          rule_entries.get(rule.name),
+                                          contents["token"])
+                if reason is None:
+                    self._restorable[rule.name] = rule_entries[rule.name]
+                    self._log.info("{0} can be restored from the " \
+                                   "checkpoint written at {1}".format(
+                                   rule.name, time.ctime(contents["time"])))
+                else:
+                    self._log.warn("{0} is rebuilt: {1}".format(rule.name,
+                                                                reason))
+
+        for rule in self._rules:
+            redis.delete(rule.checkpoint_key)
+
+    def _check_rule(self, redis, rule, entry, token):
+        """
+        return None if the rule can be restored from its checkpoint entry,
+        or the reason it can't
+        """
+        if entry is None:
+            return "not in the checkpoint"
+        if entry["settings"] != _rule_settings(rule):
+            return "settings have changed since the checkpoint"
+        try:
+            device, inode, _ = _directory_identity(rule.watch_path)
+        except OSError:
+            instance = sys.exc_info()[1]
+            return str(instance)
+        if [device, inode] != entry["identity"]:
+            return "{0} is not the directory in the checkpoint".format(
+                   rule.watch_path)
+        redis_token = _to_text(redis.get(rule.checkpoint_key))
+        if redis_token != token:
+            return "redis has changed since the checkpoint"
+        return None
+
+    def rebuild(self, redis, rule):
+        """
+        reconcile the sets of the rule with its directory, and follow
+        them from there
+        """
+        directory_sets = scan_directory_sets(rule.watch_path,
+                                             rule.key_extractor,
+                                             rule.redis_prefix,
+                                             rule.recursive,
+                                             rule.key_template)
+        reconcile_directory(redis,
+                            rule.watch_path,
+                            rule.key_extractor,
+                            rule.redis_prefix,
+                            self._args.scan_chunk_size,
+                            self._args.cleanup_batch_size,
+                            exclude_keys=rule.reserved_keys,
+                            recursive=rule.recursive,
+                            key_template=rule.key_template,
+                            directory_sets=dict(directory_sets))
+        self._sets[rule.name] = directory_sets
+
+    def restore(self, redis, rule):
+        """
+        bring the sets of the rule up to date with its directory: from the
+        checkpoint if we can, otherwise by rebuilding.
+        This is the startup scan of the rule
+        """
+        log = self._log
+        start_time = time.time()
+        entry = self._restorable.pop(rule.name, None)
+        if entry is None:
+            self.rebuild(redis, rule)
+        else:
+            checkpoint_sets = dict((redis_key, set(file_names), )
+                                   for redis_key, file_names in
+                                   entry["sets"].items())
+            _, _, mtime = _directory_identity(rule.watch_path)
+            if entry["settled"] and mtime == entry["mtime"]:
+                log.info("{0} unchanged since the checkpoint".format(
+                         rule.name))
+                directory_sets = checkpoint_sets
+            else:
+                directory_sets = scan_directory_sets(rule.watch_path,
+                                                     rule.key_extractor,
+                                                     rule.redis_prefix,
+                                                     rule.recursive,
+                                                     rule.key_template)
+                counts = apply_set_differences(redis,
+                                               checkpoint_sets,
+                                               directory_sets,
+                                               self._args.scan_chunk_size)
+                log.info("{0} changes since the checkpoint: added {1} " \
+                         "removed {2} deleted keys {3}".format(
+                         rule.name,
+                         counts["added"],
+                         counts["removed"],
+                         counts["deleted_keys"]))
+            self._sets[rule.name] = directory_sets
+            self.restored_count += 1
+
+        log.info("{0} startup scan took {1:.3f} secs".format(
+                 rule.name, time.time() - start_time))
+
+    def contents(self):
+        """
+        a dict of redis_key -> set of file names, for every rule
+        """
+        contents = dict()
+        for rule_sets in self._sets.values():
+            contents.update(rule_sets)
+        return contents
+
+    def rule_contents(self, rule):
+        """
+        a dict of redis_key -> set of file names, for one rule
+        """
+        return self._sets[rule.name]
+
+    def observe(self, entries):
+        """
+        follow (redis_key, file_name, event_name) entries on their way to
+        redis
+        """
+        self._last_observe_time = time.time()
+        for redis_key, file_name, event_name in entries:
+            rule_sets = self._rule_sets(redis_key)
+            if event_name in incoming_event_names:
+                rule_sets.setdefault(redis_key, set()).add(file_name)
+            else:
+                file_names = rule_sets.get(redis_key)
+                if file_names is not None:
+                    file_names.discard(file_name)
+                    if len(file_names) == 0:
+                        del rule_sets[redis_key]
+
+    def changing(self, redis):
+        """
+        call before sending anything to redis: delete the tokens if they
+        are still valid.
+        return False if redis was unreachable, and nothing must be sent
+        """
+        if not self._tokens_valid:
+            return True
+        try:
+            for rule in self._rules:
+                redis.delete(rule.checkpoint_key)
+        except Exception:
+            instance = sys.exc_info()[1]
+            if not is_connection_error(instance):
+                raise
+            self._log.warn("unable to delete checkpoint tokens: {0}".format(
+                           instance))
+            return False
+        self._tokens_valid = False
+        return True
+
+    def write_due(self):
+        """
+        True if it is time for a checkpoint, and redis has changed since
+        the last one
+        """
+        return not self._tokens_valid and time.time() >= self._next_write_time
+
+    def write(self, redis, queue_empty):
+        """
+        write the checkpoint. Only call this when everything observed is
+        in redis. queue_empty is True if there are no events waiting
+        """
+        start_time = time.time()
+        self._next_write_time = start_time + self._interval
+        settled = queue_empty and \
+                  start_time - self._last_observe_time >= _settle_time
+        token = uuid.uuid4().hex
+
+        rule_entries = list()
+        for rule in self._rules:
+            device, inode, mtime = _directory_identity(rule.watch_path)
+            rule_entries.append(
+                {"name"     : rule.name,
+                 "settings" : _rule_settings(rule),
+                 "identity" : [device, inode, ],
+                 "mtime"    : mtime,
+                 # the mtime covers every change in the sets
+                 "settled"  : settled and not rule.recursive and \
+                              mtime < (start_time - _settle_time) * 1e9,
+                 "sets"     : dict((redis_key, list(file_names), )
+                                   for redis_key, file_names in
+                                   self._sets[rule.name].items()), })
+        contents = {"version"   : _checkpoint_version,
+                    "time"      : start_time,
+                    "token"     : token,
+                    "rules"     : rule_entries, }
+
+        temp_path = "{0}.tmp".format(self._path)
+        with gzip.open(temp_path, "wb") as checkpoint_file:
+            checkpoint_file.write(
+                json.dumps(contents, separators=(",", ":", )).encode("utf-8"))
+        os.rename(temp_path, self._path)
+
+        for rule in self._rules:
+            redis.set(rule.checkpoint_key, token)
+        self._tokens_valid = True
+        self.write_count += 1
+        self._log.info("checkpoint {0} written in {1:.3f} secs".format(
+                       self.write_count, time.time() - start_time))
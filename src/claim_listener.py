@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+claim_listener.py
+
+listen for the claims consumers publish when they take a set
+(set_consumer.py), and pass them to the event loop, so the set mirror
+knows that the IN_DELETEs that follow are the consumer draining the set.
+
+A claim is published as '<redis_key> <member_count>' and goes on the file
+name queue as (None, key_claimed, (redis_key, member_count)), behind the
+events already there. A claim we miss (while redis is unreachable, or
+before we subscribe) costs nothing but the SREMs for its files.
+"""
+import logging
+import sys
+from threading import Thread
+import time
+
+from event_names import key_claimed
+
+# how long we wait before subscribing again after an error
+_retry_delay = 1.0
+
+def _to_text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+def parse_claim(message_text):
+    """
+    return (redis_key, member_count) from a claim message, or None
+    """
+    redis_key, _, member_count_str = message_text.rpartition(" ")
+    try:
+        member_count = int(member_count_str)
+    except ValueError:
+        return None
+    if len(redis_key) == 0:
+        return None
+    return redis_key, member_count
+
+class ClaimListener(object):
+    """
+    put the claims published on a channel on the file name queue, from a
+    daemon thread
+    """
+    def __init__(self, redis, channel, file_name_queue):
+        self._log = logging.getLogger("ClaimListener")
+        self._redis = redis
+        self._channel = channel
+        self._file_name_queue = file_name_queue
+        self._halted = False
+        self._thread = Thread(target=self._listen, name="claim_listener")
+        self._thread.daemon = True
+        self.claim_count = 0
+
+    def start(self):
+        self._log.info("listening for claims on {0}".format(self._channel))
+        self._thread.start()
+
+    def stop(self):
+        self._halted = True
+        self._thread.join(timeout=5.0)
+
+    def _listen(self):
+        while not self._halted:
+            try:
+                self._listen_to_channel()
+            except Exception:
+                instance = sys.exc_info()[1]
+                self._log.warn("claim channel {0}: {1}".format(self._channel,
+                                                               instance))
+                time.sleep(_retry_delay)
+
+    def _listen_to_channel(self):
+        subscriber = self._redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            subscriber.subscribe(self._channel)
+            while not self._halted:
+                message = subscriber.get_message(timeout=1.0)
+                if message is None or message["type"] != "message":
+                    continue
+                claim = parse_claim(_to_text(message["data"]))
+                if claim is None:
+                    self._log.warn("invalid claim {0!r}".format(
+                                   message["data"]))
+                    continue
+                self.claim_count += 1
+                self._file_name_queue.put((None, key_claimed, claim, ))
+        finally:
+            subscriber.close()
@@ -5,10 +5,23 @@ commandline.py
 parse commandline
 """
 import argparse
+import sys
+
+from key_extractor import parse_key_position
+from key_naming import default_key_template, \
+                       check_key_template, \
+                       template_shares_slot
+from metrics import parse_metrics_address
+from bounded_queue import block_policy, drop_policy
 
 class CommandlineError(Exception):
     pass
 
+thread_engine_name = "thread"
+asyncio_engine_name = "asyncio"
+pyinotify_reader_name = "pyinotify"
+direct_reader_name = "direct"
+
 _program_description = "maintain redis sets of of file names by watching a " \
                        "directory with inotify" 
 
@@ -19,6 +32,12 @@ def parse_commandline():
     parser = argparse.ArgumentParser(description=_program_description)
     parser.add_argument("-l", "--log", dest="log_path", help="/path/to/logfile")
     parser.add_argument("-v", "--verbose", action="store_true", default=False)
+    parser.add_argument("--log-background", 
+                        dest="log_background",
+                        action="store_true",
+                        default=False,
+                        help="write the log from a background thread, " \
+                        "dropping records if it falls behind")
     parser.add_argument("-w", "--watch", dest="watch_path",  
                        help="/path/to/watch/directory") 
     parser.add_argument("-k", "--key", dest="key_regex", 
@@ -26,6 +45,240 @@ def parse_commandline():
                         " from a file name")
     parser.add_argument("-p", "--prefix", dest="redis_prefix", 
                         help="prefix for key to construct the redis key")
+    parser.add_argument("--key-delimiter", 
+                        dest="key_delimiter",
+                        help="take the key as the text before the first " \
+                        "delimiter, falling back to the key regex")
+    parser.add_argument("--key-position", 
+                        dest="key_position",
+                        help="START:END take the key as file_name[START:END]" \
+                        ", falling back to the key regex")
+    parser.add_argument("--key-memo-size", 
+                        dest="key_memo_size",
+                        type=int,
+                        default=0,
+                        help="remember the keys of this many recent name " \
+                        "prefixes (0 = no memo)")
+    parser.add_argument("--key-memo-separator", 
+                        dest="key_memo_separator",
+                        default="_",
+                        help="the name prefix used by the key memo ends at " \
+                        "the last occurrence of this separator")
+    parser.add_argument("-c", "--config", dest="config_path", 
+                        help="/path/to/config/file with one section per " \
+                        "(watch, key, prefix) rule, instead of --watch, " \
+                        "--key and --prefix")
+    parser.add_argument("-r", "--recursive", 
+                        dest="recursive",
+                        action="store_true",
+                        default=False,
+                        help="watch the whole tree under the watch " \
+                        "directory, including new subdirectories")
+    parser.add_argument("--engine", 
+                        dest="engine",
+                        choices=[thread_engine_name, asyncio_engine_name, ],
+                        default=thread_engine_name,
+                        help="read inotify events from a polling thread, " \
+                        "or from an asyncio event loop with an async " \
+                        "redis client")
+    parser.add_argument("--inotify-reader", 
+                        dest="inotify_reader",
+                        choices=[pyinotify_reader_name, direct_reader_name, ],
+                        default=pyinotify_reader_name,
+                        help="read inotify events through pyinotify, or " \
+                        "parse them straight from the inotify file " \
+                        "descriptor")
+    parser.add_argument("--overflow-recovery", 
+                        dest="overflow_recovery",
+                        action="store_true",
+                        default=False,
+                        help="on an inotify queue overflow, resync the " \
+                        "sets with the directories and keep running, " \
+                        "instead of exiting")
+    parser.add_argument("--metrics-address", 
+                        dest="metrics_address",
+                        help="HOST:PORT serve Prometheus metrics over HTTP")
+    parser.add_argument("--metrics-socket", 
+                        dest="metrics_socket",
+                        help="/path/to/socket serve Prometheus metrics over " \
+                        "HTTP on a unix socket")
+    parser.add_argument("--query-socket", 
+                        dest="query_socket",
+                        help="/path/to/socket keep the sets in memory too, " \
+                        "and answer queries about them on a unix socket")
+    parser.add_argument("--queue-limit", 
+                        dest="queue_limit",
+                        type=int,
+                        default=0,
+                        help="most events waiting in the file name queue " \
+                        "(0 = no limit)")
+    parser.add_argument("--queue-memory-limit", 
+                        dest="queue_memory_limit",
+                        type=int,
+                        default=0,
+                        help="most bytes of events waiting in the file " \
+                        "name queue (0 = no limit)")
+    parser.add_argument("--queue-overload", 
+                        dest="queue_overload",
+                        choices=[block_policy, drop_policy, ],
+                        default=block_policy,
+                        help="when the file name queue is full, make the " \
+                        "notifier wait, or drop the event and rescan its " \
+                        "file name later (needs --overflow-recovery)")
+    parser.add_argument("--batch-size", 
+                        dest="batch_size",
+                        type=int,
+                        default=1,
+                        help="maximum number of events sent to redis in one " \
+                        "pipeline (1 = no batching)")
+    parser.add_argument("--batch-latency", 
+                        dest="batch_latency",
+                        type=float,
+                        default=0.05,
+                        help="maximum time (secs) an event waits while a " \
+                        "batch is filled")
+    parser.add_argument("--coalesce", 
+                        dest="coalesce",
+                        action="store_true",
+                        default=False,
+                        help="reduce the events for each file name in a " \
+                        "batch to their net effect (requires --batch-size)")
+    parser.add_argument("--mirror", 
+                        dest="mirror",
+                        action="store_true",
+                        default=False,
+                        help="keep a copy of the sets in memory, and don't " \
+                        "send adds and removes that would not change them")
+    parser.add_argument("--claim-channel", 
+                        dest="claim_channel",
+                        help="pub/sub channel where consumers announce the " \
+                        "sets they claim, so the removes of their files " \
+                        "are not sent (requires --mirror)")
+    parser.add_argument("--bulk-scan", 
+                        dest="bulk_scan",
+                        action="store_true",
+                        default=False,
+                        help="stream the initial directory scan into redis " \
+                        "in bulk, instead of queueing each file")
+    parser.add_argument("--scan-chunk-size", 
+                        dest="scan_chunk_size",
+                        type=int,
+                        default=10000,
+                        help="number of file names per pipeline in a bulk " \
+                        "scan")
+    parser.add_argument("--reconcile", 
+                        dest="reconcile",
+                        action="store_true",
+                        default=False,
+                        help="on startup, update the existing redis sets " \
+                        "to match the directory instead of deleting them")
+    parser.add_argument("--cleanup-batch-size", 
+                        dest="cleanup_batch_size",
+                        type=int,
+                        default=1000,
+                        help="number of keys per SCAN and UNLINK when " \
+                        "clearing the redis namespace on startup")
+    parser.add_argument("--cleanup-pause", 
+                        dest="cleanup_pause",
+                        type=float,
+                        default=0.01,
+                        help="time (secs) to pause between cleanup batches")
+    parser.add_argument("--redis-socket", 
+                        dest="redis_socket",
+                        help="/path/to/socket connect to redis on a unix " \
+                        "socket instead of REDIS_HOST and REDIS_PORT")
+    parser.add_argument("--cluster", 
+                        dest="cluster",
+                        action="store_true",
+                        default=False,
+                        help="REDIS_HOST and REDIS_PORT are a node of a " \
+                        "Redis Cluster")
+    parser.add_argument("--key-template", 
+                        dest="key_template",
+                        default=default_key_template,
+                        help="format of the redis keys, with {prefix} and " \
+                        "{key}; put a hash tag in {{...}} to keep related " \
+                        "keys in one cluster slot")
+    parser.add_argument("--redis-timeout", 
+                        dest="redis_timeout",
+                        type=float,
+                        default=5.0,
+                        help="time (secs) to wait for a redis reply")
+    parser.add_argument("--redis-connect-timeout", 
+                        dest="redis_connect_timeout",
+                        type=float,
+                        default=2.0,
+                        help="time (secs) to wait for a redis connection")
+    parser.add_argument("--redis-max-connections", 
+                        dest="redis_max_connections",
+                        type=int,
+                        default=8,
+                        help="maximum number of pooled redis connections")
+    parser.add_argument("--redis-buffer-size", 
+                        dest="redis_buffer_size",
+                        type=int,
+                        default=100000,
+                        help="number of events to buffer while redis is " \
+                        "unreachable (0 = exit on the first failure)")
+    parser.add_argument("--redis-retry-max-delay", 
+                        dest="redis_retry_max_delay",
+                        type=float,
+                        default=30.0,
+                        help="maximum time (secs) between attempts to " \
+                        "reach redis while events are buffered")
+    parser.add_argument("--shards", 
+                        dest="shards",
+                        type=int,
+                        default=1,
+                        help="send events to redis from this many worker " \
+                        "processes, by hash of the key (1 = no workers)")
+    parser.add_argument("--index", 
+                        dest="index",
+                        action="store_true",
+                        default=False,
+                        help="keep a sorted set of active keys by last " \
+                        "update (PREFIX_index) and a hash of their member " \
+                        "counts (PREFIX_counts)")
+    parser.add_argument("--atomic-batches", 
+                        dest="atomic_batches",
+                        action="store_true",
+                        default=False,
+                        help="apply each batch, its index updates and the " \
+                        "up-to-date timestamp with one redis script call " \
+                        "per rule, so consumers never see half a batch")
+    parser.add_argument("--checkpoint-path", 
+                        dest="checkpoint_path",
+                        help="/path/to/file keep a checkpoint of the sets " \
+                        "here, so a restart only sends what has changed")
+    parser.add_argument("--checkpoint-interval", 
+                        dest="checkpoint_interval",
+                        type=float,
+                        default=300.0,
+                        help="time (secs) between checkpoints")
+    parser.add_argument("--complete-quiet-period", 
+                        dest="complete_quiet_period",
+                        type=float,
+                        default=0.0,
+                        help="announce a key as complete when it has had " \
+                        "no new files for this long (secs, 0 = never)")
+    parser.add_argument("--complete-marker-suffix", 
+                        dest="complete_marker_suffix",
+                        help="announce a key as complete when it has the " \
+                        "number of files given in its marker file, whose " \
+                        "name ends in this suffix")
+    parser.add_argument("--complete-channel", 
+                        dest="complete_channel",
+                        help="pub/sub channel for complete key " \
+                        "announcements")
+    parser.add_argument("--complete-stream", 
+                        dest="complete_stream",
+                        help="stream for complete key announcements")
+    parser.add_argument("--complete-stream-max-length", 
+                        dest="complete_stream_max_length",
+                        type=int,
+                        default=10000,
+                        help="approximate maximum length of the " \
+                        "announcement stream")
 
     args = parser.parse_args()
 
@@ -33,18 +286,205 @@ def parse_commandline():
         parser.print_help()
         raise CommandlineError("You must specify a log path")
 
-    if args.watch_path is None:
+    if args.config_path is not None:
+        if args.watch_path is not None or \
+           args.key_regex is not None or \
+           args.redis_prefix is not None:
+            parser.print_help()
+            raise CommandlineError("--config replaces --watch, --key " \
+                                   "and --prefix")
+    else:
+        if args.watch_path is None:
+            parser.print_help()
+            raise CommandlineError("You must specify a directory to watch")
+
+        if args.key_regex is None:
+            parser.print_help()
+            raise CommandlineError("You must specify a regular expression " \
+                                   "to identify the key")
+
+        if args.redis_prefix is None:
+            parser.print_help()
+            raise CommandlineError("You must specify a prefix for " \
+                                   "constructing the redis key")
+
+    if args.key_delimiter is not None and args.key_position is not None:
+        parser.print_help()
+        raise CommandlineError("--key-delimiter and --key-position are " \
+                               "exclusive")
+
+    if args.key_delimiter == "":
+        parser.print_help()
+        raise CommandlineError("key delimiter must not be empty")
+
+    if args.key_position is not None:
+        try:
+            args.key_position = parse_key_position(args.key_position)
+        except ValueError:
+            parser.print_help()
+            raise CommandlineError("key position must be START:END, " \
+                                   "not '{0}'".format(args.key_position))
+
+    if args.key_memo_size < 0:
+        parser.print_help()
+        raise CommandlineError("key memo size must not be negative")
+
+    if args.key_memo_size > 0 and args.key_memo_separator == "":
+        parser.print_help()
+        raise CommandlineError("key memo separator must not be empty")
+
+    if args.metrics_address is not None and args.metrics_socket is not None:
+        parser.print_help()
+        raise CommandlineError("--metrics-address and --metrics-socket are " \
+                               "exclusive")
+
+    if args.metrics_address is not None:
+        try:
+            args.metrics_address = parse_metrics_address(args.metrics_address)
+        except ValueError:
+            parser.print_help()
+            raise CommandlineError("metrics address must be HOST:PORT, " \
+                                   "not '{0}'".format(args.metrics_address))
+
+    if args.queue_limit < 0 or args.queue_memory_limit < 0:
+        parser.print_help()
+        raise CommandlineError("queue limits must not be negative")
+
+    if (args.queue_limit > 0 or args.queue_memory_limit > 0) and \
+       args.engine != thread_engine_name:
+        parser.print_help()
+        raise CommandlineError("queue limits need the thread engine")
+
+    if args.queue_overload == drop_policy and not args.overflow_recovery:
+        parser.print_help()
+        raise CommandlineError("--queue-overload {0} needs " \
+                               "--overflow-recovery".format(drop_policy))
+
+    if args.batch_size < 1:
+        parser.print_help()
+        raise CommandlineError("batch size must be at least 1")
+
+    if args.batch_latency < 0.0:
+        parser.print_help()
+        raise CommandlineError("batch latency must not be negative")
+
+    if args.coalesce and args.batch_size < 2:
+        parser.print_help()
+        raise CommandlineError("coalescing needs a batch size of at least 2")
+
+    if args.scan_chunk_size < 1:
+        parser.print_help()
+        raise CommandlineError("scan chunk size must be at least 1")
+
+    if args.reconcile and args.bulk_scan:
+        parser.print_help()
+        raise CommandlineError("--reconcile and --bulk-scan are exclusive: " \
+                               "reconcile does its own bulk scan")
+
+    if args.cleanup_batch_size < 1:
+        parser.print_help()
+        raise CommandlineError("cleanup batch size must be at least 1")
+
+    if args.cleanup_pause < 0.0:
+        parser.print_help()
+        raise CommandlineError("cleanup pause must not be negative")
+
+    if args.shards < 1:
+        parser.print_help()
+        raise CommandlineError("shards must be at least 1")
+
+    if args.shards > 1 and args.engine != thread_engine_name:
+        parser.print_help()
+        raise CommandlineError("--shards needs the thread engine")
+
+    if args.checkpoint_interval <= 0.0:
+        parser.print_help()
+        raise CommandlineError("checkpoint interval must be positive")
+
+    if args.checkpoint_path is not None and \
+       args.engine != thread_engine_name:
+        parser.print_help()
+        raise CommandlineError("--checkpoint-path needs the thread engine")
+
+    if args.checkpoint_path is not None and \
+       (args.reconcile or args.bulk_scan):
+        parser.print_help()
+        raise CommandlineError("--checkpoint-path does its own startup " \
+                               "scan: it is exclusive with --reconcile and " \
+                               "--bulk-scan")
+
+    if args.query_socket is not None and args.engine != thread_engine_name:
+        parser.print_help()
+        raise CommandlineError("--query-socket needs the thread engine")
+
+    if args.claim_channel is not None and \
+       (not args.mirror or args.engine != thread_engine_name):
+        parser.print_help()
+        raise CommandlineError("--claim-channel needs --mirror and the " \
+                               "thread engine")
+
+    if args.cluster and args.redis_socket is not None:
+        parser.print_help()
+        raise CommandlineError("--cluster and --redis-socket are exclusive")
+
+    try:
+        check_key_template(args.key_template)
+    except ValueError:
+        instance = sys.exc_info()[1]
+        parser.print_help()
+        raise CommandlineError(str(instance))
+
+    if args.atomic_batches and args.cluster and \
+       not template_shares_slot(args.key_template):
+        parser.print_help()
+        raise CommandlineError("--atomic-batches in a cluster needs a " \
+                               "--key-template that keeps the keys of a " \
+                               "prefix in one slot, such as " \
+                               "'{{{prefix}}}_{key}'")
+
+    if args.redis_timeout <= 0.0 or args.redis_connect_timeout <= 0.0:
+        parser.print_help()
+        raise CommandlineError("redis timeouts must be positive")
+
+    if args.redis_max_connections < 1:
+        parser.print_help()
+        raise CommandlineError("redis max connections must be at least 1")
+
+    if args.redis_buffer_size < 0:
+        parser.print_help()
+        raise CommandlineError("redis buffer size must not be negative")
+
+    if args.redis_retry_max_delay <= 0.0:
+        parser.print_help()
+        raise CommandlineError("redis retry max delay must be positive")
+
+    if args.complete_quiet_period < 0.0:
+        parser.print_help()
+        raise CommandlineError("complete quiet period must not be negative")
+
+    if args.complete_marker_suffix == "":
+        parser.print_help()
+        raise CommandlineError("complete marker suffix must not be empty")
+
+    if args.complete_channel is not None and args.complete_stream is not None:
         parser.print_help()
-        raise CommandlineError("You must specify a directory to watch")
+        raise CommandlineError("--complete-channel and --complete-stream " \
+                               "are exclusive")
 
-    if args.key_regex is None:
+    announce = args.complete_channel is not None or \
+               args.complete_stream is not None
+    detect = args.complete_quiet_period > 0.0 or \
+             args.complete_marker_suffix is not None
+    if announce != detect:
         parser.print_help()
-        raise CommandlineError("You must specify a regular expression to " \
-                               "identify the key")
+        raise CommandlineError("complete key announcements need a " \
+                               "--complete-channel or --complete-stream, " \
+                               "and a --complete-quiet-period or " \
+                               "--complete-marker-suffix")
 
-    if args.redis_prefix is None:
+    if args.complete_stream_max_length < 1:
         parser.print_help()
-        raise CommandlineError("You must specify a prefix for constructing " \
-                               "the redis key")
+        raise CommandlineError("complete stream max length must be at " \
+                               "least 1")
 
     return args
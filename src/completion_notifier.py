@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+completion_notifier.py
+
+tell consumers when the set for a key is complete, so they don't have to
+poll or sleep. A key is complete when
+
+ * it has had no new files for a quiet period, or
+ * it has as many files as its marker file says
+
+A marker file is a file whose name gives the same key as the data files
+and ends in the marker suffix, for example 1001-1-5000_00000000.count next
+to 1001-1-5000_00000001 ... 1001-1-5000_00000042. It holds the number of
+data files as text. The marker is a file in the directory like any other,
+so it is in the set too, and it is not counted.
+
+The notification is published on a pub/sub channel as
+'<redis_key> <file_count>' (the message test_producer.py sends), or added
+to a stream with the fields key, count and reason ('quiet' or 'marker').
+
+Only files that come through the event loop count as activity; keys loaded
+by a bulk or reconcile scan are not announced. A key that gets new files
+after it was announced is announced again. A key whose set is empty by
+the time we look (a consumer has drained it) is not announced. The sets of
+keys whose marker count isn't reached are looked at again every minute,
+so one drained early is forgotten; a marker is given up after a day.
+"""
+from collections import OrderedDict
+import logging
+import os.path
+import sys
+import time
+
+from event_names import incoming_event_names
+from write_ahead_buffer import is_connection_error
+
+quiet_reason = "quiet"
+marker_reason = "marker"
+
+# the longest time between checks for quiet keys
+_max_check_interval = 1.0
+# how often we look again at the sets of every key with a marker, to
+# forget those a consumer has drained before they were complete
+_marker_sweep_interval = 60.0
+# a marker whose files haven't all come in this long is given up
+_marker_expiry = 24 * 3600.0
+
+class CompletionNotifier(object):
+    """
+    watch dispatched entries for keys that have become complete
+    """
+    def __init__(self, args, redis, rules):
+        self._log = logging.getLogger("CompletionNotifier")
+        self._redis = redis
+        self._quiet_period = args.complete_quiet_period
+        self._marker_suffix = args.complete_marker_suffix
+        self._channel = args.complete_channel
+        self._stream = args.complete_stream
+        self._stream_max_length = args.complete_stream_max_length
+        self._rules = rules
+        if self._quiet_period > 0.0:
+            self._check_interval = min(self._quiet_period / 2.0,
+                                       _max_check_interval)
+        else:
+            self._check_interval = _max_check_interval
+        self._next_check_time = 0.0
+        self._next_sweep_time = 0.0
+        # redis_key -> time of the last new file, oldest first
+        self._last_activity = OrderedDict()
+        # redis_key -> number of data files given by the marker
+        self._expected_counts = dict()
+        # redis_key -> time the marker was read, oldest first
+        self._marker_times = OrderedDict()
+        # keys with a marker and new files since the last check
+        self._changed_marker_keys = set()
+        self.notification_count = 0
+
+    def _watch_path(self, redis_key):
+        for rule in self._rules:
+            if rule.owns_key(redis_key):
+                return rule.watch_path
+        return None
+
+    def _read_marker(self, redis_key, file_name):
+        watch_path = self._watch_path(redis_key)
+        if watch_path is None:
+            return
+        marker_path = os.path.join(watch_path, file_name)
+        try:
+            with open(marker_path, "r") as marker_file:
+                expected_count = int(marker_file.read().strip())
+        except (IOError, OSError, ValueError):
+            instance = sys.exc_info()[1]
+            self._log.warn("unable to read marker {0}: {1}".format(
+                           marker_path, instance))
+            return
+        self._log.debug("{0} expects {1} files".format(redis_key,
+                                                      expected_count))
+        self._expected_counts[redis_key] = expected_count
+        self._marker_times.pop(redis_key, None)
+        self._marker_times[redis_key] = time.time()
+        self._changed_marker_keys.add(redis_key)
+
+    def observe(self, entries):
+        """
+        note the activity in a list of dispatched (redis_key, file_name,
+        event_name) entries
+        """
+        current_time = time.time()
+        for redis_key, file_name, event_name in entries:
+            if event_name not in incoming_event_names:
+                continue
+            if self._marker_suffix is not None and \
+               file_name.endswith(self._marker_suffix):
+                self._read_marker(redis_key, file_name)
+            elif redis_key in self._expected_counts:
+                self._changed_marker_keys.add(redis_key)
+            if self._quiet_period > 0.0:
+                # move the key to the end: the newest activity
+                self._last_activity.pop(redis_key, None)
+                self._last_activity[redis_key] = current_time
+
+    def _complete_keys(self):
+        """
+        return a list of (redis_key, reason) for the keys that look complete
+        """
+        current_time = time.time()
+        marker_keys = self._changed_marker_keys
+        if current_time >= self._next_sweep_time and \
+           len(self._expected_counts) > 0:
+            # the ones that got no new files are looked at too: an empty
+            # set is forgotten
+            self._next_sweep_time = current_time + _marker_sweep_interval
+            marker_keys = set(self._expected_counts.keys())
+
+        complete_keys = list()
+        for redis_key in marker_keys:
+            complete_keys.append((redis_key, marker_reason, ))
+
+        if self._quiet_period > 0.0:
+            deadline = current_time - self._quiet_period
+            for redis_key, last_activity in self._last_activity.items():
+                if last_activity > deadline:
+                    break
+                if redis_key not in marker_keys:
+                    complete_keys.append((redis_key, quiet_reason, ))
+
+        return complete_keys
+
+    def check_due(self):
+        return time.time() >= self._next_check_time
+
+    def check(self):
+        """
+        announce the keys that are complete. Call this regularly, but only
+        while everything dispatched is in redis
+        """
+        if not self.check_due():
+            return
+        self._next_check_time = time.time() + self._check_interval
+
+        self._expire_markers()
+        complete_keys = self._complete_keys()
+        if len(complete_keys) == 0:
+            return
+
+        try:
+            pipeline = self._redis.pipeline(transaction=False)
+            for redis_key, _ in complete_keys:
+                pipeline.scard(redis_key)
+            file_counts = pipeline.execute()
+
+            announcements = list()
+            empty_keys = list()
+            for (redis_key, reason), file_count in zip(complete_keys,
+                                                       file_counts):
+                if file_count == 0:
+                    # drained (or deleted) by a consumer: nothing to announce
+                    empty_keys.append(redis_key)
+                    continue
+                expected_count = self._expected_counts.get(redis_key)
+                if expected_count is not None:
+                    # don't count the marker itself
+                    file_count -= 1
+                    if reason == marker_reason and file_count < expected_count:
+                        continue
+                announcements.append((redis_key, file_count, reason, ))
+
+            pipeline = self._redis.pipeline(transaction=False)
+            for redis_key, file_count, reason in announcements:
+                self._queue_announcement(pipeline,
+                                         redis_key,
+                                         file_count,
+                                         reason)
+            pipeline.execute()
+        except Exception:
+            instance = sys.exc_info()[1]
+            if is_connection_error(instance):
+                # try again at the next check
+                self._log.warn("unable to announce complete keys: {0}".format(
+                               instance))
+                return
+            # don't retry something redis refuses: forget these keys
+            self._log.exception("announcing complete keys")
+            self._forget([redis_key for redis_key, _ in complete_keys])
+            return
+
+        self._forget([redis_key for redis_key, _, _ in announcements] + \
+                     empty_keys)
+        self.notification_count += len(announcements)
+
+    def _expire_markers(self):
+        deadline = time.time() - _marker_expiry
+        expired_keys = list()
+        for redis_key, marker_time in self._marker_times.items():
+            if marker_time > deadline:
+                break
+            expired_keys.append(redis_key)
+        for redis_key in expired_keys:
+            self._log.warn("giving up on {0}: {1} files expected".format(
+                           redis_key, self._expected_counts[redis_key]))
+            self._changed_marker_keys.discard(redis_key)
+            self._last_activity.pop(redis_key, None)
+            self._expected_counts.pop(redis_key, None)
+            self._marker_times.pop(redis_key, None)
+
+    def _forget(self, redis_keys):
+        self._changed_marker_keys.clear()
+        for redis_key in redis_keys:
+            self._last_activity.pop(redis_key, None)
+            self._expected_counts.pop(redis_key, None)
+            self._marker_times.pop(redis_key, None)
+
+    def _queue_announcement(self, pipeline, redis_key, file_count, reason):
+        self._log.debug("{0} complete with {1} files ({2})".format(
+                        redis_key, file_count, reason))
+        if self._channel is not None:
+            pipeline.publish(self._channel,
+                             "{0} {1}".format(redis_key, file_count))
+        else:
+            pipeline.xadd(self._stream,
+                          {"key"    : redis_key,
+                           "count"  : str(file_count),
+                           "reason" : reason, },
+                          maxlen=self._stream_max_length,
+                          approximate=True)
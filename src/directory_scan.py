@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+directory_scan.py
+
+stream the initial directory scan straight into redis, grouping the file
+names by key and loading each key's set in bulk.
+
+This runs before the main loop takes anything off the file name queue, so
+any inotify event that arrives during the scan is applied after it.
+"""
+from collections import OrderedDict
+import errno
+import logging
+import os
+import sys
+import time
+
+from key_naming import default_key_template, make_redis_key
+
+_scandir = getattr(os, "scandir", None)
+_progress_interval = 10.0
+_progress_check_count = 4096
+
+def _iterate_tree(watch_path):
+    """
+    yield the path of every file below watch_path, relative to watch_path
+    """
+    if _scandir is None:
+        for directory, _, file_names in os.walk(watch_path):
+            relative_directory = os.path.relpath(directory, watch_path)
+            for file_name in file_names:
+                if relative_directory == os.curdir:
+                    yield file_name
+                else:
+                    yield os.path.join(relative_directory, file_name)
+        return
+
+    pending_directories = ["", ]
+    while len(pending_directories) > 0:
+        relative_directory = pending_directories.pop()
+        try:
+            entries = _scandir(os.path.join(watch_path, relative_directory))
+        except OSError:
+            instance = sys.exc_info()[1]
+            # a shard directory removed while we walk the tree
+            if relative_directory != "" and instance.errno == errno.ENOENT:
+                continue
+            raise
+        for entry in entries:
+            relative_path = os.path.join(relative_directory, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                pending_directories.append(relative_path)
+            else:
+                yield relative_path
+
+def iterate_file_names(watch_path, recursive=False):
+    """
+    yield the names in a directory without building a list of them.
+    If recursive is True, yield the relative paths of the files in the
+    whole tree instead
+    """
+    if recursive:
+        for file_name in _iterate_tree(watch_path):
+            yield file_name
+        return
+
+    if _scandir is None:
+        for file_name in os.listdir(watch_path):
+            yield file_name
+        return
+
+    for entry in _scandir(watch_path):
+        yield entry.name
+
+def _load_chunk(redis, chunk):
+    """
+    send one multi-member SADD per key, as a single pipeline
+    """
+    pipeline = redis.pipeline(transaction=False)
+    for redis_key, file_names in chunk.items():
+        pipeline.sadd(redis_key, *file_names)
+    pipeline.execute()
+
+def bulk_load_directory(redis, 
+                        watch_path, 
+                        key_extractor, 
+                        redis_prefix, 
+                        chunk_size,
+                        recursive=False,
+                        key_template=default_key_template):
+    """
+    add every matching file name in watch_path to its redis set,
+    chunk_size names at a time. In a recursive scan, the key is
+    extracted from the base name and the set holds the relative path.
+    return the number of file names loaded
+    """
+    log = logging.getLogger("bulk_load_directory")
+    log.info("bulk loading {0} in chunks of {1}".format(watch_path,
+                                                        chunk_size))
+
+    start_time = time.time()
+    next_report_time = start_time + _progress_interval
+    file_count = 0
+    loaded_count = 0
+    chunk = OrderedDict()
+    chunk_count = 0
+    for file_name in iterate_file_names(watch_path, recursive):
+        file_count += 1
+        if file_count % _progress_check_count == 0 and \
+           time.time() >= next_report_time:
+            log.info("scanned {0} files, loaded {1}".format(file_count,
+                                                            loaded_count))
+            next_report_time = time.time() + _progress_interval
+
+        key = key_extractor.extract(file_name.rpartition(os.sep)[2])
+        if key is None:
+            continue
+        redis_key = make_redis_key(key_template, redis_prefix, key)
+        try:
+            chunk[redis_key].append(file_name)
+        except KeyError:
+            chunk[redis_key] = [file_name, ]
+        chunk_count += 1
+
+        if chunk_count >= chunk_size:
+            _load_chunk(redis, chunk)
+            loaded_count += chunk_count
+            chunk = OrderedDict()
+            chunk_count = 0
+
+    if chunk_count > 0:
+        _load_chunk(redis, chunk)
+        loaded_count += chunk_count
+
+    log.info("scanned {0} files, loaded {1} ({2} unmatched) " \
+             "in {3:.3f} secs".format(file_count,
+                                      loaded_count,
+                                      file_count - loaded_count,
+                                      time.time() - start_time))
+    return loaded_count
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+event_coalescer.py
+
+reduce the events for each file name in a batch window to their net effect,
+so short lived files never reach redis.
+
+A file that is added and then removed inside the window costs one SREM.
+We can't tell from IN_CLOSE_WRITE whether the add created the file or
+rewrote one that is already in the set, so the removal always goes out:
+an SREM of a name that is not there is harmless.
+"""
+from collections import OrderedDict
+import logging
+
+class EventCoalescer(object):
+    """
+    coalesce lists of (redis_key, file_name, event_name) entries, keeping
+    count of how many events were eliminated
+    """
+    def __init__(self):
+        self._log = logging.getLogger("EventCoalescer")
+        self.event_count = 0
+        self.eliminated_count = 0
+        self._reported_event_count = 0
+
+    def coalesce(self, entries):
+        """
+        return a list holding at most one entry per file name
+        """
+        if len(entries) < 2:
+            self.event_count += len(entries)
+            return entries
+
+        # (redis_key, file_name) -> last entry, in order of first event
+        last_entries = OrderedDict()
+        for entry in entries:
+            last_entries[entry[:2]] = entry
+
+        result = list(last_entries.values())
+
+        self.event_count += len(entries)
+        self.eliminated_count += len(entries) - len(result)
+        return result
+
+    def log_statistics(self):
+        """
+        log the counts, if anything has changed since we last did
+        """
+        if self.event_count == self._reported_event_count:
+            return
+        self._reported_event_count = self.event_count
+        self._log.info("coalesced {0} events, eliminated {1}".format(
+                       self.event_count, self.eliminated_count))
@@ -12,3 +12,21 @@ inotify_moved_to = "IN_MOVED_TO"
 inotify_delete = "IN_DELETE"
 inotify_moved_from = "IN_MOVED_FROM"
 inotify_idle = "INOTIFY_IDLE"
+inotify_overflow = "INOTIFY_OVERFLOW"
+found_in_new_directory = "FOUND_IN_NEW_DIRECTORY"
+events_dropped = "EVENTS_DROPPED"
+# what a rescan of a name whose events were dropped finds
+found_on_rescan = "FOUND_ON_RESCAN"
+missing_on_rescan = "MISSING_ON_RESCAN"
+# a consumer has claimed a set: (None, key_claimed, (redis_key, count))
+key_claimed = "KEY_CLAIMED"
+
+# events that add a file name to its set, and events that remove it
+incoming_event_names = frozenset([found_at_startup,
+                                  found_in_new_directory,
+                                  found_on_rescan,
+                                  inotify_close_write,
+                                  inotify_moved_to, ])
+outgoing_event_names = frozenset([inotify_delete,
+                                  inotify_moved_from,
+                                  missing_on_rescan, ])
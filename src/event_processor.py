@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+event_processor.py
+
+turn batches of (file_name, event_name, watch_descriptor) queue entries
+into the work the event loop has to do. This holds no redis connection, so
+the same processing serves the threaded and the asyncio engines.
+"""
+import logging
+import os
+
+from log_limiter import RateLimitedLog
+
+from event_names import directory_scan_finished, \
+                        inotify_idle, \
+                        inotify_overflow, \
+                        events_dropped, \
+                        found_on_rescan, \
+                        missing_on_rescan, \
+                        key_claimed
+
+# the steps yielded by EventProcessor.process_batch
+dispatch_step = "dispatch"
+up_to_date_step = "up_to_date"
+idle_step = "idle"
+overflow_step = "overflow"
+claimed_step = "claimed"
+
+class EventProcessor(object):
+    """
+    route queue entries to their rule by watch descriptor, extract keys and
+    keep track of when we can claim to be up to date
+    """
+    def __init__(self, rules):
+        self._log = logging.getLogger("EventProcessor")
+        self._unknown_log = RateLimitedLog(self._log,
+                                           logging.WARN,
+                                           "unknown watch descriptor")
+        self._rules_by_watch_descriptor = dict()
+        for rule in rules:
+            self._rules_by_watch_descriptor[rule.watch_descriptor] = rule
+        self._pending_directory_scans = \
+            set(self._rules_by_watch_descriptor.keys())
+        self.up_to_date = False
+        # event_name -> number of entries seen
+        self.event_counts = dict()
+        # the BoundedQueue that drops events, if there is one
+        self.dropped_events = None
+
+    def _rescan_dropped(self, batch):
+        """
+        replace the events_dropped marker with an entry for each name whose
+        events were dropped, saying whether the file is there now
+        """
+        for entry in batch:
+            if entry[1] != events_dropped:
+                yield entry
+                continue
+            for file_name, watch_descriptor in \
+                self.dropped_events.take_dropped(entry[2]):
+                rule = self._rules_by_watch_descriptor.get(watch_descriptor)
+                if rule is None:
+                    continue
+                if os.path.lexists(os.path.join(rule.watch_path, file_name)):
+                    yield file_name, found_on_rescan, watch_descriptor
+                else:
+                    yield file_name, missing_on_rescan, watch_descriptor
+
+    def process_batch(self, batch):
+        """
+        generate (step, entries) pairs, in order:
+            (dispatch_step, [(redis_key, file_name, event_name), ...])
+            (up_to_date_step, None): everything so far is in redis
+            (idle_step, None): the notifier has gone idle
+            (overflow_step, None): events were lost, resync the sets
+            (claimed_step, (redis_key, member_count)): a consumer has
+                claimed a set
+        The caller stops iterating if a dispatch fails.
+        """
+        pending_entries = list()
+        event_counts = self.event_counts
+        # look once per batch, not per event
+        debug = self._log.isEnabledFor(logging.DEBUG)
+        if self.dropped_events is not None:
+            batch = self._rescan_dropped(batch)
+        for file_name, event_name, watch_descriptor in batch:
+            try:
+                event_counts[event_name] += 1
+            except KeyError:
+                event_counts[event_name] = 1
+
+            if event_name == directory_scan_finished:
+                self._log.debug("setting directory_scan_up_to_date {0}".format(
+                    self._rules_by_watch_descriptor[watch_descriptor].name))
+                self._pending_directory_scans.discard(watch_descriptor)
+                continue
+
+            if event_name == inotify_idle:
+                if not self.up_to_date and \
+                   len(self._pending_directory_scans) == 0:
+                    # everything queued ahead of the idle marker must be
+                    # in redis before we claim to be up to date
+                    if len(pending_entries) > 0:
+                        yield dispatch_step, pending_entries
+                        pending_entries = list()
+                    # set before yielding, so the caller can take it back
+                    # if it is unable to mark redis up to date
+                    self.up_to_date = True
+                    yield up_to_date_step, None
+                yield idle_step, None
+                continue
+
+            if event_name == inotify_overflow:
+                if len(pending_entries) > 0:
+                    yield dispatch_step, pending_entries
+                    pending_entries = list()
+                # we are up to date again after the resync, when the 
+                # notifier next goes idle
+                self.up_to_date = False
+                yield overflow_step, None
+                continue
+
+            if event_name == key_claimed:
+                # the claim comes after everything dispatched so far;
+                # the third element of the marker is (redis_key, count)
+                if len(pending_entries) > 0:
+                    yield dispatch_step, pending_entries
+                    pending_entries = list()
+                yield claimed_step, watch_descriptor
+                continue
+
+            try:
+                rule = self._rules_by_watch_descriptor[watch_descriptor]
+            except KeyError:
+                self._unknown_log("unknown watch descriptor {0} '{1}' {2}",
+                                  watch_descriptor, file_name, event_name)
+                continue
+
+            # in a recursive rule, file_name is a path relative to the
+            # watch directory; the key comes from the base name
+            key = rule.key_extractor.extract(file_name.rpartition(os.sep)[2])
+            if key is None:
+                rule.unmatched_count += 1
+                if debug:
+                    self._log.debug("unmatched file name '{0}'".format(
+                                    file_name))
+                continue
+
+            if debug:
+                self._log.debug("found file_name '{0}' key {1} " \
+                                "event {2}".format(file_name, key, event_name))
+            redis_key = rule.redis_key(key)
+            pending_entries.append((redis_key, file_name, event_name, ))
+
+        if len(pending_entries) > 0:
+            yield dispatch_step, pending_entries
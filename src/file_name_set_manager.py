@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+file_name_set_manager.py
+
+maintain sets of file names by watching directories with inotify, from
+inside another program:
+
+    rules = [WatchRule("default", watch_path, key_regex, "prefix"), ]
+    index = MemorySetBackend()
+    manager = FileNameSetManager(rules, [index, RedisSetBackend(redis), ])
+    manager.start()
+    ...
+    index.members("prefix_key")
+    ...
+    manager.stop()
+
+start() scans the directories into every backend, then applies events
+from a dispatcher thread. A MemorySetBackend answers queries without a
+round trip; SetQueryServer serves it to other processes on the host.
+
+This is the core of file_name_set_manager_main, without its commandline,
+its redis extras (batch scripts, the key index, the write-ahead buffer,
+shards, checkpoints) or the asyncio engine.
+"""
+import logging
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from threading import Event, Thread
+import time
+
+from batch_dispatch import collect_batch
+from event_names import directory_scan_finished
+from event_processor import EventProcessor, \
+                            dispatch_step, \
+                            up_to_date_step, \
+                            overflow_step
+from inotify_setup import create_notifier, create_notifier_thread
+from reconcile import scan_directory_sets
+
+class FileNameSetManager(object):
+    """
+    keep the sets of file names for a list of WatchRules in one or more
+    set backends
+    """
+    def __init__(self, 
+                 rules, 
+                 backends, 
+                 batch_size=1, 
+                 batch_latency=0.0,
+                 direct_reader=False):
+        self._log = logging.getLogger("FileNameSetManager")
+        self._rules = rules
+        self._backends = backends
+        self._batch_size = batch_size
+        self._batch_latency = batch_latency
+        self._direct_reader = direct_reader
+        self._halt_event = Event()
+        self._up_to_date_event = Event()
+        self._file_name_queue = queue.Queue()
+        self._notifier = None
+        self._processor = None
+        self._notifier_thread = None
+        self._dispatcher_thread = None
+        self.failed = False
+
+    def start(self):
+        """
+        start watching, and load the backends with what the directories
+        hold now. The events that arrive during the scan are applied after
+        it, by the dispatcher thread
+        """
+        notifier, watch_descriptors = create_notifier(
+            [rule.watch_path for rule in self._rules],
+            self._file_name_queue,
+            recursive_paths=[rule.watch_path for rule in self._rules
+                             if rule.recursive],
+            overflow_recovery=True,
+            direct=self._direct_reader)
+        self._notifier = notifier
+        for rule in self._rules:
+            rule.watch_descriptor = watch_descriptors[rule.watch_path]
+        self._processor = EventProcessor(self._rules)
+
+        for backend in self._backends:
+            backend.mark_up_to_date(self._rules, 0)
+
+        self._notifier_thread = create_notifier_thread(self._halt_event,
+                                                       notifier,
+                                                       self._file_name_queue)
+        self._notifier_thread.start()
+
+        try:
+            for rule in self._rules:
+                self._scan(rule)
+                self._file_name_queue.put((None,
+                                           directory_scan_finished,
+                                           rule.watch_descriptor, ))
+        except Exception:
+            self._halt_event.set()
+            self._notifier_thread.join(timeout=5.0)
+            notifier.stop()
+            raise
+
+        self._dispatcher_thread = Thread(target=self._dispatch,
+                                         name="dispatcher")
+        self._dispatcher_thread.daemon = True
+        self._dispatcher_thread.start()
+
+    def stop(self):
+        self._halt_event.set()
+        if self._dispatcher_thread is not None:
+            self._dispatcher_thread.join(timeout=5.0)
+        if self._notifier_thread is not None:
+            self._notifier_thread.join(timeout=5.0)
+        if self._notifier is not None:
+            self._notifier.stop()
+        for backend in self._backends:
+            try:
+                backend.mark_up_to_date(self._rules, 0)
+            except Exception:
+                self._log.exception("clearing up to date timestamps")
+
+    def wait_up_to_date(self, timeout=None):
+        """
+        wait until everything up to now is in the backends.
+        return False on timeout, or if the manager has failed
+        """
+        self._up_to_date_event.wait(timeout)
+        return self._up_to_date_event.is_set() and not self.failed
+
+    def _scan(self, rule):
+        start_time = time.time()
+        directory_sets = scan_directory_sets(rule.watch_path,
+                                             rule.key_extractor,
+                                             rule.redis_prefix,
+                                             rule.recursive,
+                                             rule.key_template)
+        for backend in self._backends:
+            backend.replace(rule, directory_sets)
+        self._log.info("{0} scanned {1} keys in {2:.3f} secs".format(
+                       rule.name,
+                       len(directory_sets),
+                       time.time() - start_time))
+
+    def _dispatch(self):
+        try:
+            succeeded = self._dispatch_loop()
+        except Exception:
+            self._log.exception("dispatcher")
+            succeeded = False
+        if not succeeded:
+            self.failed = True
+            self._halt_event.set()
+            # let anyone waiting see the failure
+            self._up_to_date_event.set()
+
+    def _dispatch_loop(self):
+        """
+        return False on failure
+        """
+        while not self._halt_event.is_set():
+            try:
+                entry = self._file_name_queue.get(block=True, timeout=1.0)
+            except queue.Empty:
+                continue
+
+            if self._batch_size > 1:
+                batch = collect_batch(self._file_name_queue,
+                                      entry,
+                                      self._batch_size,
+                                      self._batch_latency)
+            else:
+                batch = [entry, ]
+
+            for step, entries in self._processor.process_batch(batch):
+                if step == dispatch_step:
+                    for backend in self._backends:
+                        if not backend.apply(entries):
+                            return False
+                elif step == up_to_date_step:
+                    current_time = int(time.time())
+                    for backend in self._backends:
+                        backend.mark_up_to_date(self._rules, current_time)
+                    self._up_to_date_event.set()
+                elif step == overflow_step:
+                    self._recover()
+
+        return True
+
+    def _recover(self):
+        """
+        events were lost: scan the directories again. The events queued
+        meanwhile are applied after the scan
+        """
+        self._log.warn("inotify queue overflow: scanning again")
+        self._up_to_date_event.clear()
+        for backend in self._backends:
+            backend.mark_up_to_date(self._rules, 0)
+        for rule in self._rules:
+            self._scan(rule)
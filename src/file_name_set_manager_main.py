@@ -5,10 +5,8 @@ file_name_set_manager_main.py
 This program will maintain redis sets of of file names by watching a directory 
 with inotify
 """
+import functools
 import logging
-import os
-import os.path
-import re
 try:
     import queue
 except ImportError:
@@ -19,50 +17,529 @@ import time
 
 from signal_handler import set_signal_handler
 from log_setup import initialize_stderr_logging, initialize_file_logging
-from commandline import parse_commandline, CommandlineError
+from log_limiter import RateLimitedLog, log_suppressed_counts
+from commandline import parse_commandline, CommandlineError, \
+                        asyncio_engine_name, direct_reader_name
 from inotify_setup import create_notifier, create_notifier_thread, InotifyError
 from redis_connection import create_redis_connection
+from batch_dispatch import collect_batch, execute_batch
+from event_coalescer import EventCoalescer
+from bounded_queue import BoundedQueue, drop_policy
+from set_mirror import SetMirror
+from claim_listener import ClaimListener
+from directory_scan import bulk_load_directory, iterate_file_names
+from reconcile import reconcile_directory, scan_directory_sets
+from namespace_cleanup import clear_namespace
+from key_extractor import create_key_extractor
+from event_processor import EventProcessor, \
+                            dispatch_step, \
+                            up_to_date_step, \
+                            overflow_step, \
+                            claimed_step, \
+                            idle_step
+from overflow_recovery import OverflowRecovery
+from completion_notifier import CompletionNotifier
+from key_index import KeyIndex, rebuild_index
+from batch_script import BatchScript
+from checkpoint import Checkpoint
+from shard_dispatch import ShardPool
+from write_ahead_buffer import WriteAheadBuffer, \
+                               is_connection_error, \
+                               all_connection_errors
+from metrics import Metrics, MetricsServer
+from set_backends import MemorySetBackend
+from set_query_server import SetQueryServer
+from watch_rules import WatchRule, WatchRuleError, load_watch_rules, \
+                        check_watch_rules
 from event_names import found_at_startup, \
                         directory_scan_finished, \
                         inotify_close_write, \
                         inotify_moved_to, \
                         inotify_delete, \
                         inotify_moved_from, \
-                        inotify_idle
+                        found_in_new_directory, \
+                        found_on_rescan, \
+                        missing_on_rescan
 
-_up_to_date_timestamp = "up_to_date"
+_startup_file_log = RateLimitedLog(
+    logging.getLogger("_initial_directory_scan"), 
+    logging.INFO, 
+    "file found at startup")
+_duplicate_log = RateLimitedLog(logging.getLogger("_process_incoming_file"),
+                                logging.WARN,
+                                "duplicate add")
+_dispatch_failure_log = RateLimitedLog(logging.getLogger("_dispatch_entries"),
+                                       logging.ERROR,
+                                       "dispatch failure")
+_replay_failure_log = RateLimitedLog(logging.getLogger("_replay_buffer"),
+                                     logging.ERROR,
+                                     "replay failure")
 
-def _initial_directory_scan(watch_path, file_name_queue):    
+def _initial_directory_scan(watch_path, 
+                            recursive, 
+                            watch_descriptor, 
+                            file_name_queue):    
     """
     load the queue with filenames found on startup
     """
     log = logging.getLogger("_initial_directory_scan")
-    for file_name in os.listdir(watch_path):
-        log.info("putting ({0}, {1})".format(file_name, found_at_startup))
-        file_name_queue.put((file_name, found_at_startup, ))
+    file_count = 0
+    for file_name in iterate_file_names(watch_path, recursive):
+        _startup_file_log("putting ({0}, {1})", file_name, found_at_startup)
+        file_name_queue.put((file_name, found_at_startup, watch_descriptor, ))
+        file_count += 1
+    log.info("queued {0} files found in {1}".format(file_count, watch_path))
 
     # mark the queue to show the end of these files
-    file_name_queue.put((None, directory_scan_finished, ))
+    file_name_queue.put((None, directory_scan_finished, watch_descriptor, ))
     log.debug("putting ({0}, {1})".format(None, directory_scan_finished))
  
 def _process_incoming_file(redis, redis_key, file_name):
-    log = logging.getLogger("_process_incoming_file")
-
     add_count = redis.sadd(redis_key, file_name)
     # this is probably some form of duplicate, so we don't abort
     if add_count == 0:
-        log.warn("sadd({0}, {1}) returned add count 0".format(redis_key, 
-                                                              file_name))
+        _duplicate_log("sadd({0}, {1}) returned add count 0", 
+                       redis_key, 
+                       file_name)
 def _process_outgoing_file(redis, redis_key, file_name):
     # we don't warn on a zero count here, because the user can
     # delete the key when he is no longer interested in it
     _ = redis.srem(redis_key, file_name)
 
 _dispatch_table = {found_at_startup        : _process_incoming_file,
+                   found_in_new_directory  : _process_incoming_file,
+                   found_on_rescan         : _process_incoming_file,
                    inotify_close_write     : _process_incoming_file,
                    inotify_moved_to        : _process_incoming_file,
                    inotify_delete          : _process_outgoing_file,
-                   inotify_moved_from      : _process_outgoing_file}
+                   inotify_moved_from      : _process_outgoing_file,
+                   missing_on_rescan       : _process_outgoing_file}
+
+def _send_entries(redis, 
+                  entries, 
+                  key_index=None, 
+                  batch_script=None, 
+                  up_to_date_time=None):
+    """
+    send a list of (redis_key, file_name, event_name) entries to redis:
+    one at a time through _dispatch_table, as a pipelined batch, or 
+    through the batch script. The key index is only kept by the batch 
+    paths, and only the batch script sets up_to_date_time.
+    returns a list of (file_name, event_name, exception) for the entries
+    that failed
+    """
+    if batch_script is not None:
+        return batch_script.execute(entries, up_to_date_time)
+
+    if len(entries) == 1 and key_index is None:
+        redis_key, file_name, event_name = entries[0]
+        try:
+            _dispatch_table[event_name](redis, redis_key, file_name)
+        except Exception:
+            return [(file_name, event_name, sys.exc_info()[1], ), ]
+        return []
+
+    return execute_batch(redis, entries, key_index)
+
+def _dispatch_entries(redis, 
+                      entries, 
+                      coalescer=None, 
+                      write_buffer=None, 
+                      key_index=None,
+                      batch_script=None,
+                      up_to_date_time=None):
+    """
+    send a list of (redis_key, file_name, event_name) entries to redis.
+    With a write-ahead buffer, entries that redis was unable to take,
+    and everything after them, are buffered for replay.
+    With a batch script, up_to_date_time (if not None) is set in the same
+    step as the entries.
+    return False if any of them failed
+    """
+    if coalescer is not None:
+        entries = coalescer.coalesce(entries)
+
+    if len(entries) == 0:
+        return True
+
+    # keep the order of events: nothing overtakes the buffer
+    if write_buffer is not None and write_buffer.pending():
+        return write_buffer.append(entries)
+
+    failures = _send_entries(redis, 
+                             entries, 
+                             key_index, 
+                             batch_script, 
+                             up_to_date_time)
+    if write_buffer is not None and all_connection_errors(failures):
+        return write_buffer.append(entries, failures[0][2])
+
+    for file_name, event_name, instance in failures:
+        _dispatch_failure_log("{0} {1} {2}", file_name, event_name, instance)
+    return len(failures) == 0
+
+def _replay_buffer(redis, 
+                   write_buffer, 
+                   rules, 
+                   key_index=None, 
+                   batch_script=None):
+    """
+    once its retry is due, send what the write-ahead buffer holds, in order.
+    return False on an error that is not a connection error
+    """
+    log = logging.getLogger("_replay_buffer")
+
+    if not write_buffer.retry_due():
+        return True
+
+    if not write_buffer.up_to_date_cleared:
+        try:
+            for rule in rules:
+                log.debug("setting {0} to {1}".format(
+                          rule.up_to_date_timestamp_key, 0))
+                redis.set(rule.up_to_date_timestamp_key, "0")
+        except Exception:
+            instance = sys.exc_info()[1]
+            if not is_connection_error(instance):
+                log.exception("clearing up to date timestamps")
+                return False
+            write_buffer.retry_failed(instance)
+            return True
+        write_buffer.up_to_date_cleared = True
+
+    while write_buffer.pending():
+        chunk = write_buffer.next_chunk()
+        failures = _send_entries(redis, chunk, key_index, batch_script)
+        if all_connection_errors(failures):
+            write_buffer.retry_failed(failures[0][2])
+            return True
+        for file_name, event_name, instance in failures:
+            _replay_failure_log("{0} {1} {2}", file_name, event_name, instance)
+        if len(failures) > 0:
+            return False
+        write_buffer.chunk_sent(len(chunk))
+
+    return True
+
+def _hand_buffer_to_shards(redis, write_buffer, rules, shard_pool):
+    """
+    pass what the write-ahead buffer holds to the shards, in order.
+    return False if a shard has failed
+    """
+    log = logging.getLogger("_hand_buffer_to_shards")
+
+    if not write_buffer.up_to_date_cleared:
+        try:
+            for rule in rules:
+                redis.set(rule.up_to_date_timestamp_key, "0")
+        except Exception:
+            instance = sys.exc_info()[1]
+            if not is_connection_error(instance):
+                log.exception("clearing up to date timestamps")
+                return False
+            # try again on the next pass
+            return True
+        write_buffer.up_to_date_cleared = True
+
+    while write_buffer.pending():
+        chunk = write_buffer.next_chunk()
+        if not shard_pool.dispatch(chunk):
+            return False
+        write_buffer.chunk_sent(len(chunk))
+    return True
+
+def _startup_scan(args, 
+                  redis, 
+                  rule, 
+                  file_name_queue, 
+                  key_index=None, 
+                  checkpoint=None,
+                  query_backend=None):
+    """
+    bring the sets for one rule up to date with its directory, by
+    restoring a checkpoint, reconciling, bulk loading or queueing the file 
+    names found on startup.
+    return False on failure
+    """
+    log = logging.getLogger("_startup_scan")
+
+    # what the sets hold after a restore, reconcile or bulk load
+    directory_sets = None
+    if checkpoint is not None:
+        try:
+            checkpoint.restore(redis, rule)
+        except Exception:
+            log.exception("restore {0}".format(rule.name))
+            return False
+        directory_sets = checkpoint.rule_contents(rule)
+    elif args.reconcile:
+        try:
+            if query_backend is not None:
+                directory_sets = scan_directory_sets(rule.watch_path,
+                                                     rule.key_extractor,
+                                                     rule.redis_prefix,
+                                                     rule.recursive,
+                                                     rule.key_template)
+            reconcile_directory(redis, 
+                                rule.watch_path, 
+                                rule.key_extractor, 
+                                rule.redis_prefix,
+                                args.scan_chunk_size,
+                                args.cleanup_batch_size,
+                                exclude_keys=rule.reserved_keys,
+                                recursive=rule.recursive,
+                                key_template=rule.key_template,
+                                directory_sets=(None if directory_sets is None
+                                                else dict(directory_sets)))
+        except Exception:
+            log.exception("reconcile_directory {0}".format(rule.name))
+            return False
+    elif args.bulk_scan:
+        try:
+            bulk_load_directory(redis, 
+                                rule.watch_path, 
+                                rule.key_extractor, 
+                                rule.redis_prefix,
+                                args.scan_chunk_size,
+                                recursive=rule.recursive,
+                                key_template=rule.key_template)
+        except Exception:
+            log.exception("bulk_load_directory {0}".format(rule.name))
+            return False
+    else:
+        _initial_directory_scan(rule.watch_path, 
+                                rule.recursive,
+                                rule.watch_descriptor, 
+                                file_name_queue)
+        return True
+
+    # the restore, the bulk load and the reconcile bypass the dispatcher
+    if key_index is not None:
+        try:
+            rebuild_index(redis, rule, args.cleanup_batch_size)
+        except Exception:
+            log.exception("rebuild_index {0}".format(rule.name))
+            return False
+
+    if query_backend is not None:
+        try:
+            if directory_sets is None:
+                # the bulk load streams the names: scan them again
+                directory_sets = scan_directory_sets(rule.watch_path,
+                                                     rule.key_extractor,
+                                                     rule.redis_prefix,
+                                                     rule.recursive,
+                                                     rule.key_template)
+        except Exception:
+            log.exception("scan_directory_sets {0}".format(rule.name))
+            return False
+        query_backend.replace(rule, directory_sets)
+
+    file_name_queue.put((None, 
+                         directory_scan_finished, 
+                         rule.watch_descriptor, ))
+    return True
+
+def _mark_up_to_date(redis, rules, query_backend=None):
+    """
+    everything up to now is in redis
+    """
+    log = logging.getLogger("_mark_up_to_date")
+    current_time = int(time.time())
+    for rule in rules:
+        log.debug("setting {0} to {1}".format(rule.up_to_date_timestamp_key, 
+                                              current_time))
+        redis.set(rule.up_to_date_timestamp_key, str(current_time))
+    if query_backend is not None:
+        query_backend.mark_up_to_date(rules, current_time)
+
+def _main_loop(args, 
+               redis, 
+               rules, 
+               processor, 
+               coalescer, 
+               set_mirror,
+               query_backend,
+               overflow_recovery,
+               metrics,
+               write_buffer,
+               completion_notifier,
+               key_index,
+               batch_script,
+               checkpoint,
+               shard_pool,
+               file_name_queue, 
+               halt_event):
+    """
+    take entries off the queue filled by the notifier thread, and send 
+    them to redis
+    The return value will be the returncode for the program
+    """
+    log = logging.getLogger("main")
+    log.info("main loop starts")
+    while not halt_event.is_set():
+
+        try:
+            entry = file_name_queue.get(block=True, timeout=1.0)
+        except queue.Empty:
+            # a pending recovery is retried even when nothing happens
+            if not overflow_recovery.pending:
+                continue
+            entry = None
+        except KeyboardInterrupt:
+            log.warn("KeyboardInterrupt: halting")
+            halt_event.set()
+            break
+
+        if entry is None:
+            batch = list()
+        elif args.batch_size > 1:
+            batch = collect_batch(file_name_queue, 
+                                  entry, 
+                                  args.batch_size, 
+                                  args.batch_latency)
+        else:
+            batch = [entry, ]
+
+        for step, entries in processor.process_batch(batch):
+            if step == dispatch_step:
+                start_time = time.time()
+                sent_entries = entries
+                if set_mirror is not None:
+                    sent_entries = set_mirror.filter(entries)
+                if overflow_recovery.pending:
+                    # the reconcile will scan the directories after these
+                    succeeded = True
+                elif checkpoint is not None and not checkpoint.changing(redis):
+                    # redis is unreachable: hold the entries until it is 
+                    # back and the checkpoint tokens are gone
+                    succeeded = write_buffer is not None and \
+                                write_buffer.append(sent_entries)
+                elif shard_pool is not None:
+                    if write_buffer is not None and write_buffer.pending():
+                        # nothing overtakes the entries held for the
+                        # checkpoint tokens
+                        succeeded = write_buffer.append(sent_entries)
+                    else:
+                        succeeded = shard_pool.dispatch(sent_entries)
+                else:
+                    # once we are up to date, the batch script moves the 
+                    # timestamp along with each batch that empties the queue
+                    up_to_date_time = None
+                    if batch_script is not None and processor.up_to_date and \
+                       file_name_queue.qsize() == 0:
+                        up_to_date_time = int(start_time)
+                    succeeded = _dispatch_entries(redis, 
+                                                  sent_entries, 
+                                                  coalescer, 
+                                                  write_buffer,
+                                                  key_index,
+                                                  batch_script,
+                                                  up_to_date_time)
+                if metrics is not None:
+                    metrics.observe_redis_latency(time.time() - start_time)
+                if not succeeded:
+                    halt_event.set()
+                    return 1
+                if query_backend is not None:
+                    query_backend.apply(entries)
+                if completion_notifier is not None:
+                    completion_notifier.observe(entries)
+                if checkpoint is not None:
+                    checkpoint.observe(entries)
+            elif step == up_to_date_step:
+                if overflow_recovery.pending:
+                    # we are up to date after the reconcile
+                    processor.up_to_date = False
+                elif shard_pool is not None and not shard_pool.caught_up():
+                    # we are up to date when every shard has caught up
+                    processor.up_to_date = False
+                elif write_buffer is None:
+                    _mark_up_to_date(redis, rules, query_backend)
+                elif write_buffer.pending():
+                    # we are up to date when the buffer has drained
+                    processor.up_to_date = False
+                else:
+                    try:
+                        _mark_up_to_date(redis, rules, query_backend)
+                    except Exception:
+                        instance = sys.exc_info()[1]
+                        if not is_connection_error(instance):
+                            raise
+                        log.warn("unable to mark up to date: {0}".format(
+                                 instance))
+                        processor.up_to_date = False
+            elif step == idle_step:
+                if metrics is not None:
+                    metrics.mark_idle()
+                if coalescer is not None:
+                    coalescer.log_statistics()
+                if set_mirror is not None:
+                    set_mirror.log_statistics()
+                log_suppressed_counts()
+            elif step == claimed_step:
+                redis_key, member_count = entries
+                if not set_mirror.claim(redis_key, member_count):
+                    log.info("claim of {0} ({1} members) doesn't match " \
+                             "the mirror: removes go to redis".format(
+                             redis_key, member_count))
+            elif step == overflow_step:
+                overflow_recovery.overflowed()
+
+        # the shards apply what they were given before the overflow first
+        if overflow_recovery.retry_due() and \
+           (shard_pool is None or shard_pool.caught_up()):
+            if not overflow_recovery.recover():
+                halt_event.set()
+                return 1
+
+        if write_buffer is not None and write_buffer.pending() and \
+           not overflow_recovery.pending and \
+           (checkpoint is None or checkpoint.changing(redis)):
+            if shard_pool is not None:
+                # the shards send (and if need be buffer) the entries
+                # held for the checkpoint tokens
+                succeeded = _hand_buffer_to_shards(redis, 
+                                                   write_buffer, 
+                                                   rules, 
+                                                   shard_pool)
+            else:
+                succeeded = _replay_buffer(redis, 
+                                           write_buffer, 
+                                           rules, 
+                                           key_index, 
+                                           batch_script)
+            if not succeeded:
+                halt_event.set()
+                return 1
+            if not write_buffer.pending():
+                # redis has caught up: mark it up to date at the next idle
+                processor.up_to_date = False
+
+        if shard_pool is not None:
+            if not shard_pool.check():
+                halt_event.set()
+                return 1
+            if shard_pool.buffered:
+                # a shard is riding out an outage: mark redis up to date
+                # again at the first idle after every shard has caught up
+                shard_pool.buffered = False
+                processor.up_to_date = False
+
+        if completion_notifier is not None and \
+           (write_buffer is None or not write_buffer.pending()) and \
+           (shard_pool is None or shard_pool.caught_up()):
+            completion_notifier.check()
+
+        if checkpoint is not None and checkpoint.write_due() and \
+           (write_buffer is None or not write_buffer.pending()) and \
+           (shard_pool is None or shard_pool.caught_up()):
+            try:
+                checkpoint.write(redis, file_name_queue.qsize() == 0)
+            except Exception:
+                log.exception("writing checkpoint")
+
+    return 0
 
 def main():
     """
@@ -79,113 +556,314 @@ def main():
         log.error("invalid commandline {0}".format(instance))
         return 1
 
-    if not "(?P<key>" in args.key_regex:
-        log.error("invalid key regex {0}".format(args.key_regex))
-        return 1
-
     try:
-        key_regex = re.compile(args.key_regex)
-    except Exception:
+        if args.config_path is None:
+            rules = [WatchRule("default", 
+                               args.watch_path, 
+                               args.key_regex, 
+                               args.redis_prefix,
+                               args.recursive,
+                               args.key_template), ]
+            check_watch_rules(rules)
+        else:
+            rules = load_watch_rules(args.config_path, 
+                                     args.recursive, 
+                                     args.key_template)
+    except WatchRuleError:
         instance = sys.exc_info()[1]
-        log.error("Unable to compile key_regex {0} {1}".format(args.key_regex,
-                                                               instance))
-        return 1        
+        log.error(str(instance))
+        return 1
 
-    initialize_file_logging(args.log_path, args.verbose)
+    initialize_file_logging(args.log_path, args.verbose, args.log_background)
 
-    log.info("key regex pattern = '{0}'".format(key_regex.pattern))
+    for rule in rules:
+        log.info("rule {0}".format(rule))
+        rule.key_extractor = create_key_extractor(rule.key_regex,
+                                                  args.key_delimiter,
+                                                  args.key_position,
+                                                  args.key_memo_size,
+                                                  args.key_memo_separator)
+    if args.batch_size > 1:
+        log.info("batching up to {0} events, max latency {1} secs".format(
+                 args.batch_size, args.batch_latency))
+    coalescer = (EventCoalescer() if args.coalesce else None)
 
     halt_event = Event()
     set_signal_handler(halt_event)
 
-    file_name_queue = queue.Queue()    
+    # fork the shard workers before we open inotify and redis, so they
+    # don't inherit them
+    shard_pool = None
+    if args.shards > 1:
+        shard_pool = ShardPool(args, 
+                               rules, 
+                               coalescer, 
+                               _dispatch_entries, 
+                               _replay_buffer)
+        shard_pool.start()
+
+    if args.engine == asyncio_engine_name:
+        try:
+            from asyncio_engine import AsyncioEngine
+        except ImportError:
+            log.exception("the asyncio engine is not available")
+            return 1
+        engine = AsyncioEngine(args, coalescer, halt_event)
+        # the notifier feeds the engine's buffer instead of a queue.Queue
+        file_name_queue = engine.event_buffer
+    elif args.queue_limit > 0 or args.queue_memory_limit > 0:
+        engine = None
+        file_name_queue = BoundedQueue(args.queue_limit,
+                                       args.queue_memory_limit,
+                                       args.queue_overload)
+    else:
+        engine = None
+        file_name_queue = queue.Queue()    
 
     try:
-        notifier = create_notifier(args.watch_path, file_name_queue)
+        notifier, watch_descriptors = create_notifier(
+            [rule.watch_path for rule in rules], 
+            file_name_queue,
+            recursive_paths=[rule.watch_path for rule in rules 
+                             if rule.recursive],
+            overflow_recovery=args.overflow_recovery,
+            direct=(args.inotify_reader == direct_reader_name))
     except InotifyError as instance:
         log.error("Unable to initialize inotify: {0}".format(instance))
         return 1
 
+    # events are routed to their rule by watch descriptor
+    rules_by_watch_descriptor = dict()
+    for rule in rules:
+        rule.watch_descriptor = watch_descriptors[rule.watch_path]
+        if rule.watch_descriptor in rules_by_watch_descriptor:
+            log.error("{0} and {1} watch the same directory".format(
+                      rules_by_watch_descriptor[rule.watch_descriptor].name,
+                      rule.name))
+            return 1
+        rules_by_watch_descriptor[rule.watch_descriptor] = rule
+
     try:
-        redis = create_redis_connection()
+        redis = create_redis_connection(
+            socket_path=args.redis_socket,
+            socket_timeout=args.redis_timeout,
+            connect_timeout=args.redis_connect_timeout,
+            max_connections=args.redis_max_connections,
+            cluster=args.cluster)
     except Exception:
         log.exception("Unable to connect to redis")
         return 1
 
-    # clear REDIS of all keys under our namespace, so that old sets that 
-    # don't have any files anymore don't stay around
-    existing_keys = redis.keys("_".join([args.redis_prefix, "*"]))
-    if len(existing_keys) > 0: 
-        log.debug("deleting {0} existing REDIS keys".format(
-                  len(existing_keys), ))
-        redis.delete(*existing_keys)
-
-    # set our up-to-date time as far back as we can: we aren't up to date yet
-    up_to_date_timestamp_key = "_".join([args.redis_prefix, 
-                                         _up_to_date_timestamp])
-    log.debug("setting {0} to {1}".format(up_to_date_timestamp_key, 0))
-    redis.set(up_to_date_timestamp_key, "0")
-
-    notifier_thread = create_notifier_thread(halt_event, 
-                                             notifier, 
-                                             file_name_queue)
+    checkpoint = None
+    if args.checkpoint_path is not None:
+        checkpoint = Checkpoint(args, rules)
+        try:
+            checkpoint.load(redis)
+        except Exception:
+            log.exception("loading checkpoint")
+            return 1
 
-    # we want the notifier running while we do the initial directory scan, so
-    # we don't miss any files. 
-    notifier_thread.start()
+    for rule in rules:
+        # clear REDIS of all keys under our namespace, so that old sets that 
+        # don't have any files anymore don't stay around.
+        # In reconcile mode, and with a checkpoint, we fix up the existing 
+        # sets after the notifier starts
+        if not args.reconcile and checkpoint is None:
+            try:
+                clear_namespace(redis, 
+                                rule.redis_prefix, 
+                                args.cleanup_batch_size, 
+                                args.cleanup_pause,
+                                rule.key_template)
+            except Exception:
+                log.exception("clear_namespace")
+                return 1
 
-    _initial_directory_scan(args.watch_path, file_name_queue)
-
-    log.info("main loop starts")
-    directory_scan_up_to_date = False
-    up_to_date = False
-    return_code = 0
-    while not halt_event.is_set():
+        # set our up-to-date time as far back as we can: 
+        # we aren't up to date yet
+        log.debug("setting {0} to {1}".format(rule.up_to_date_timestamp_key, 
+                                              0))
+        redis.set(rule.up_to_date_timestamp_key, "0")
 
+    processor = EventProcessor(rules)
+    bounded_queue = None
+    if isinstance(file_name_queue, BoundedQueue):
+        bounded_queue = file_name_queue
+        if args.queue_overload == drop_policy:
+            processor.dropped_events = bounded_queue
+    overflow_recovery = OverflowRecovery(args, redis, rules)
+    write_buffer = None
+    if args.redis_buffer_size > 0:
+        write_buffer = WriteAheadBuffer(args.redis_buffer_size,
+                                        args.redis_retry_max_delay,
+                                        args.scan_chunk_size)
+    key_index = None
+    if args.index:
+        key_index = KeyIndex(rules)
+        overflow_recovery.key_index = key_index
+    overflow_recovery.checkpoint = checkpoint
+    overflow_recovery.write_buffer = write_buffer
+    set_mirror = None
+    if args.mirror:
+        # a bulk load or reconcile leaves sets the mirror doesn't know
+        set_mirror = SetMirror(not (args.reconcile or args.bulk_scan))
+        overflow_recovery.set_mirror = set_mirror
+    batch_script = None
+    if args.atomic_batches:
+        batch_script = BatchScript(redis, rules, args.index)
+    query_backend = None
+    query_server = None
+    if args.query_socket is not None:
+        query_backend = MemorySetBackend()
+        overflow_recovery.query_backend = query_backend
         try:
-            file_name, event_name = file_name_queue.get(block=True, timeout=1.0)
-        except queue.Empty:
-            continue
-        except KeyboardInterrupt:
-            log.warn("KeyboardInterrupt: halting")
-            halt_event.set()
-            break
+            query_server = SetQueryServer(query_backend, args.query_socket)
+        except Exception:
+            log.exception("Unable to start query server")
+            return 1
+        query_server.start()
+    claim_listener = None
+    if args.claim_channel is not None:
+        claim_listener = ClaimListener(redis,
+                                       args.claim_channel,
+                                       file_name_queue)
+    completion_notifier = None
+    if args.complete_channel is not None or args.complete_stream is not None:
+        completion_notifier = CompletionNotifier(args, redis, rules)
 
-        if event_name == directory_scan_finished:
-            log.debug("setting directory_scan_up_to_date")
-            directory_scan_up_to_date = True
-            continue
-
-        if event_name == inotify_idle:
-            if not up_to_date and directory_scan_up_to_date:
-                current_time = int(time.time())
-                log.debug("setting {0} to {1}".format(up_to_date_timestamp_key, 
-                                                      current_time))
-                redis.set(up_to_date_timestamp_key, str(current_time))
-                up_to_date = True
-            continue
-
-        match_object = key_regex.match(file_name)
-        if match_object is None:
-            log.debug("unmatched file name '{0}'".format(file_name))
-            continue
-        key = match_object.group("key")
-
-        log.debug("found file_name '{0}' key {1} event {2}".format(file_name, 
-                                                                   key,
-                                                                   event_name))
-        redis_key = "_".join([args.redis_prefix, key, ])
+    metrics = None
+    metrics_server = None
+    if args.metrics_address is not None or args.metrics_socket is not None:
+        metrics = Metrics(processor, rules, file_name_queue)
+        metrics.coalescer = coalescer
+        metrics.overflow_recovery = overflow_recovery
+        metrics.write_buffer = write_buffer
+        metrics.completion_notifier = completion_notifier
+        metrics.set_mirror = set_mirror
+        metrics.bounded_queue = bounded_queue
         try:
-            _dispatch_table[event_name](redis, redis_key, file_name)
+            metrics_server = MetricsServer(metrics, 
+                                           address=args.metrics_address, 
+                                           socket_path=args.metrics_socket)
         except Exception:
-            log.exception("{0} {1}".format(file_name, event_name))
-            return_code = 1
-            halt_event.set()
+            log.exception("Unable to start metrics server")
+            return 1
+        metrics_server.start()
+
+    if engine is not None:
+        engine.metrics = metrics
+        engine.write_buffer = write_buffer
+        engine.completion_notifier = completion_notifier
+        engine.key_index = key_index
+        engine.set_mirror = set_mirror
+        return_code = engine.run(
+            notifier,
+            processor,
+            [functools.partial(_startup_scan, 
+                               args, 
+                               redis, 
+                               rule, 
+                               file_name_queue,
+                               key_index) for rule in rules], 
+            overflow_recovery,
+            rules)
+    else:
+        notifier_thread = create_notifier_thread(halt_event, 
+                                                 notifier, 
+                                                 file_name_queue)
+
+        # we want the notifier running while we do the initial directory 
+        # scan, so we don't miss any files. 
+        notifier_thread.start()
+        if claim_listener is not None:
+            claim_listener.start()
+
+        return_code = 0
+        for rule in rules:
+            if not _startup_scan(args, 
+                                 redis, 
+                                 rule, 
+                                 file_name_queue, 
+                                 key_index,
+                                 checkpoint,
+                                 query_backend):
+                return_code = 1
+                halt_event.set()
+                break
+
+        if set_mirror is not None and checkpoint is not None:
+            set_mirror.reset(True, checkpoint.contents())
+
+        if return_code == 0:
+            return_code = _main_loop(args, 
+                                     redis, 
+                                     rules, 
+                                     processor, 
+                                     coalescer, 
+                                     set_mirror,
+                                     query_backend,
+                                     overflow_recovery,
+                                     metrics,
+                                     write_buffer,
+                                     completion_notifier,
+                                     key_index,
+                                     batch_script,
+                                     checkpoint,
+                                     shard_pool,
+                                     file_name_queue, 
+                                     halt_event)
+        if bounded_queue is not None:
+            # the notifier may be waiting for room
+            bounded_queue.release()
+        notifier_thread.join(timeout=5.0)
+#       assert not notifier_thread.is_alive
 
     log.info("main loop ends")
-    redis.set(up_to_date_timestamp_key, "0")
-    notifier_thread.join(timeout=5.0)
-#    assert not notifier_thread.is_alive
+    if claim_listener is not None:
+        claim_listener.stop()
+        log.info("{0} claims announced".format(claim_listener.claim_count))
+    if shard_pool is not None:
+        shard_pool.stop()
+    if checkpoint is not None and return_code == 0 and \
+       (write_buffer is None or not write_buffer.pending()) and \
+       (shard_pool is None or shard_pool.caught_up()):
+        try:
+            checkpoint.write(redis, file_name_queue.qsize() == 0)
+        except Exception:
+            log.exception("writing checkpoint")
+    if metrics_server is not None:
+        metrics_server.stop()
+    if query_server is not None:
+        query_server.stop()
+    if overflow_recovery.recovery_count > 0:
+        log.info("recovered from {0} inotify queue overflows".format(
+                 overflow_recovery.recovery_count))
+    if coalescer is not None:
+        coalescer.log_statistics()
+    if set_mirror is not None:
+        set_mirror.log_statistics(force=True)
+    if bounded_queue is not None:
+        bounded_queue.log_statistics()
+    log_suppressed_counts()
+    if completion_notifier is not None:
+        log.info("announced {0} complete keys".format(
+                 completion_notifier.notification_count))
+    if write_buffer is not None:
+        write_buffer.log_statistics()
+        if write_buffer.pending():
+            log.error("{0} buffered entries never reached redis".format(
+                      write_buffer.qsize()))
+    for rule in rules:
+        if hasattr(rule.key_extractor, "hit_count"):
+            log.info("{0} key memo hits {1} misses {2}".format(
+                     rule.name, 
+                     rule.key_extractor.hit_count, 
+                     rule.key_extractor.miss_count))
+    try:
+        for rule in rules:
+            redis.set(rule.up_to_date_timestamp_key, "0")
+    except Exception:
+        log.exception("clearing up to date timestamps")
     notifier.stop()
 
     log.info("program terminates return_code = {0}".format(return_code))
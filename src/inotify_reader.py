@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+"""
+inotify_reader.py
+
+read inotify events straight from the file descriptor, without pyinotify.
+
+pyinotify builds an Event object for each event, works out its mask name
+and calls the ProcessEvent method for it. DirectNotifier reads the
+descriptor into one buffer, parses the struct inotify_event records from a
+memoryview of it and maps each mask to its name in event_names with a
+dict lookup: the only object made per event is the queue entry.
+
+    struct inotify_event {
+        int      wd;
+        uint32_t mask;
+        uint32_t cookie;
+        uint32_t len;       /* of name, including NUL padding */
+        char     name[];
+    };
+
+DirectNotifier has the methods of pyinotify.Notifier that the notifier
+thread and the asyncio engine use (check_events, read_events,
+process_events, stop and the _fd attribute), and puts the same
+(file_name, event_name, watch_descriptor) entries on the queue.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+
+from event_names import inotify_close_write, \
+                        inotify_moved_to, \
+                        inotify_delete, \
+                        inotify_moved_from, \
+                        inotify_overflow, \
+                        found_in_new_directory
+from directory_scan import iterate_file_names
+
+class InotifyError(Exception):
+    pass
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0o2000000)
+
+_file_changes_mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM
+_new_directory_mask = IN_CREATE | IN_MOVED_TO
+
+_event_names = {IN_CLOSE_WRITE  : inotify_close_write,
+                IN_MOVED_TO     : inotify_moved_to,
+                IN_DELETE       : inotify_delete,
+                IN_MOVED_FROM   : inotify_moved_from, }
+
+_header = struct.Struct("iIII")
+# room for several hundred events with long names
+default_buffer_size = 256 * 1024
+
+_max_queued_events_path = "/proc/sys/fs/inotify/max_queued_events"
+
+_fsdecode = getattr(os, "fsdecode", None)
+_fsencode = getattr(os, "fsencode", None)
+_readv = getattr(os, "readv", None)
+
+def _decode_name(name_bytes):
+    # python 2 file names are byte strings
+    if _fsdecode is None:
+        return name_bytes
+    return _fsdecode(name_bytes)
+
+def _load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                       use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int, ]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int,
+                                       ctypes.c_char_p,
+                                       ctypes.c_uint32, ]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int, ]
+    return libc
+
+def _max_queued_events():
+    try:
+        with open(_max_queued_events_path) as max_queued_file:
+            return int(max_queued_file.read())
+    except (IOError, OSError, ValueError, ):
+        return None
+
+class DirectNotifier(object):
+    """
+    watch directories with a raw inotify file descriptor, and put
+    (file_name, event_name, watch_descriptor) entries on a queue
+    """
+    def __init__(self,
+                 file_name_queue,
+                 overflow_recovery=False,
+                 buffer_size=default_buffer_size):
+        self._log = logging.getLogger("DirectNotifier")
+        self._log.info("max_queued_events = {0}".format(
+                       _max_queued_events()))
+        self._libc = _load_libc()
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise InotifyError("inotify_init1 failed: {0}".format(
+                               os.strerror(ctypes.get_errno())))
+        self._file_name_queue = file_name_queue
+        # the engine's buffer takes a whole read at once
+        self._put_many = getattr(file_name_queue, "put_many", None)
+        self._overflow_recovery = overflow_recovery
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._byte_count = 0
+        self._poll = select.poll()
+        self._poll.register(self._fd, select.POLLIN)
+        # watch descriptor -> (root watch descriptor, relative directory),
+        # for the directories of recursive trees
+        self._routes = dict()
+        # watch descriptor -> path, for the directories of recursive trees
+        self._paths = dict()
+        # cookie -> (watch descriptor, name) of a directory moved in a
+        # recursive tree, until its IN_MOVED_TO says where to
+        self._moved_directories = dict()
+
+    def _add_watch(self, path, mask):
+        encoded_path = (path if _fsencode is None else _fsencode(path))
+        watch_descriptor = self._libc.inotify_add_watch(self._fd,
+                                                        encoded_path,
+                                                        mask | IN_ONLYDIR)
+        if watch_descriptor < 0:
+            raise InotifyError("add_watch failed: {0} {1}".format(
+                               path, os.strerror(ctypes.get_errno())))
+        return watch_descriptor
+
+    def add_watch(self, watch_path, recursive=False):
+        """
+        watch a directory, or with recursive the whole tree under it.
+        return the watch descriptor of watch_path
+        """
+        if not recursive:
+            return self._add_watch(watch_path, _file_changes_mask)
+
+        root_watch_descriptor = self._add_tree(watch_path, None, "")
+        self._log.info("{0} watches under {1}".format(
+                       sum(1 for route in self._routes.values()
+                           if route[0] == root_watch_descriptor),
+                       watch_path))
+        return root_watch_descriptor
+
+    def _add_tree(self, path, root_watch_descriptor, relative_directory):
+        """
+        watch path and every directory below it, in a recursive tree
+        """
+        pending_directories = [(path, relative_directory, ), ]
+        top_watch_descriptor = None
+        while len(pending_directories) > 0:
+            path, relative_directory = pending_directories.pop()
+            try:
+                watch_descriptor = self._add_watch(
+                    path, _file_changes_mask | _new_directory_mask)
+            except InotifyError:
+                # a directory removed while we walk the tree
+                if top_watch_descriptor is None or os.path.isdir(path):
+                    raise
+                continue
+            if top_watch_descriptor is None:
+                top_watch_descriptor = watch_descriptor
+                if root_watch_descriptor is None:
+                    root_watch_descriptor = watch_descriptor
+            self._routes[watch_descriptor] = (root_watch_descriptor,
+                                              relative_directory, )
+            self._paths[watch_descriptor] = path
+            try:
+                names = os.listdir(path)
+            except OSError:
+                continue
+            for name in names:
+                child_path = os.path.join(path, name)
+                if os.path.isdir(child_path) and \
+                   not os.path.islink(child_path):
+                    pending_directories.append(
+                        (child_path, os.path.join(relative_directory, name), ))
+        return top_watch_descriptor
+
+    def check_events(self, timeout=None):
+        """
+        wait up to timeout milliseconds for events.
+        return True if there are some to read
+        """
+        try:
+            return len(self._poll.poll(timeout)) > 0
+        except (IOError, OSError, select.error, ):
+            instance = sys.exc_info()[1]
+            if instance.args[0] == errno.EINTR:
+                return False
+            raise
+
+    def read_events(self):
+        """
+        read as many whole events as the buffer holds
+        """
+        try:
+            if _readv is not None:
+                self._byte_count = _readv(self._fd, [self._buffer, ])
+            else:
+                data = os.read(self._fd, len(self._buffer))
+                self._buffer[:len(data)] = data
+                self._byte_count = len(data)
+        except OSError:
+            instance = sys.exc_info()[1]
+            if instance.errno not in (errno.EAGAIN, errno.EINTR, ):
+                raise
+            self._byte_count = 0
+
+    def process_events(self):
+        """
+        parse the events read_events read, and queue them
+        """
+        buffer = self._buffer
+        view = self._view
+        byte_count = self._byte_count
+        self._byte_count = 0
+        unpack_from = _header.unpack_from
+        header_size = _header.size
+        event_names = _event_names
+        routes = self._routes
+        entries = list()
+
+        offset = 0
+        while offset < byte_count:
+            watch_descriptor, mask, cookie, name_length = \
+                unpack_from(view, offset)
+            name_offset = offset + header_size
+            offset = name_offset + name_length
+
+            event_name = event_names.get(mask & _file_changes_mask)
+            if event_name is not None and not mask & IN_ISDIR:
+                name_end = buffer.find(b"\0", name_offset, offset)
+                if name_end < 0:
+                    name_end = offset
+                file_name = _decode_name(
+                    view[name_offset:name_end].tobytes())
+                route = routes.get(watch_descriptor)
+                if route is None:
+                    entries.append((file_name, event_name, watch_descriptor, ))
+                else:
+                    root_watch_descriptor, relative_directory = route
+                    if relative_directory != "":
+                        file_name = os.path.join(relative_directory,
+                                                 file_name)
+                    entries.append((file_name,
+                                    event_name,
+                                    root_watch_descriptor, ))
+                continue
+
+            if mask & IN_ISDIR:
+                if watch_descriptor in routes:
+                    name_end = buffer.find(b"\0", name_offset, offset)
+                    if name_end < 0:
+                        name_end = offset
+                    name = _decode_name(view[name_offset:name_end].tobytes())
+                    if mask & IN_MOVED_FROM:
+                        self._moved_directories[cookie] = (watch_descriptor,
+                                                           name, )
+                    elif mask & IN_MOVED_TO and \
+                         cookie in self._moved_directories:
+                        self._moved_directory(
+                            entries,
+                            self._moved_directories.pop(cookie),
+                            watch_descriptor,
+                            name)
+                    elif mask & _new_directory_mask:
+                        self._new_directory(entries, watch_descriptor, name)
+            elif mask & IN_IGNORED:
+                # the watch is gone (directory removed): its descriptor
+                # may be reused
+                routes.pop(watch_descriptor, None)
+                self._paths.pop(watch_descriptor, None)
+            elif mask & IN_Q_OVERFLOW:
+                self._overflow(entries)
+
+        if len(self._moved_directories) > 0:
+            self._moved_out(entries)
+        self._queue(entries)
+
+    def _new_directory(self, entries, watch_descriptor, name):
+        """
+        a new subdirectory in a recursive tree: watch it, then scan it,
+        since files may have been written before the watch was in place
+        """
+        root_watch_descriptor, relative_directory = \
+            self._routes[watch_descriptor]
+        path = os.path.join(self._paths[watch_descriptor], name)
+        relative_directory = os.path.join(relative_directory, name)
+        self._log.info("new directory {0}".format(path))
+        try:
+            self._add_tree(path, root_watch_descriptor, relative_directory)
+            for file_name in iterate_file_names(path, recursive=True):
+                entries.append((os.path.join(relative_directory, file_name),
+                                found_in_new_directory,
+                                root_watch_descriptor, ))
+        except (InotifyError, OSError, ):
+            # gone again before we got to it
+            instance = sys.exc_info()[1]
+            self._log.warn("new directory {0}: {1}".format(path, instance))
+
+    def _moved_directory(self, entries, moved_from, watch_descriptor, name):
+        """
+        a directory moved within the recursive trees: route the watches of
+        the subtree to its new place, then scan it, to take the old names
+        of its files out of the sets and put the new ones in
+        """
+        from_watch_descriptor, from_name = moved_from
+        if not from_watch_descriptor in self._routes:
+            # its parent has moved out since
+            self._new_directory(entries, watch_descriptor, name)
+            return
+        from_root_watch_descriptor, from_directory = \
+            self._routes[from_watch_descriptor]
+        old_path = os.path.join(self._paths[from_watch_descriptor], from_name)
+        old_directory = os.path.join(from_directory, from_name)
+        root_watch_descriptor, relative_directory = \
+            self._routes[watch_descriptor]
+        path = os.path.join(self._paths[watch_descriptor], name)
+        relative_directory = os.path.join(relative_directory, name)
+        self._log.info("directory {0} moved to {1}".format(old_path, path))
+        self._forget_tree(old_path)
+        try:
+            # the directories keep their watch descriptors
+            self._add_tree(path, root_watch_descriptor, relative_directory)
+            for file_name in iterate_file_names(path, recursive=True):
+                entries.append((os.path.join(old_directory, file_name),
+                                inotify_moved_from,
+                                from_root_watch_descriptor, ))
+                entries.append((os.path.join(relative_directory, file_name),
+                                found_in_new_directory,
+                                root_watch_descriptor, ))
+        except (InotifyError, OSError, ):
+            # gone again before we got to it
+            instance = sys.exc_info()[1]
+            self._log.warn("moved directory {0}: {1}".format(path, instance))
+            self._resync(entries, "moved directory {0} not scanned".format(
+                         path))
+
+    def _moved_out(self, entries):
+        """
+        a directory whose IN_MOVED_FROM has no IN_MOVED_TO in the same read
+        has left the recursive trees: we stop watching it, and since its
+        file names can't be listed any more, the sets need a resync
+        """
+        for watch_descriptor, name in self._moved_directories.values():
+            if not watch_descriptor in self._paths:
+                continue
+            path = os.path.join(self._paths[watch_descriptor], name)
+            self._log.warn("directory {0} moved out of the watched "
+                           "trees".format(path))
+            for moved_watch_descriptor in self._forget_tree(path):
+                self._libc.inotify_rm_watch(self._fd, moved_watch_descriptor)
+        self._moved_directories.clear()
+        self._resync(entries, "directory moved out of a recursive tree")
+
+    def _forget_tree(self, path):
+        """
+        drop the routes of path and the directories below it.
+        return their watch descriptors
+        """
+        prefix = path + os.sep
+        watch_descriptors = [watch_descriptor
+                             for watch_descriptor, watch_path
+                             in self._paths.items()
+                             if watch_path == path or
+                                watch_path.startswith(prefix)]
+        for watch_descriptor in watch_descriptors:
+            del self._routes[watch_descriptor]
+            del self._paths[watch_descriptor]
+        return watch_descriptors
+
+    def _overflow(self, entries):
+        self._resync(entries, "Overflow: max_queued_events={0}".format(
+                     _max_queued_events()))
+
+    def _resync(self, entries, error_message):
+        self._log.error(error_message)
+        if not self._overflow_recovery:
+            self._queue(entries)
+            raise InotifyError(error_message)
+        # the sets are out of step: the main loop will resync them
+        entries.append((None, inotify_overflow, None, ))
+
+    def _queue(self, entries):
+        if self._put_many is not None:
+            self._put_many(entries)
+            return
+        put = self._file_name_queue.put
+        for entry in entries:
+            put(entry)
+
+    def stop(self):
+        self._poll.unregister(self._fd)
+        os.close(self._fd)
@@ -2,21 +2,26 @@
 """
 inotify_setup.py 
 
-setup inotify to watch directory
+setup inotify to watch directories
 """
 import logging 
+import os
+import sys
 from threading import Thread
 
 import pyinotify
 
-class InotifyError(Exception):
-    pass
-
-from event_names import inotify_idle
+from inotify_reader import DirectNotifier, InotifyError
+from event_names import inotify_idle, \
+                        inotify_overflow, \
+                        inotify_moved_from, \
+                        found_in_new_directory
+from directory_scan import iterate_file_names
 
 _incoming_files_mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
 _outgoing_files_mask = pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM 
 _file_changes_mask = _incoming_files_mask | _outgoing_files_mask   
+_new_directory_mask = pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO
                 
 class _ProcessEvent(pyinotify.ProcessEvent):
     
@@ -25,18 +30,194 @@ class _ProcessEvent(pyinotify.ProcessEvent):
         self._log.info("max_queued_events = {0}".format(
             pyinotify.max_queued_events))
         self._file_name_queue = kwargs["file_name_queue"]
+        # watch_path -> watch descriptor of the top of each recursive tree
+        self._recursive_roots = kwargs.get("recursive_roots", dict())
+        self._recursive_watch_descriptors = \
+            frozenset(self._recursive_roots.values())
+        self._watch_manager = kwargs.get("watch_manager")
+        self._overflow_recovery = kwargs.get("overflow_recovery", False)
+        # watch descriptor -> (root watch descriptor, relative directory)
+        self._routes = dict()
+        # cookie -> (IN_MOVED_FROM event, route) of a directory moved in a
+        # recursive tree, until its IN_MOVED_TO says where to
+        self._moved_directories = dict()
+
+    def _route(self, inotify_event):
+        """
+        map the watch descriptor of a subdirectory in a recursive tree to the
+        watch descriptor of the top of the tree, and the relative path
+        """
+        try:
+            return self._routes[inotify_event.wd]
+        except KeyError:
+            pass
+
+        route = (inotify_event.wd, "", )
+        for root_path, root_watch_descriptor in self._recursive_roots.items():
+            relative_directory = os.path.relpath(inotify_event.path, 
+                                                 root_path)
+            if relative_directory == os.curdir:
+                route = (root_watch_descriptor, "", )
+                break
+            if relative_directory != os.pardir and \
+               not relative_directory.startswith(os.pardir + os.sep):
+                route = (root_watch_descriptor, relative_directory, )
+                break
+
+        self._routes[inotify_event.wd] = route
+        return route
+
+    def _process_new_directory(self, inotify_event):
+        """
+        a new subdirectory in a recursive tree: pyinotify adds a watch 
+        for it, but files may have been written before the watch was in 
+        place, so we scan it
+        """
+        root_watch_descriptor, relative_directory = self._route(inotify_event)
+        relative_directory = os.path.join(relative_directory, 
+                                          inotify_event.name)
+        self._log.info("new directory {0}".format(inotify_event.pathname))
+        for file_name in iterate_file_names(inotify_event.pathname, 
+                                            recursive=True):
+            self._file_name_queue.put(
+                (os.path.join(relative_directory, file_name), 
+                 found_in_new_directory, 
+                 root_watch_descriptor, ))
+
+    def _tree_watches(self, path):
+        """
+        the watches of path and the directories below it, by descriptor
+        """
+        prefix = path + os.sep
+        return dict((watch_descriptor, watch, )
+                    for watch_descriptor, watch
+                    in self._watch_manager.watches.items()
+                    if watch.path == path or watch.path.startswith(prefix))
+
+    def _process_moved_directory(self, moved_from, inotify_event):
+        """
+        a directory moved within the recursive trees: without IN_MOVE_SELF
+        in the mask pyinotify doesn't follow the move, so we give the
+        watches of the subtree their new paths. Then we scan it, to take
+        the old names of its files out of the sets and put the new ones in
+        """
+        moved_from_event, (from_root_watch_descriptor, from_directory) = \
+            moved_from
+        old_path = moved_from_event.pathname
+        new_path = inotify_event.pathname
+        for watch in self._tree_watches(old_path).values():
+            watch.path = new_path + watch.path[len(old_path):]
+        self._routes.clear()
+
+        root_watch_descriptor, relative_directory = self._route(inotify_event)
+        old_directory = os.path.join(from_directory, moved_from_event.name)
+        new_directory = os.path.join(relative_directory, inotify_event.name)
+        self._log.info("directory {0} moved to {1}".format(old_path,
+                                                           new_path))
+        try:
+            for file_name in iterate_file_names(new_path, recursive=True):
+                self._file_name_queue.put(
+                    (os.path.join(old_directory, file_name),
+                     inotify_moved_from,
+                     from_root_watch_descriptor, ))
+                self._file_name_queue.put(
+                    (os.path.join(new_directory, file_name),
+                     found_in_new_directory,
+                     root_watch_descriptor, ))
+        except OSError:
+            # gone again before we got to it
+            instance = sys.exc_info()[1]
+            self._log.warn("moved directory {0}: {1}".format(new_path,
+                                                             instance))
+            self._resync("moved directory {0} not scanned".format(new_path))
+
+    def end_of_read(self):
+        """
+        a directory whose IN_MOVED_FROM has no IN_MOVED_TO in the same read
+        has left the recursive trees: we stop watching it, and since its
+        file names can't be listed any more, the sets need a resync
+        """
+        if len(self._moved_directories) == 0:
+            return
+        for moved_from_event, _ in self._moved_directories.values():
+            self._log.warn("directory {0} moved out of the watched "
+                           "trees".format(moved_from_event.pathname))
+            # rm_watch(rec=True) only finds the subdirectories of a path
+            # that is still there
+            watch_descriptors = list(
+                self._tree_watches(moved_from_event.pathname).keys())
+            if len(watch_descriptors) > 0:
+                self._watch_manager.rm_watch(watch_descriptors)
+        self._moved_directories.clear()
+        self._routes.clear()
+        self._resync("directory moved out of a recursive tree")
 
     def process_default(self, inotify_event):
-        self._file_name_queue.put((inotify_event.name, 
-                                   inotify_event.maskname, ))
+        if inotify_event.dir:
+            if len(self._recursive_roots) == 0:
+                return
+            route = self._route(inotify_event)
+            if not route[0] in self._recursive_watch_descriptors:
+                self._log.debug("ignoring directory event {0}".format(
+                                inotify_event))
+            elif inotify_event.mask & pyinotify.IN_MOVED_FROM:
+                self._moved_directories[inotify_event.cookie] = \
+                    (inotify_event, route, )
+            elif inotify_event.mask & pyinotify.IN_MOVED_TO and \
+                 inotify_event.cookie in self._moved_directories:
+                self._process_moved_directory(
+                    self._moved_directories.pop(inotify_event.cookie),
+                    inotify_event)
+            elif inotify_event.mask & _new_directory_mask:
+                self._process_new_directory(inotify_event)
+            return
+
+        if not inotify_event.mask & _file_changes_mask:
+            return
+
+        if len(self._recursive_roots) == 0:
+            self._file_name_queue.put((inotify_event.name, 
+                                       inotify_event.maskname, 
+                                       inotify_event.wd, ))
+            return
+
+        root_watch_descriptor, relative_directory = self._route(inotify_event)
+        self._file_name_queue.put((os.path.join(relative_directory,
+                                                inotify_event.name), 
+                                   inotify_event.maskname, 
+                                   root_watch_descriptor, ))
+
+    def process_IN_IGNORED(self, inotify_event):
+        # the watch is gone (directory removed): its descriptor may be reused
+        self._routes.pop(inotify_event.wd, None)
 
     def process_IN_Q_OVERFLOW(self, event):
-        error_message = "Overflow: max_queued_events={0} {1}".format(
-            pyinotify.max_queued_events, event,
-        )
+        self._resync("Overflow: max_queued_events={0} {1}".format(
+                     pyinotify.max_queued_events, event))
+
+    def _resync(self, error_message):
         self._log.error(error_message)
+        if self._overflow_recovery:
+            # the sets are out of step: the main loop will resync them
+            self._file_name_queue.put((None, inotify_overflow, None, ))
+            return
         raise InotifyError(error_message)
 
+class _Notifier(pyinotify.Notifier):
+    """
+    a pyinotify.Notifier that tells the _ProcessEvent when it has been
+    through a read, so it can pair the halves of a directory move
+    """
+    def __init__(self, watch_manager, process_event):
+        pyinotify.Notifier.__init__(self,
+                                    watch_manager,
+                                    default_proc_fun=process_event)
+        self._process_event = process_event
+
+    def process_events(self):
+        pyinotify.Notifier.process_events(self)
+        self._process_event.end_of_read()
+
 class _NotifierThread(Thread):
     def __init__(self, halt_event, notifier, file_name_queue):
         Thread.__init__(self, name="notifier")
@@ -56,34 +237,92 @@ class _NotifierThread(Thread):
                     self._halt_event.set()
                     break
             else:
-                self._file_name_queue.put((None, inotify_idle, ))
+                self._file_name_queue.put((None, inotify_idle, None, ))
 
-def create_notifier(watch_path, file_name_queue):
+def _create_direct_notifier(watch_paths, 
+                            file_name_queue, 
+                            recursive_paths, 
+                            overflow_recovery):
+    log = logging.getLogger("create_notifier")
+    notifier = DirectNotifier(file_name_queue, 
+                              overflow_recovery=overflow_recovery)
+    watch_descriptors = dict()
+    try:
+        for watch_path in watch_paths:
+            recursive = watch_path in recursive_paths
+            log.info("watching path {0} recursive = {1} (direct)".format(
+                     watch_path, recursive))
+            watch_descriptors[watch_path] = notifier.add_watch(watch_path,
+                                                               recursive)
+    except InotifyError:
+        notifier.stop()
+        raise
+    return notifier, watch_descriptors
+
+def create_notifier(watch_paths, 
+                    file_name_queue, 
+                    recursive_paths=(), 
+                    overflow_recovery=False,
+                    direct=False):
     """
-    create the inotifier infrastructure for watching a directory
+    create the inotifier infrastructure for watching one or more directories
+    with a single watch manager. The directories in recursive_paths are 
+    watched with all their subdirectories, including new ones.
+    With overflow_recovery, a queue overflow puts an inotify_overflow
+    event on the queue instead of raising InotifyError.
+    With direct, events are read by a DirectNotifier instead of pyinotify.
+
+    returns (notifier, watch_descriptors), where watch_descriptors is a dict
+    of watch_path -> watch descriptor, for routing events
     """
+    if direct:
+        return _create_direct_notifier(watch_paths, 
+                                       file_name_queue, 
+                                       recursive_paths, 
+                                       overflow_recovery)
+
     log = logging.getLogger("create_notifier")
     watch_manager = pyinotify.WatchManager()
 
-    log.info("watching path {0}".format(watch_path))
-    result = watch_manager.add_watch(watch_path, 
-                                     mask=_file_changes_mask,
-                                     rec=False, 
-                                     auto_add=False, 
-                                     quiet=False)
-    if not watch_path in result:
-        raise InotifyError("add_watch failed: invalid directory '{0}'".format(
-            watch_path))
-
-    if result[watch_path] < 0:
-        raise InotifyError("add_watch failed: {0} {1}".format(
-                           watch_path, 
-                           result[watch_path]))
-
-    proc_fun = _ProcessEvent(file_name_queue=file_name_queue)
-    notifier = pyinotify.Notifier(watch_manager, default_proc_fun=proc_fun)
-
-    return notifier
+    watch_descriptors = dict()
+    recursive_roots = dict()
+    for watch_path in watch_paths:
+        recursive = watch_path in recursive_paths
+        log.info("watching path {0} recursive = {1}".format(watch_path,
+                                                            recursive))
+        result = watch_manager.add_watch(watch_path, 
+                                         mask=_file_changes_mask,
+                                         rec=recursive, 
+                                         auto_add=recursive, 
+                                         quiet=False)
+        if not watch_path in result:
+            raise InotifyError(
+                "add_watch failed: invalid directory '{0}'".format(watch_path))
+
+        for path, watch_descriptor in result.items():
+            if watch_descriptor < 0:
+                raise InotifyError("add_watch failed: {0} {1}".format(
+                                   path, 
+                                   watch_descriptor))
+
+        watch_descriptors[watch_path] = result[watch_path]
+        if recursive:
+            log.info("{0} watches under {1}".format(len(result), watch_path))
+            recursive_roots[watch_path] = result[watch_path]
+
+    proc_fun = _ProcessEvent(file_name_queue=file_name_queue,
+                             recursive_roots=recursive_roots,
+                             watch_manager=watch_manager,
+                             overflow_recovery=overflow_recovery)
+    notifier = _Notifier(watch_manager, proc_fun)
+
+    return notifier, watch_descriptors
+
+def notifier_file_descriptor(notifier):
+    """
+    the inotify file descriptor, for engines that poll it themselves
+    """
+    return notifier._fd
 
 def create_notifier_thread(halt_event, notifier, file_name_queue):
     """
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+key_extractor.py
+
+get the key from a file name. Running the (?P<key>...) regex for every event
+is the largest per-event cost after logging, so for naming schemes like
+<user>-<device>-<xact>_<seq> we can cut the key out with a delimiter or at
+a fixed position instead, and keep the regex as the fallback for names
+that don't fit.
+
+Every extractor has extract(file_name), which returns the key or None.
+"""
+from collections import OrderedDict
+
+class RegexKeyExtractor(object):
+    """
+    the key is the 'key' group of a regex match
+    """
+    def __init__(self, key_regex):
+        self._match = key_regex.match
+
+    def extract(self, file_name):
+        match_object = self._match(file_name)
+        if match_object is None:
+            return None
+        return match_object.group("key")
+
+class DelimiterKeyExtractor(object):
+    """
+    the key is everything before the first delimiter
+    """
+    def __init__(self, delimiter, fallback):
+        self._delimiter = delimiter
+        self._fallback = fallback
+
+    def extract(self, file_name):
+        key, delimiter, _ = file_name.partition(self._delimiter)
+        if delimiter == "" or key == "":
+            return self._fallback.extract(file_name)
+        return key
+
+class FixedPositionKeyExtractor(object):
+    """
+    the key is file_name[start:end]
+    """
+    def __init__(self, start, end, fallback):
+        self._start = start
+        self._end = end
+        self._fallback = fallback
+
+    def extract(self, file_name):
+        if len(file_name) < self._end:
+            return self._fallback.extract(file_name)
+        return file_name[self._start:self._end]
+
+class MemoizedKeyExtractor(object):
+    """
+    remember the keys for the most recent name prefixes, where the prefix
+    is the part of the name before the last separator ('1001-1-5000' for
+    '1001-1-5000_00000001'). Consecutive files usually share a key, so
+    most lookups skip the wrapped extractor.
+
+    This assumes the key depends only on the prefix.
+    """
+    def __init__(self, extractor, separator, memo_size):
+        self._extractor = extractor
+        self._separator = separator
+        self._memo_size = memo_size
+        self._memo = OrderedDict()
+        self.hit_count = 0
+        self.miss_count = 0
+
+    def extract(self, file_name):
+        prefix, separator, _ = file_name.rpartition(self._separator)
+        if separator == "":
+            return self._extractor.extract(file_name)
+
+        try:
+            key = self._memo[prefix]
+        except KeyError:
+            pass
+        else:
+            self.hit_count += 1
+            return key
+
+        self.miss_count += 1
+        key = self._extractor.extract(file_name)
+        self._memo[prefix] = key
+        if len(self._memo) > self._memo_size:
+            self._memo.popitem(last=False)
+        return key
+
+def parse_key_position(position):
+    """
+    parse 'START:END' into a pair of ints
+    """
+    start_str, _, end_str = position.partition(":")
+    start, end = int(start_str), int(end_str)
+    if start < 0 or end <= start:
+        raise ValueError("invalid key position '{0}'".format(position))
+    return start, end
+
+def create_key_extractor(key_regex,
+                         delimiter=None,
+                         position=None,
+                         memo_size=0,
+                         memo_separator="_"):
+    """
+    build the extractor for one rule: delimiter or fixed position
+    (start, end) if given, falling back to key_regex, optionally memoized
+    """
+    extractor = RegexKeyExtractor(key_regex)
+    if delimiter is not None:
+        extractor = DelimiterKeyExtractor(delimiter, extractor)
+    elif position is not None:
+        extractor = FixedPositionKeyExtractor(position[0],
+                                              position[1],
+                                              extractor)
+    if memo_size > 0:
+        extractor = MemoizedKeyExtractor(extractor, memo_separator, memo_size)
+    return extractor
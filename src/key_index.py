@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+key_index.py
+
+keep an index of the active keys of each rule, so consumers can find work
+without KEYS or SCAN over the namespace:
+
+    <prefix>_index   sorted set of redis keys, scored by last update time
+    <prefix>_counts  hash of redis key -> number of members
+
+so the oldest ready keys are one ZRANGE away, and their sizes one HMGET.
+A key leaves the index when its set becomes empty.
+
+Each dispatch asks for the SCARD of the keys it touched in the same
+pipeline, then updates the index with a second one. If that second
+pipeline fails the dispatch is reported as failed, so the write-ahead
+buffer (or the next restart) sends it again.
+"""
+from collections import OrderedDict
+import logging
+import time
+
+from namespace_cleanup import iterate_namespace_keys
+
+def _to_text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+def first_error(results):
+    """
+    the first exception in a list of pipeline results, or None
+    """
+    for result in results:
+        if isinstance(result, Exception):
+            return result
+    return None
+
+class KeyIndex(object):
+    """
+    queue the index updates for dispatched keys
+    """
+    def __init__(self, rules):
+        self._rules = rules
+
+    def _index_keys(self, redis_key):
+        for rule in self._rules:
+            if rule.owns_key(redis_key):
+                return rule.index_key, rule.count_key
+        raise KeyError(redis_key)
+
+    def queue_counts(self, pipeline, sent_commands):
+        """
+        queue a SCARD for each key in the sent_commands of
+        queue_batch_commands. returns the list of keys, for queue_updates
+        """
+        redis_keys = list(OrderedDict.fromkeys(
+            redis_key for redis_key, _, _, _ in sent_commands))
+        for redis_key in redis_keys:
+            pipeline.scard(redis_key)
+        return redis_keys
+
+    def queue_updates(self, pipeline, redis_keys, counts):
+        """
+        queue the index updates for redis_keys, given their member counts
+        """
+        score = time.time()
+        for redis_key, count in zip(redis_keys, counts):
+            index_key, count_key = self._index_keys(redis_key)
+            if count > 0:
+                pipeline.zadd(index_key, {redis_key : score})
+                pipeline.hset(count_key, redis_key, count)
+            else:
+                pipeline.zrem(index_key, redis_key)
+                pipeline.hdel(count_key, redis_key)
+
+def rebuild_index(redis, rule, scan_count):
+    """
+    replace the index of a rule with the sets that are in redis now, after
+    a bulk load or reconcile has bypassed the dispatcher. every key gets
+    the current time as its score
+    """
+    log = logging.getLogger("rebuild_index")
+    start_time = time.time()
+
+    reserved_keys = set(rule.reserved_keys)
+    redis_keys = [key for key in
+                  (_to_text(key) for key in
+                   iterate_namespace_keys(redis, 
+                                          rule.redis_prefix, 
+                                          scan_count,
+                                          rule.key_template))
+                  if not key in reserved_keys]
+
+    # one key at a time: in a cluster they may be in different slots
+    redis.delete(rule.index_key)
+    redis.delete(rule.count_key)
+    score = time.time()
+    indexed_count = 0
+    for i in range(0, len(redis_keys), scan_count):
+        key_chunk = redis_keys[i:i+scan_count]
+        pipeline = redis.pipeline(transaction=False)
+        for redis_key in key_chunk:
+            pipeline.scard(redis_key)
+        counts = pipeline.execute(raise_on_error=False)
+
+        pipeline = redis.pipeline(transaction=False)
+        for redis_key, count in zip(key_chunk, counts):
+            # not a set (WRONGTYPE), or empty
+            if isinstance(count, Exception) or count == 0:
+                continue
+            pipeline.zadd(rule.index_key, {redis_key : score})
+            pipeline.hset(rule.count_key, redis_key, count)
+            indexed_count += 1
+        pipeline.execute()
+
+    log.info("indexed {0} keys under {1} in {2:.3f} secs".format(
+             indexed_count, rule.redis_prefix, time.time() - start_time))
+    return indexed_count
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+key_naming.py
+
+build redis keys from a prefix and a key with a template. The default,
+'{prefix}_{key}', gives the prefix_key names we have always used.
+
+In Redis Cluster a hash tag (the part of the name between { and }) decides
+the slot, so a template can make related keys share one. In str.format
+syntax a literal brace is doubled:
+
+    {{{prefix}}}_{key}  ->  {op}_1001-1-5000   (every key of a rule in one
+                                                slot, with its index)
+    {prefix}_{{{key}}}  ->  op_{1001-1-5000}
+"""
+default_key_template = "{prefix}_{key}"
+
+# where consumers put the sets they claim (set_consumer.py): outside the
+# namespace of every rule, so no cleanup, reconcile or index rebuild
+# touches a set that is being drained
+claimed_key_prefix = "claimed:"
+
+def make_redis_key(key_template, redis_prefix, key):
+    if key_template == default_key_template:
+        return "_".join([redis_prefix, key, ])
+    return key_template.format(prefix=redis_prefix, key=key)
+
+def namespace_pattern(key_template, redis_prefix):
+    """
+    the SCAN MATCH pattern for every key under redis_prefix
+    """
+    return make_redis_key(key_template, redis_prefix, "*")
+
+def split_key_template(key_template, redis_prefix):
+    """
+    return the (head, tail) text around the key in every redis key
+    under redis_prefix
+    """
+    head, _, tail = \
+        make_redis_key(key_template, redis_prefix, "\0").partition("\0")
+    return head, tail
+
+def check_key_template(key_template):
+    """
+    raise ValueError unless the template uses both {prefix} and {key}
+    """
+    try:
+        redis_key = key_template.format(prefix="\1", key="\0")
+    except (IndexError, KeyError, ValueError, ):
+        raise ValueError("invalid key template '{0}'".format(key_template))
+    if redis_key.count("\1") != 1 or redis_key.count("\0") != 1:
+        raise ValueError("key template '{0}' must use {{prefix}} and " \
+                         "{{key}} once each".format(key_template))
+
+def hash_tag(redis_key):
+    """
+    the part of redis_key that Redis Cluster hashes to find its slot
+    """
+    start = redis_key.find("{")
+    if start >= 0:
+        end = redis_key.find("}", start + 1)
+        if end > start + 1:
+            return redis_key[start+1:end]
+    return redis_key
+
+def template_shares_slot(key_template):
+    """
+    True if every redis key under a prefix hashes to the same cluster slot
+    """
+    return hash_tag(make_redis_key(key_template, "prefix", "a")) == \
+           hash_tag(make_redis_key(key_template, "prefix", "b"))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+log_limiter.py
+
+keep messages that can come once per event from flooding the log during
+a burst. A RateLimitedLog writes the first max_count messages in each
+interval, and counts the rest without formatting them. The count is
+logged with the next message that gets through, and by
+log_suppressed_counts, which the main loop calls when the notifier goes
+idle and at shutdown.
+"""
+import time
+
+# every RateLimitedLog, for log_suppressed_counts
+_limiters = list()
+
+class RateLimitedLog(object):
+    """
+    log through a logger at a fixed level, at most max_count times every
+    interval secs. Call it with a str.format template and its arguments
+    """
+    def __init__(self, log, level, description, max_count=10, interval=60.0):
+        self._log = log
+        self._level = level
+        self._description = description
+        self._max_count = max_count
+        self._interval = interval
+        self._interval_start = 0.0
+        self._interval_count = 0
+        self.message_count = 0
+        self.suppressed_count = 0
+        _limiters.append(self)
+
+    def __call__(self, template, *args):
+        self.message_count += 1
+        if not self._log.isEnabledFor(self._level):
+            return
+        if self._interval_count >= self._max_count:
+            current_time = time.time()
+            if current_time - self._interval_start < self._interval:
+                self.suppressed_count += 1
+                return
+            self.log_suppressed_count()
+        if self._interval_count == 0:
+            self._interval_start = time.time()
+        self._interval_count += 1
+        self._log.log(self._level, template.format(*args))
+
+    def log_suppressed_count(self):
+        """
+        log how many messages we have held back, and start a new interval
+        """
+        if self.suppressed_count > 0:
+            self._log.log(self._level,
+                          "{0} more {1} messages suppressed ({2} in " \
+                          "all)".format(self.suppressed_count,
+                                        self._description,
+                                        self.message_count))
+            self.suppressed_count = 0
+        self._interval_count = 0
+
+def log_suppressed_counts():
+    """
+    log the count of every RateLimitedLog that has held messages back
+    """
+    for limiter in _limiters:
+        if limiter.suppressed_count > 0:
+            limiter.log_suppressed_count()
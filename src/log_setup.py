@@ -3,14 +3,57 @@
 log_setup.py
 
 set up logging
+
+In background mode, the loggers only put records on a queue; a listener
+thread formats them and writes the file. If the queue is full, the record
+is dropped and counted, instead of holding up the event loop.
 """
+import atexit
 import logging
 import logging.handlers
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import sys
 
 _max_log_size = 16 * 1024 * 1024
 _max_log_backup_files = 1000
 _log_format_template = "%(asctime)s %(levelname)-8s %(name)-20s: %(message)s"
+_max_queued_records = 10000
+
+# python 3.2 and later
+_QueueHandler = getattr(logging.handlers, "QueueHandler", None)
+_QueueListener = getattr(logging.handlers, "QueueListener", None)
+
+if _QueueHandler is not None:
+    class _BackgroundHandler(_QueueHandler):
+        """
+        hand records to the listener thread without formatting them
+        """
+        def __init__(self, record_queue):
+            _QueueHandler.__init__(self, record_queue)
+            self.dropped_count = 0
+
+        def prepare(self, record):
+            # QueueHandler would format the message here, in the caller's 
+            # thread; the listener's handler formats it instead
+            return record
+
+        def enqueue(self, record):
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped_count += 1
+
+    class _BackgroundListener(_QueueListener):
+        """
+        a QueueListener whose stop() waits for room on a full queue
+        """
+        def enqueue_sentinel(self):
+            # QueueListener uses put_nowait, which raises queue.Full
+            # just when the queue is saturated
+            self.queue.put(self._sentinel)
 
 def initialize_stderr_logging():
     """
@@ -25,9 +68,26 @@ def initialize_stderr_logging():
 
     logging.root.setLevel(log_level)
 
-def initialize_file_logging(log_path, verbose):
+def _stop_listener(listener, background_handler):
+    # no new records behind the sentinel; the listener writes everything
+    # queued ahead of it before it stops
+    logging.root.removeHandler(background_handler)
+    listener.stop()
+    if background_handler.dropped_count > 0:
+        # the listener is gone: write straight to the file
+        for handler in listener.handlers:
+            handler.handle(logging.makeLogRecord(
+                {"name"     : "log_setup",
+                 "levelno"  : logging.WARN,
+                 "levelname": logging.getLevelName(logging.WARN),
+                 "msg"      : "dropped {0} log records: the log queue " \
+                              "was full".format(
+                              background_handler.dropped_count), }))
+
+def initialize_file_logging(log_path, verbose, background=False):
     """
-    initialize the permanent log
+    initialize the permanent log. With background, records are written by
+    a listener thread, which is stopped when the program exits
     """
     log_level = (logging.DEBUG if verbose else logging.INFO)
 
@@ -41,6 +101,19 @@ def initialize_file_logging(log_path, verbose):
     formatter = logging.Formatter(_log_format_template)
     handler.setFormatter(formatter)
 
+    if background and _QueueHandler is None:
+        logging.getLogger("initialize_file_logging").warn(
+            "background logging needs python 3.2: logging synchronously")
+        background = False
+
+    if background:
+        record_queue = queue.Queue(maxsize=_max_queued_records)
+        background_handler = _BackgroundHandler(record_queue)
+        listener = _BackgroundListener(record_queue, handler)
+        listener.start()
+        atexit.register(_stop_listener, listener, background_handler)
+        handler = background_handler
+
     logging.root.addHandler(handler)
     logging.root.setLevel(log_level)
 
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+metrics.py
+
+an optional local endpoint that reports what is going on inside the
+process in Prometheus text format, over HTTP on a TCP port or a unix socket:
+
+    curl http://localhost:9100/metrics
+    curl --unix-socket /path/to/metrics.socket http://localhost/metrics
+
+The hot loop only increments plain counters it keeps anyway; everything
+else is computed when the endpoint is read.
+"""
+import bisect
+import logging
+import os
+import sys
+from threading import Thread
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+_metric_prefix = "file_name_set_manager"
+_latency_buckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                    0.25, 0.5, 1.0, 2.5, 5.0, ]
+
+class Metrics(object):
+    """
+    collect the numbers for the endpoint
+    """
+    def __init__(self, processor, rules, file_name_queue):
+        self._processor = processor
+        self._rules = rules
+        self._file_name_queue = file_name_queue
+        self._start_time = time.time()
+        self._last_idle_time = None
+        # one count per bucket, the last one is +Inf
+        self._latency_counts = [0 for _ in range(len(_latency_buckets) + 1)]
+        self._latency_sum = 0.0
+        self.coalescer = None
+        self.overflow_recovery = None
+        self.write_buffer = None
+        self.completion_notifier = None
+        self.set_mirror = None
+        self.bounded_queue = None
+
+    def observe_redis_latency(self, seconds):
+        self._latency_counts[bisect.bisect_left(_latency_buckets,
+                                                seconds)] += 1
+        self._latency_sum += seconds
+
+    def mark_idle(self):
+        self._last_idle_time = time.time()
+
+    def render(self):
+        """
+        the metrics in Prometheus text exposition format
+        """
+        lines = list()
+
+        def _add(name, metric_type, help_text, samples):
+            full_name = "_".join([_metric_prefix, name])
+            lines.append("# HELP {0} {1}".format(full_name, help_text))
+            lines.append("# TYPE {0} {1}".format(full_name, metric_type))
+            for labels, value in samples:
+                lines.append("{0}{1} {2}".format(full_name, labels, value))
+
+        _add("events_total", "counter",
+             "events taken off the file name queue, by event name",
+             [('{{event="{0}"}}'.format(event_name), count)
+              for event_name, count
+              in sorted(list(self._processor.event_counts.items()))])
+        _add("unmatched_names_total", "counter",
+             "file names that did not match the key of their rule",
+             [('{{rule="{0}"}}'.format(rule.name), rule.unmatched_count)
+              for rule in self._rules])
+        _add("queue_depth", "gauge",
+             "entries waiting in the file name queue",
+             [("", self._file_name_queue.qsize()), ])
+
+        if self.bounded_queue is not None:
+            _add("queue_bytes", "gauge",
+                 "estimated memory of the entries in the file name queue",
+                 [("", self.bounded_queue.byte_count), ])
+            _add("queue_high_water_entries", "gauge",
+                 "most entries the file name queue has held",
+                 [("", self.bounded_queue.high_water_entries), ])
+            _add("queue_high_water_bytes", "gauge",
+                 "most estimated bytes the file name queue has held",
+                 [("", self.bounded_queue.high_water_bytes), ])
+            _add("queue_blocked_seconds_total", "counter",
+                 "time the notifier waited for room in the queue",
+                 [("", self.bounded_queue.blocked_seconds), ])
+            _add("queue_dropped_events_total", "counter",
+                 "events dropped because the queue was full",
+                 [("", self.bounded_queue.dropped_count), ])
+            _add("queue_rescanned_names_total", "counter",
+                 "names of dropped events looked at again",
+                 [("", self.bounded_queue.rescanned_count), ])
+
+        cumulative_count = 0
+        samples = list()
+        for bound, count in zip(_latency_buckets, self._latency_counts):
+            cumulative_count += count
+            samples.append(('_bucket{{le="{0}"}}'.format(bound),
+                            cumulative_count))
+        cumulative_count += self._latency_counts[-1]
+        samples.append(('_bucket{le="+Inf"}', cumulative_count))
+        samples.append(("_sum", self._latency_sum))
+        samples.append(("_count", cumulative_count))
+        _add("redis_dispatch_seconds", "histogram",
+             "time to send one dispatch (event or batch) to redis",
+             samples)
+
+        last_idle_time = self._last_idle_time
+        if last_idle_time is None:
+            last_idle_time = self._start_time
+        _add("seconds_since_idle", "gauge",
+             "time since the notifier last reported no pending events",
+             [("", time.time() - last_idle_time), ])
+
+        if self.coalescer is not None:
+            _add("coalesced_events_total", "counter",
+                 "events that went through the coalescer",
+                 [("", self.coalescer.event_count), ])
+            _add("eliminated_events_total", "counter",
+                 "events eliminated by the coalescer",
+                 [("", self.coalescer.eliminated_count), ])
+
+        if self.overflow_recovery is not None:
+            _add("overflow_recoveries_total", "counter",
+                 "recoveries from inotify queue overflow",
+                 [("", self.overflow_recovery.recovery_count), ])
+
+        if self.write_buffer is not None:
+            _add("redis_buffer_depth", "gauge",
+                 "events buffered while redis is unreachable",
+                 [("", self.write_buffer.qsize()), ])
+            _add("redis_outages_total", "counter",
+                 "times redis became unreachable",
+                 [("", self.write_buffer.outage_count), ])
+
+        if self.completion_notifier is not None:
+            _add("complete_keys_total", "counter",
+                 "keys announced as complete",
+                 [("", self.completion_notifier.notification_count), ])
+
+        if self.set_mirror is not None:
+            _add("mirror_skipped_events_total", "counter",
+                 "events the set mirror kept from redis",
+                 [("", self.set_mirror.hit_count), ])
+            _add("mirror_sent_events_total", "counter",
+                 "events the set mirror let through to redis",
+                 [("", self.set_mirror.miss_count), ])
+            _add("mirror_names", "gauge",
+                 "file names held by the set mirror",
+                 [("", self.set_mirror.name_count), ])
+            _add("mirror_memory_bytes", "gauge",
+                 "rough memory use of the set mirror",
+                 [("", self.set_mirror.memory_bytes()), ])
+
+        lines.append("")
+        return "\n".join(lines)
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket clients have no address
+        return str(self.client_address)
+
+    def log_message(self, *_):
+        pass
+
+class _TCPMetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class _UnixMetricsServer(socketserver.ThreadingMixIn,
+                         socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class MetricsServer(object):
+    """
+    serve Metrics.render from a daemon thread
+    """
+    def __init__(self, metrics, address=None, socket_path=None):
+        self._log = logging.getLogger("MetricsServer")
+        self._socket_path = socket_path
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            self._server = _UnixMetricsServer(socket_path,
+                                              _MetricsRequestHandler)
+            self._log.info("serving metrics on {0}".format(socket_path))
+        else:
+            self._server = _TCPMetricsServer(address, _MetricsRequestHandler)
+            self._log.info("serving metrics on {0}:{1}".format(*address))
+        self._server.metrics = metrics
+        self._thread = Thread(target=self._server.serve_forever,
+                              name="metrics")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._socket_path is not None:
+            try:
+                os.unlink(self._socket_path)
+            except OSError:
+                instance = sys.exc_info()[1]
+                self._log.warn("unable to remove {0}: {1}".format(
+                               self._socket_path, instance))
+
+def parse_metrics_address(address):
+    """
+    parse 'HOST:PORT' (or ':PORT' for localhost) into (host, port)
+    """
+    host, _, port_str = address.rpartition(":")
+    if host == "":
+        host = "localhost"
+    return host, int(port_str)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+namespace_cleanup.py
+
+find and remove the keys under our prefix without blocking redis:
+SCAN with a cursor instead of KEYS, and UNLINK in bounded batches
+instead of one DELETE of everything.
+
+In Redis Cluster every primary node is scanned, and keys are removed in
+groups that share a hash slot, since a multi-key command can't span slots.
+"""
+from collections import OrderedDict
+import logging
+import sys
+import time
+
+from redis.exceptions import ResponseError
+
+from key_naming import default_key_template, namespace_pattern
+from redis_connection import is_cluster, node_connections
+
+def iterate_namespace_keys(redis, 
+                           redis_prefix, 
+                           scan_count, 
+                           key_template=default_key_template):
+    """
+    yield every key under redis_prefix, scan_count keys per SCAN call
+    """
+    pattern = namespace_pattern(key_template, redis_prefix)
+    for node_redis in node_connections(redis):
+        for key in node_redis.scan_iter(match=pattern, count=scan_count):
+            yield key
+
+class _KeyRemover(object):
+    """
+    remove keys with UNLINK, falling back to DELETE on servers that
+    don't have it (before redis 4.0)
+    """
+    def __init__(self, redis):
+        self._log = logging.getLogger("_KeyRemover")
+        self._redis = redis
+        self._cluster = is_cluster(redis)
+        self._use_unlink = True
+
+    def _remove_by_slot(self, command, keys):
+        """
+        one command per hash slot, pipelined to the owning nodes
+        """
+        slots = OrderedDict()
+        for key in keys:
+            slots.setdefault(self._redis.keyslot(key), []).append(key)
+        pipeline = self._redis.pipeline(transaction=False)
+        for slot_keys in slots.values():
+            getattr(pipeline, command)(*slot_keys)
+        return sum(pipeline.execute())
+
+    def _remove(self, command, keys):
+        if self._cluster:
+            return self._remove_by_slot(command, keys)
+        return getattr(self._redis, command)(*keys)
+
+    def remove(self, keys):
+        if self._use_unlink:
+            try:
+                return self._remove("unlink", keys)
+            except ResponseError:
+                instance = sys.exc_info()[1]
+                self._log.warn("UNLINK failed ({0}), using DELETE".format(
+                               instance))
+                self._use_unlink = False
+        return self._remove("delete", keys)
+
+def clear_namespace(redis, 
+                    redis_prefix, 
+                    batch_size, 
+                    pause, 
+                    key_template=default_key_template):
+    """
+    remove every key under redis_prefix, batch_size keys at a time,
+    sleeping pause seconds between batches.
+    return the number of keys removed
+    """
+    log = logging.getLogger("clear_namespace")
+    start_time = time.time()
+    remover = _KeyRemover(redis)
+
+    removed_count = 0
+    batch = list()
+    for key in iterate_namespace_keys(redis, 
+                                      redis_prefix, 
+                                      batch_size, 
+                                      key_template):
+        batch.append(key)
+        if len(batch) >= batch_size:
+            removed_count += remover.remove(batch)
+            batch = list()
+            if pause > 0.0:
+                time.sleep(pause)
+
+    if len(batch) > 0:
+        removed_count += remover.remove(batch)
+
+    log.info("removed {0} keys under {1} in {2:.3f} secs".format(
+             removed_count, redis_prefix, time.time() - start_time))
+    return removed_count
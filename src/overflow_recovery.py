@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+overflow_recovery.py
+
+recover from an inotify queue overflow without restarting: mark every rule
+not up to date, then reconcile its sets with a fresh directory scan.
+
+The notifier keeps reading while we reconcile, and the events it queues
+are applied after the reconcile, so the sets converge on the directory
+contents. The up-to-date timestamps are set again the next time the
+notifier goes idle.
+
+Everything dispatched between the overflow and the reconcile describes a
+directory the reconcile scans afresh, so the engines don't send it, and
+what the write-ahead buffer holds is discarded once the reconcile is done.
+If redis is unreachable, the recovery stays pending and is tried again,
+with the same backoff as the buffer. With shards, it waits until every
+shard has sent what it was given before the overflow, so none of that is
+applied after the reconcile.
+"""
+import logging
+import sys
+import time
+
+from key_index import rebuild_index
+from reconcile import reconcile_directory, scan_directory_sets
+from write_ahead_buffer import is_connection_error
+
+_initial_retry_delay = 0.1
+
+class OverflowRecovery(object):
+    """
+    resync the redis sets after events have been lost
+    """
+    def __init__(self, args, redis, rules):
+        self._log = logging.getLogger("OverflowRecovery")
+        self._args = args
+        self._redis = redis
+        self._rules = rules
+        self._retry_delay = _initial_retry_delay
+        self._next_retry_time = 0.0
+        self.recovery_count = 0
+        # an overflow we have not recovered from yet
+        self.pending = False
+        self.write_buffer = None
+        self.key_index = None
+        self.checkpoint = None
+        self.set_mirror = None
+        self.query_backend = None
+
+    def overflowed(self):
+        """
+        events were lost: recover at the next chance
+        """
+        if not self.pending:
+            self.recovery_count += 1
+            self._log.warn("inotify queue overflow: recovery {0} " \
+                           "pending".format(self.recovery_count))
+        self.pending = True
+        self._retry_delay = _initial_retry_delay
+        self._next_retry_time = 0.0
+
+    def retry_due(self):
+        return self.pending and time.time() >= self._next_retry_time
+
+    def _retry_later(self, instance):
+        self._next_retry_time = time.time() + self._retry_delay
+        self._log.warn("recovery {0}: redis unreachable ({1}), retry in " \
+                       "{2:.1f} secs".format(self.recovery_count,
+                                             instance,
+                                             self._retry_delay))
+        self._retry_delay = min(self._retry_delay * 2,
+                                self._args.redis_retry_max_delay)
+
+    def recover(self):
+        """
+        resync the sets after overflowed().
+        return False if the recovery failed. If redis was unreachable it
+        stays pending
+        """
+        if not self.pending:
+            self.overflowed()
+        self._log.warn("starting recovery {0}".format(self.recovery_count))
+        start_time = time.time()
+
+        try:
+            if self.checkpoint is not None and \
+               not self.checkpoint.changing(self._redis):
+                self._retry_later("checkpoint tokens not deleted")
+                return True
+
+            for rule in self._rules:
+                self._log.debug("setting {0} to {1}".format(
+                                rule.up_to_date_timestamp_key, 0))
+                self._redis.set(rule.up_to_date_timestamp_key, "0")
+            if self.query_backend is not None:
+                self.query_backend.mark_up_to_date(self._rules, 0)
+
+            for rule in self._rules:
+                directory_sets = None
+                if self.checkpoint is not None:
+                    # the checkpoint follows the sets it reconciles
+                    self.checkpoint.rebuild(self._redis, rule)
+                    directory_sets = self.checkpoint.rule_contents(rule)
+                else:
+                    if self.query_backend is not None:
+                        directory_sets = scan_directory_sets(
+                            rule.watch_path,
+                            rule.key_extractor,
+                            rule.redis_prefix,
+                            rule.recursive,
+                            rule.key_template)
+                    reconcile_directory(
+                        self._redis,
+                        rule.watch_path,
+                        rule.key_extractor,
+                        rule.redis_prefix,
+                        self._args.scan_chunk_size,
+                        self._args.cleanup_batch_size,
+                        exclude_keys=rule.reserved_keys,
+                        recursive=rule.recursive,
+                        key_template=rule.key_template,
+                        directory_sets=(None if directory_sets is None
+                                        else dict(directory_sets)))
+                if self.query_backend is not None:
+                    self.query_backend.replace(rule, directory_sets)
+                if self.key_index is not None:
+                    rebuild_index(self._redis,
+                                  rule,
+                                  self._args.cleanup_batch_size)
+        except Exception:
+            instance = sys.exc_info()[1]
+            if is_connection_error(instance):
+                self._retry_later(instance)
+                return True
+            self._log.exception("recovery {0}".format(self.recovery_count))
+            return False
+
+        self.pending = False
+        # the reconcile supersedes everything buffered before it
+        if self.write_buffer is not None:
+            self.write_buffer.discard()
+
+        # the reconcile went around the mirror
+        if self.set_mirror is not None:
+            if self.checkpoint is not None:
+                self.set_mirror.reset(True, self.checkpoint.contents())
+            else:
+                self.set_mirror.reset(False)
+
+        self._log.warn("recovery {0} completed in {1:.3f} secs".format(
+                       self.recovery_count, time.time() - start_time))
+        return True
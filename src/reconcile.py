@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+reconcile.py
+
+bring the existing redis sets in line with the directory contents by
+sending only the differences, instead of deleting every key and
+rebuilding from scratch. Sets that are already correct are never touched,
+so consumers can keep reading them while we reconcile.
+"""
+import logging
+import os
+import time
+
+from directory_scan import iterate_file_names
+from key_naming import default_key_template, make_redis_key
+from namespace_cleanup import iterate_namespace_keys
+
+# number of existing keys whose members we fetch in one pipeline
+_key_chunk_size = 100
+
+def _to_text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+def scan_directory_sets(watch_path, 
+                        key_extractor, 
+                        redis_prefix, 
+                        recursive=False,
+                        key_template=default_key_template):
+    """
+    return a dict of redis_key -> set of matching file names in watch_path
+    """
+    directory_sets = dict()
+    for file_name in iterate_file_names(watch_path, recursive):
+        key = key_extractor.extract(file_name.rpartition(os.sep)[2])
+        if key is None:
+            continue
+        redis_key = make_redis_key(key_template, redis_prefix, key)
+        try:
+            directory_sets[redis_key].add(file_name)
+        except KeyError:
+            directory_sets[redis_key] = set([file_name, ])
+    return directory_sets
+
+def _chunks(items, chunk_size):
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i+chunk_size]
+
+def _queue_set_changes(pipeline, redis_key, command, members, chunk_size):
+    for chunk in _chunks(list(members), chunk_size):
+        getattr(pipeline, command)(redis_key, *chunk)
+
+def reconcile_sets(redis, directory_sets, existing_keys, chunk_size):
+    """
+    make the redis sets in existing_keys match directory_sets, then
+    create the sets that are missing. directory_sets is consumed.
+
+    return a dict of counts
+    """
+    log = logging.getLogger("reconcile_sets")
+    counts = {"added"          : 0,
+              "removed"        : 0,
+              "deleted_keys"   : 0,
+              "unchanged_keys" : 0, }
+
+    for key_chunk in _chunks(existing_keys, _key_chunk_size):
+        pipeline = redis.pipeline(transaction=False)
+        for redis_key in key_chunk:
+            pipeline.smembers(redis_key)
+        results = pipeline.execute(raise_on_error=False)
+
+        pipeline = redis.pipeline(transaction=False)
+        for redis_key, result in zip(key_chunk, results):
+            if isinstance(result, Exception):
+                # not a set (WRONGTYPE): leave it alone
+                log.warn("skipping {0}: {1}".format(redis_key, result))
+                continue
+            redis_members = set(_to_text(member) for member in result)
+            directory_members = directory_sets.pop(redis_key, None)
+            if directory_members is None:
+                pipeline.delete(redis_key)
+                counts["deleted_keys"] += 1
+                continue
+            extra_members = redis_members - directory_members
+            missing_members = directory_members - redis_members
+            if len(extra_members) == 0 and len(missing_members) == 0:
+                counts["unchanged_keys"] += 1
+                continue
+            _queue_set_changes(pipeline, redis_key, "srem", extra_members,
+                               chunk_size)
+            _queue_set_changes(pipeline, redis_key, "sadd", missing_members,
+                               chunk_size)
+            counts["removed"] += len(extra_members)
+            counts["added"] += len(missing_members)
+        pipeline.execute()
+
+    # whatever is left has no set in redis yet
+    pipeline = redis.pipeline(transaction=False)
+    queued_count = 0
+    for redis_key, directory_members in directory_sets.items():
+        _queue_set_changes(pipeline, redis_key, "sadd", directory_members,
+                           chunk_size)
+        counts["added"] += len(directory_members)
+        queued_count += len(directory_members)
+        if queued_count >= chunk_size:
+            pipeline.execute()
+            pipeline = redis.pipeline(transaction=False)
+            queued_count = 0
+    pipeline.execute()
+    directory_sets.clear()
+
+    return counts
+
+def apply_set_differences(redis, old_sets, new_sets, chunk_size):
+    """
+    change the redis sets from old_sets, which we know they hold, to 
+    new_sets, without reading them. Both are dicts of redis_key -> set of 
+    file names.
+
+    return a dict of counts
+    """
+    counts = {"added"          : 0,
+              "removed"        : 0,
+              "deleted_keys"   : 0,
+              "unchanged_keys" : 0, }
+
+    pipeline = redis.pipeline(transaction=False)
+    queued_count = 0
+    for redis_key in set(old_sets.keys()) | set(new_sets.keys()):
+        old_members = old_sets.get(redis_key, set())
+        new_members = new_sets.get(redis_key, set())
+        if len(new_members) == 0:
+            pipeline.delete(redis_key)
+            counts["deleted_keys"] += 1
+            queued_count += 1
+        else:
+            extra_members = old_members - new_members
+            missing_members = new_members - old_members
+            if len(extra_members) == 0 and len(missing_members) == 0:
+                counts["unchanged_keys"] += 1
+                continue
+            _queue_set_changes(pipeline, redis_key, "srem", extra_members,
+                               chunk_size)
+            _queue_set_changes(pipeline, redis_key, "sadd", missing_members,
+                               chunk_size)
+            counts["removed"] += len(extra_members)
+            counts["added"] += len(missing_members)
+            queued_count += len(extra_members) + len(missing_members)
+        if queued_count >= chunk_size:
+            pipeline.execute()
+            pipeline = redis.pipeline(transaction=False)
+            queued_count = 0
+    pipeline.execute()
+
+    return counts
+
+def reconcile_directory(redis,
+                        watch_path,
+                        key_extractor,
+                        redis_prefix,
+                        chunk_size,
+                        scan_count,
+                        exclude_keys=(),
+                        recursive=False,
+                        key_template=default_key_template,
+                        directory_sets=None):
+    """
+    reconcile every set under redis_prefix with the contents of watch_path.
+    keys in exclude_keys (such as the up-to-date timestamp) are not touched.
+    directory_sets, if given, is the result of a scan_directory_sets we 
+    have already done; it is consumed.
+    """
+    log = logging.getLogger("reconcile_directory")
+    start_time = time.time()
+
+    if directory_sets is None:
+        directory_sets = scan_directory_sets(watch_path, 
+                                             key_extractor, 
+                                             redis_prefix, 
+                                             recursive,
+                                             key_template)
+    log.info("found {0} keys in {1} in {2:.3f} secs".format(
+             len(directory_sets), watch_path, time.time() - start_time))
+
+    exclude_keys = set(exclude_keys)
+    existing_keys = [_to_text(key) for key in 
+                     iterate_namespace_keys(redis, 
+                                            redis_prefix, 
+                                            scan_count,
+                                            key_template)]
+    existing_keys = [key for key in existing_keys if not key in exclude_keys]
+
+    counts = reconcile_sets(redis, directory_sets, existing_keys, chunk_size)
+
+    log.info("reconciled {0} existing keys in {1:.3f} secs: " \
+             "added {2} removed {3} deleted keys {4} unchanged keys {5}".format(
+             len(existing_keys),
+             time.time() - start_time,
+             counts["added"],
+             counts["removed"],
+             counts["deleted_keys"],
+             counts["unchanged_keys"]))
+    return counts
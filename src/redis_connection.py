@@ -3,6 +3,17 @@
 redis_connection.py
 
 create a redis connection
+
+Both clients share the same settings: a connection pool, socket timeouts
+(so a dead server shows up as a ConnectionError or TimeoutError instead of
+a hang), and an optional unix socket in place of host and port.
+Connections that fail are dropped by the pool and reconnected on their
+next command; the write-ahead buffer takes care of backing off between
+attempts.
+
+In cluster mode (redis-py 4.1 or later) REDIS_HOST and REDIS_PORT name any
+node of the cluster. The cluster client routes every command to the node
+that owns its key's slot, and its pipeline sends one batch to each node.
 """
 import logging
 import os
@@ -12,17 +23,140 @@ import redis
 _redis_host = os.environ.get("REDIS_HOST", "localhost")
 _redis_port = int(os.environ.get("REDIS_PORT", str(6379)))
 _redis_db = int(os.environ.get("REDIS_DB", str(0)))
+_redis_socket = os.environ.get("REDIS_SOCKET")
 
-def create_redis_connection(host=None, port=None, db=None):
-    log = logging.getLogger("create_redis_connection")
-
+def _connection_parameters(host, port, db):
     if host is None:
         host = _redis_host
     if port is None:
         port = _redis_port
     if db is None:
         db = _redis_db
+    return host, port, db
+
+def _pool_parameters(host,
+                     port,
+                     db,
+                     socket_path,
+                     socket_timeout,
+                     connect_timeout,
+                     max_connections):
+    """
+    keyword arguments for a ConnectionPool, and a description for the log
+    """
+    host, port, db = _connection_parameters(host, port, db)
+    if socket_path is None:
+        socket_path = _redis_socket
+
+    parameters = {"db"              : db,
+                  "socket_timeout"  : socket_timeout,
+                  "max_connections" : max_connections, }
+    if socket_path is not None:
+        parameters["path"] = socket_path
+        description = "{0} db={1}".format(socket_path, db)
+    else:
+        parameters["host"] = host
+        parameters["port"] = port
+        parameters["socket_connect_timeout"] = connect_timeout
+        parameters["socket_keepalive"] = True
+        description = "{0}:{1} db={2}".format(host, port, db)
+
+    return parameters, socket_path is not None, description
+
+def _cluster_parameters(host, port, socket_timeout, connect_timeout,
+                        max_connections):
+    host, port, _ = _connection_parameters(host, port, None)
+    parameters = {"host"                    : host,
+                  "port"                    : port,
+                  "socket_timeout"          : socket_timeout,
+                  "socket_connect_timeout"  : connect_timeout,
+                  "socket_keepalive"        : True,
+                  "max_connections"         : max_connections, }
+    return parameters, "cluster {0}:{1}".format(host, port)
+
+def is_cluster(redis):
+    return hasattr(redis, "get_primaries")
+
+def node_connections(redis):
+    """
+    a client for each primary node of a cluster, for commands such as SCAN
+    that work on one node at a time; otherwise just redis
+    """
+    if not is_cluster(redis):
+        return [redis, ]
+    return [redis.get_redis_connection(node) for node in redis.get_primaries()]
+
+def create_redis_connection(host=None,
+                            port=None,
+                            db=None,
+                            socket_path=None,
+                            socket_timeout=None,
+                            connect_timeout=None,
+                            max_connections=None,
+                            cluster=False):
+    log = logging.getLogger("create_redis_connection")
+
+    if cluster:
+        from redis.cluster import RedisCluster
+        parameters, description = _cluster_parameters(host,
+                                                       port,
+                                                       socket_timeout,
+                                                       connect_timeout,
+                                                       max_connections)
+        log.info("connecting to {0}".format(description))
+        return RedisCluster(**parameters)
+
+    parameters, unix_socket, description = \
+        _pool_parameters(host,
+                         port,
+                         db,
+                         socket_path,
+                         socket_timeout,
+                         connect_timeout,
+                         max_connections)
+    if unix_socket:
+        parameters["connection_class"] = redis.UnixDomainSocketConnection
+
+    log.info("connecting to {0}".format(description))
+    return redis.StrictRedis(connection_pool=redis.ConnectionPool(**parameters))
+
+def create_async_redis_connection(host=None,
+                                  port=None,
+                                  db=None,
+                                  socket_path=None,
+                                  socket_timeout=None,
+                                  connect_timeout=None,
+                                  max_connections=None,
+                                  cluster=False):
+    """
+    create a client for the asyncio engine. This needs redis-py 4.2 or
+    later (4.3 for cluster), so we only import it when asked
+    """
+    import redis.asyncio
+    log = logging.getLogger("create_async_redis_connection")
+
+    if cluster:
+        from redis.asyncio.cluster import RedisCluster
+        parameters, description = _cluster_parameters(host,
+                                                       port,
+                                                       socket_timeout,
+                                                       connect_timeout,
+                                                       max_connections)
+        log.info("connecting to {0}".format(description))
+        return RedisCluster(**parameters)
 
-    log.info("connecting to {0}:{1} db={2}".format(host, port, db))
-    return redis.StrictRedis(host=host, port=port, db=db)
+    parameters, unix_socket, description = \
+        _pool_parameters(host,
+                         port,
+                         db,
+                         socket_path,
+                         socket_timeout,
+                         connect_timeout,
+                         max_connections)
+    if unix_socket:
+        parameters["connection_class"] = \
+            redis.asyncio.UnixDomainSocketConnection
 
+    log.info("connecting to {0}".format(description))
+    return redis.asyncio.StrictRedis(
+        connection_pool=redis.asyncio.ConnectionPool(**parameters))
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+set_backends.py
+
+where FileNameSetManager keeps the sets. Every backend has the same
+methods:
+
+    replace(rule, directory_sets)    make the sets of a rule match a dict
+                                     of redis_key -> set of file names
+    apply(entries)                   apply (redis_key, file_name, event_name)
+                                     entries; return False on failure
+    mark_up_to_date(rules, value)    set the up-to-date timestamp of rules
+
+MemorySetBackend keeps them in this process, and answers queries without
+a round trip; SetQueryServer serves it to other processes on the host.
+RedisSetBackend keeps them in redis, the view shared between hosts.
+"""
+import fnmatch
+import logging
+from threading import Lock
+
+from batch_dispatch import execute_batch
+from event_names import incoming_event_names
+from reconcile import reconcile_directory
+
+class MemorySetBackend(object):
+    """
+    the sets in a dict, under the same keys they have in redis. Queries may
+    come from other threads
+    """
+    def __init__(self):
+        self._lock = Lock()
+        # redis_key -> set of file names
+        self._sets = dict()
+        # up-to-date timestamp key -> value
+        self._values = dict()
+
+    def replace(self, rule, directory_sets):
+        with self._lock:
+            for redis_key in list(self._sets.keys()):
+                if rule.owns_key(redis_key):
+                    del self._sets[redis_key]
+            for redis_key, file_names in directory_sets.items():
+                if len(file_names) > 0:
+                    self._sets[redis_key] = set(file_names)
+
+    def apply(self, entries):
+        with self._lock:
+            for redis_key, file_name, event_name in entries:
+                if event_name in incoming_event_names:
+                    self._sets.setdefault(redis_key, set()).add(file_name)
+                    continue
+                file_names = self._sets.get(redis_key)
+                if file_names is not None:
+                    file_names.discard(file_name)
+                    if len(file_names) == 0:
+                        del self._sets[redis_key]
+        return True
+
+    def mark_up_to_date(self, rules, value):
+        with self._lock:
+            for rule in rules:
+                self._values[rule.up_to_date_timestamp_key] = value
+
+    def members(self, redis_key):
+        """
+        the file names in a set, as a list
+        """
+        with self._lock:
+            return list(self._sets.get(redis_key, ()))
+
+    def is_member(self, redis_key, file_name):
+        with self._lock:
+            return file_name in self._sets.get(redis_key, ())
+
+    def count(self, redis_key):
+        with self._lock:
+            return len(self._sets.get(redis_key, ()))
+
+    def keys(self, pattern="*"):
+        """
+        the keys of the sets that match a glob pattern, like redis KEYS
+        """
+        with self._lock:
+            redis_keys = list(self._sets.keys())
+        return [redis_key for redis_key in redis_keys
+                if fnmatch.fnmatchcase(redis_key, pattern)]
+
+    def get(self, redis_key):
+        """
+        the value of an up-to-date timestamp key, like redis GET.
+        None for any other key
+        """
+        with self._lock:
+            return self._values.get(redis_key)
+
+class RedisSetBackend(object):
+    """
+    the sets in redis, sent as pipelined batches
+    """
+    def __init__(self, redis, chunk_size=10000, scan_count=1000):
+        self._log = logging.getLogger("RedisSetBackend")
+        self._redis = redis
+        self._chunk_size = chunk_size
+        self._scan_count = scan_count
+
+    def replace(self, rule, directory_sets):
+        reconcile_directory(self._redis,
+                            rule.watch_path,
+                            rule.key_extractor,
+                            rule.redis_prefix,
+                            self._chunk_size,
+                            self._scan_count,
+                            exclude_keys=rule.reserved_keys,
+                            recursive=rule.recursive,
+                            key_template=rule.key_template,
+                            directory_sets=dict(directory_sets))
+
+    def apply(self, entries):
+        failures = execute_batch(self._redis, entries)
+        for file_name, event_name, instance in failures:
+            self._log.error("{0} {1} {2}".format(file_name,
+                                                 event_name,
+                                                 instance))
+        return len(failures) == 0
+
+    def mark_up_to_date(self, rules, value):
+        for rule in rules:
+            self._redis.set(rule.up_to_date_timestamp_key, str(value))
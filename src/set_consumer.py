@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+set_consumer.py
+
+take the files of a key away from file_name_set_manager: claim the set,
+read its members a page at a time, and remove the files.
+
+A claim renames the set to a key of our own, in one redis script, so
+files added after the claim start a new set instead of being lost between
+a read and a delete. Claimed sets are named
+
+    claimed:{<hash tag>}:<redis_key>:<token>
+
+outside the namespace of every rule, so a reconcile or an index rebuild
+in the manager never sees them. The hash tag is the one of redis_key (the
+whole key, if it has none), so the claimed set is in the same Redis
+Cluster slot.
+
+The script can also
+
+ * publish '<redis_key> <member_count>' on a claim channel. The manager,
+   started with the same --claim-channel and --mirror, then knows the
+   IN_DELETEs of the files are the drain, and doesn't send their SREMs
+   to a set that is gone
+ * take the key out of the manager's key index (--index), given the index
+   and count keys of its rule
+
+The members are read with SSCAN, so a set of any size takes a page of
+memory. The files are removed by a pool of threads: unlink is a system
+call, and each waits on the file system. A file that is already gone is
+counted, not an error. The claimed set is deleted once every file is
+removed; if some could not be, it is left for another look.
+
+A SetConsumer drains one key at a time.
+"""
+import errno
+import logging
+import os.path
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import sys
+from threading import Thread, Lock
+import time
+import uuid
+
+from key_naming import hash_tag, claimed_key_prefix
+
+_claim_source = """
+if redis.call("exists", KEYS[1]) == 0 then
+    return false
+end
+redis.call("rename", KEYS[1], KEYS[2])
+local count = redis.call("scard", KEYS[2])
+if ARGV[1] ~= "" then
+    redis.call("publish", ARGV[1], KEYS[1] .. " " .. count)
+end
+if #KEYS == 4 then
+    redis.call("zrem", KEYS[3], KEYS[1])
+    redis.call("hdel", KEYS[4], KEYS[1])
+end
+return count
+"""
+
+default_worker_count = 8
+default_page_size = 1000
+
+# file names handed to a worker at a time
+_chunk_size = 100
+
+def _to_text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+def claim_key_name(redis_key, token):
+    """
+    the name we rename the set of redis_key to, in the same cluster slot
+    """
+    return "{0}{{{1}}}:{2}:{3}".format(claimed_key_prefix,
+                                       hash_tag(redis_key),
+                                       redis_key,
+                                       token)
+
+class DrainReport(object):
+    """
+    what draining one key did
+    """
+    def __init__(self, redis_key, claim_key, member_count):
+        self.redis_key = redis_key
+        self.claim_key = claim_key
+        self.member_count = member_count
+        self.removed_count = 0
+        self.missing_count = 0
+        self.failed_count = 0
+        self.elapsed_seconds = 0.0
+
+    def files_per_second(self):
+        if self.elapsed_seconds <= 0.0:
+            return 0.0
+        return (self.removed_count + self.missing_count) / \
+               self.elapsed_seconds
+
+    def __str__(self):
+        return "{0}: {1} members, removed {2}, already gone {3}, " \
+               "failed {4} in {5:.3f} secs ({6:.0f} files/sec)".format(
+               self.redis_key,
+               self.member_count,
+               self.removed_count,
+               self.missing_count,
+               self.failed_count,
+               self.elapsed_seconds,
+               self.files_per_second())
+
+class _RemovalPool(object):
+    """
+    threads that remove lists of paths, counting into a DrainReport
+    """
+    def __init__(self, worker_count):
+        self._log = logging.getLogger("RemovalPool")
+        # a bounded queue: the reader waits for the workers
+        self._job_queue = queue.Queue(maxsize=worker_count * 2)
+        self._lock = Lock()
+        self._threads = list()
+        for worker_number in range(worker_count):
+            thread = Thread(target=self._work,
+                            name="remove_{0}".format(worker_number))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self._job_queue.get()
+            if job is None:
+                self._job_queue.task_done()
+                break
+            paths, report = job
+            removed_count = 0
+            missing_count = 0
+            failed_count = 0
+            for path in paths:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    instance = sys.exc_info()[1]
+                    if instance.errno == errno.ENOENT:
+                        missing_count += 1
+                    else:
+                        self._log.error("unable to remove {0}: {1}".format(
+                                        path, instance))
+                        failed_count += 1
+                else:
+                    removed_count += 1
+            with self._lock:
+                report.removed_count += removed_count
+                report.missing_count += missing_count
+                report.failed_count += failed_count
+            self._job_queue.task_done()
+
+    def remove(self, paths, report):
+        self._job_queue.put((paths, report, ))
+
+    def wait(self):
+        """
+        wait until every path handed to remove() has been dealt with
+        """
+        self._job_queue.join()
+
+    def stop(self):
+        for _ in self._threads:
+            self._job_queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout=5.0)
+
+class SetConsumer(object):
+    """
+    claim and drain the sets of file names under watch_path.
+    index_keys is (index_key, count_key) of the rule, if the manager
+    keeps a key index
+    """
+    def __init__(self,
+                 redis,
+                 watch_path,
+                 worker_count=default_worker_count,
+                 page_size=default_page_size,
+                 claim_channel=None,
+                 index_keys=None):
+        self._log = logging.getLogger("SetConsumer")
+        self._redis = redis
+        self._watch_path = watch_path
+        self._page_size = page_size
+        self._claim_channel = claim_channel
+        self._index_keys = (list() if index_keys is None
+                            else list(index_keys))
+        self._claim_script = redis.register_script(_claim_source)
+        self._pool = _RemovalPool(worker_count)
+
+    def close(self):
+        self._pool.stop()
+
+    def claim(self, redis_key):
+        """
+        take the set of redis_key for ourselves.
+        return (claim_key, member_count), or None if there is no set
+        """
+        claim_key = claim_key_name(redis_key, uuid.uuid4().hex)
+        member_count = self._claim_script(
+            keys=[redis_key, claim_key, ] + self._index_keys,
+            args=[self._claim_channel or "", ])
+        if member_count is None:
+            return None
+        return claim_key, member_count
+
+    def iterate_pages(self, claim_key):
+        """
+        generate lists of the file names in a claimed set, a page at a time
+        """
+        cursor = 0
+        while True:
+            cursor, members = self._redis.sscan(claim_key,
+                                                cursor,
+                                                count=self._page_size)
+            if len(members) > 0:
+                yield [_to_text(member) for member in members]
+            if int(cursor) == 0:
+                break
+
+    def drain(self, redis_key):
+        """
+        claim the set of redis_key and remove its files.
+        return a DrainReport, or None if there is no set
+        """
+        start_time = time.time()
+        claim = self.claim(redis_key)
+        if claim is None:
+            self._log.info("no set for {0}".format(redis_key))
+            return None
+        claim_key, member_count = claim
+        report = DrainReport(redis_key, claim_key, member_count)
+
+        join = os.path.join
+        watch_path = self._watch_path
+        for file_names in self.iterate_pages(claim_key):
+            paths = [join(watch_path, file_name) for file_name in file_names]
+            for first in range(0, len(paths), _chunk_size):
+                self._pool.remove(paths[first:first+_chunk_size], report)
+        self._pool.wait()
+
+        if report.failed_count == 0:
+            self._redis.delete(claim_key)
+        else:
+            self._log.error("{0} files of {1} not removed: leaving {2}".format(
+                            report.failed_count, redis_key, claim_key))
+        report.elapsed_seconds = time.time() - start_time
+        self._log.info("drained {0}".format(report))
+        return report
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+set_mirror.py
+
+keep a copy of the redis sets in the process, so adds and removes that
+would not change a set never reach redis: a file rewritten in place gets
+IN_CLOSE_WRITE again, and names that were never added (or already
+removed) still get their IN_DELETE.
+
+Names are interned, so a name is stored once however many of its events
+we see.
+
+The mirror is complete when it holds every member of every set: after the
+namespace is cleared on startup, or when it is seeded from a checkpoint.
+After a bulk load or reconcile we only know what we have added since, so a
+remove of a name we don't know still goes to redis.
+
+This assumes nothing else adds the names to the sets. A consumer that
+deletes a key will not see a rewritten file added back.
+
+A consumer that claims a key (set_consumer.py) renames the set away and
+then deletes its files. If it tells us about the claim, with the number of
+members it took, and we hold that many names for the key, they move to a
+claimed set: their IN_DELETEs are the drain, and never reach redis. If the
+counts differ, names were added or removed around the claim, and the
+removes go to redis as before.
+"""
+import logging
+import sys
+
+from event_names import incoming_event_names
+
+_intern = getattr(sys, "intern", None) or intern
+
+class SetMirror(object):
+    """
+    filter lists of (redis_key, file_name, event_name) entries down to
+    the ones that change a set
+    """
+    def __init__(self, complete):
+        self._log = logging.getLogger("SetMirror")
+        # redis_key -> set of file names
+        self._sets = dict()
+        # redis_key -> sys.getsizeof of its set, so we can follow the
+        # memory use without walking every set
+        self._set_sizes = dict()
+        self._set_bytes = 0
+        self._name_bytes = 0
+        self.name_count = 0
+        # redis_key -> set of file names claimed by a consumer, whose
+        # removes we expect
+        self._claimed = dict()
+        self.claimed_name_count = 0
+        self.complete = complete
+        self.hit_count = 0
+        self.miss_count = 0
+        self._reported_count = 0
+
+    def reset(self, complete, sets=None):
+        """
+        start again from a dict of redis_key -> set of file names, or from
+        nothing
+        """
+        self._sets.clear()
+        self._set_sizes.clear()
+        self._set_bytes = 0
+        self._name_bytes = 0
+        self.name_count = 0
+        self._claimed.clear()
+        self.claimed_name_count = 0
+        self.complete = complete
+        if sets is not None:
+            for redis_key, file_names in sets.items():
+                for file_name in file_names:
+                    self._add(redis_key, file_name)
+
+    def _resized(self, redis_key, file_names):
+        new_size = (0 if file_names is None else sys.getsizeof(file_names))
+        self._set_bytes += new_size - self._set_sizes.get(redis_key, 0)
+        if file_names is None:
+            self._set_sizes.pop(redis_key, None)
+        else:
+            self._set_sizes[redis_key] = new_size
+
+    def _add(self, redis_key, file_name):
+        """
+        return False if the name was already there
+        """
+        file_names = self._sets.get(redis_key)
+        if file_names is None:
+            file_names = set()
+            self._sets[_intern(redis_key)] = file_names
+        elif file_name in file_names:
+            return False
+        file_names.add(_intern(file_name))
+        self._name_bytes += sys.getsizeof(file_name)
+        self.name_count += 1
+        self._resized(redis_key, file_names)
+        return True
+
+    def _remove(self, redis_key, file_name):
+        """
+        return False if the name was not there
+        """
+        file_names = self._sets.get(redis_key)
+        if file_names is None or not file_name in file_names:
+            return False
+        file_names.discard(file_name)
+        self._name_bytes -= sys.getsizeof(file_name)
+        self.name_count -= 1
+        if len(file_names) == 0:
+            del self._sets[redis_key]
+            file_names = None
+        self._resized(redis_key, file_names)
+        return True
+
+    def claim(self, redis_key, member_count):
+        """
+        a consumer has claimed the set of redis_key, which had member_count
+        members. return True if we hold the same number of names for it
+        """
+        file_names = self._sets.get(redis_key)
+        if file_names is None or len(file_names) != member_count:
+            self._log.debug("claim of {0}: {1} members, {2} names".format(
+                            redis_key,
+                            member_count,
+                            (0 if file_names is None else len(file_names))))
+            return False
+        del self._sets[redis_key]
+        self._resized(redis_key, None)
+        for file_name in file_names:
+            self._name_bytes -= sys.getsizeof(file_name)
+        self.name_count -= len(file_names)
+        claimed_names = self._claimed.get(redis_key)
+        if claimed_names is None:
+            self._claimed[redis_key] = file_names
+        else:
+            claimed_names.update(file_names)
+        self.claimed_name_count += len(file_names)
+        return True
+
+    def _unclaim(self, redis_key, file_name):
+        """
+        return False if the name was not claimed
+        """
+        claimed_names = self._claimed.get(redis_key)
+        if claimed_names is None or not file_name in claimed_names:
+            return False
+        claimed_names.discard(file_name)
+        self.claimed_name_count -= 1
+        if len(claimed_names) == 0:
+            del self._claimed[redis_key]
+        return True
+
+    def filter(self, entries):
+        """
+        return the entries that change a set, updating the mirror
+        """
+        result = list()
+        for entry in entries:
+            redis_key, file_name, event_name = entry
+            if event_name in incoming_event_names:
+                # a claimed name written again is a new member
+                if len(self._claimed) > 0:
+                    self._unclaim(redis_key, file_name)
+                changed = self._add(redis_key, file_name)
+            elif len(self._claimed) > 0 and \
+                 self._unclaim(redis_key, file_name):
+                # removed by the consumer that claimed the set
+                changed = False
+            else:
+                # a name we don't know may still be in an incomplete set
+                changed = self._remove(redis_key, file_name) or \
+                          not self.complete
+            if changed:
+                result.append(entry)
+                self.miss_count += 1
+            else:
+                self.hit_count += 1
+        return result
+
+    def hit_rate(self):
+        total_count = self.hit_count + self.miss_count
+        if total_count == 0:
+            return 0.0
+        return float(self.hit_count) / total_count
+
+    def memory_bytes(self):
+        """
+        roughly what the mirror takes: the dict, the sets and the names
+        """
+        return sys.getsizeof(self._sets) + self._set_bytes + self._name_bytes
+
+    def log_statistics(self, force=False):
+        """
+        log the counts, if anything has changed since we last did
+        """
+        total_count = self.hit_count + self.miss_count
+        if total_count == self._reported_count and not force:
+            return
+        self._reported_count = total_count
+        self._log.info("{0} keys, {1} names, about {2} bytes; {3} claimed " \
+                       "names; skipped {4} of {5} events ({6:.1%})".format(
+                       len(self._sets),
+                       self.name_count,
+                       self.memory_bytes(),
+                       self.claimed_name_count,
+                       self.hit_count,
+                       total_count,
+                       self.hit_rate()))
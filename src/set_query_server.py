@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+set_query_server.py
+
+serve a MemorySetBackend on a unix socket, so programs on the same host
+can ask about the sets without a round trip to redis.
+
+Each request is one line of JSON, answered by one line of JSON:
+
+    {"command": "members", "key": "prefix_key"}
+    {"result": ["file_1", "file_2"]}
+
+The commands are members (key), is_member (key, name), count (key),
+keys (pattern, default '*') and get (key), for the up-to-date timestamps.
+A request that fails gets {"error": "..."}. A connection may send any
+number of requests.
+"""
+import json
+import logging
+import os
+import socket
+import sys
+from threading import Thread
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+def _answer(backend, request):
+    command = request["command"]
+    if command == "members":
+        return sorted(backend.members(request["key"]))
+    if command == "is_member":
+        return backend.is_member(request["key"], request["name"])
+    if command == "count":
+        return backend.count(request["key"])
+    if command == "keys":
+        return sorted(backend.keys(request.get("pattern", "*")))
+    if command == "get":
+        return backend.get(request["key"])
+    raise ValueError("unknown command {0}".format(command))
+
+class _QueryRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                reply = {"result" : _answer(self.server.backend,
+                                            json.loads(line.decode("utf-8")))}
+            except Exception:
+                instance = sys.exc_info()[1]
+                reply = {"error" : "{0}: {1}".format(
+                                   instance.__class__.__name__, instance)}
+            self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+class _UnixQueryServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class SetQueryServer(object):
+    """
+    answer queries about a MemorySetBackend from a daemon thread
+    """
+    def __init__(self, backend, socket_path):
+        self._log = logging.getLogger("SetQueryServer")
+        self._socket_path = socket_path
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self._server = _UnixQueryServer(socket_path, _QueryRequestHandler)
+        self._server.backend = backend
+        self._log.info("serving set queries on {0}".format(socket_path))
+        self._thread = Thread(target=self._server.serve_forever,
+                              name="set_query")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        try:
+            os.unlink(self._socket_path)
+        except OSError:
+            instance = sys.exc_info()[1]
+            self._log.warn("unable to remove {0}: {1}".format(
+                           self._socket_path, instance))
+
+class SetQueryError(Exception):
+    pass
+
+class SetQueryClient(object):
+    """
+    ask a SetQueryServer about the sets, over one connection
+    """
+    def __init__(self, socket_path, timeout=None):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(socket_path)
+        self._file = self._socket.makefile("rb")
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def _query(self, request):
+        self._socket.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        line = self._file.readline()
+        if len(line) == 0:
+            raise SetQueryError("connection closed")
+        reply = json.loads(line.decode("utf-8"))
+        if "error" in reply:
+            raise SetQueryError(reply["error"])
+        return reply["result"]
+
+    def members(self, redis_key):
+        return self._query({"command" : "members", "key" : redis_key})
+
+    def is_member(self, redis_key, file_name):
+        return self._query({"command"   : "is_member",
+                            "key"       : redis_key,
+                            "name"      : file_name, })
+
+    def count(self, redis_key):
+        return self._query({"command" : "count", "key" : redis_key})
+
+    def keys(self, pattern="*"):
+        return self._query({"command" : "keys", "pattern" : pattern})
+
+    def get(self, redis_key):
+        return self._query({"command" : "get", "key" : redis_key})
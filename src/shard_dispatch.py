@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+shard_dispatch.py
+
+spread the redis work over several worker processes. The main loop still
+reads events and extracts keys; each key is hashed to one of N shards, and
+every shard is a process with its own redis connection, write-ahead buffer
+and pipelines. All the entries for a key go to the same shard, in order,
+so ordering within a key is kept.
+
+Every job is acknowledged with (shard, sequence, succeeded, buffer pending).
+A shard has caught up when it has acknowledged everything sent to it and
+has nothing buffered; the up-to-date timestamps are set only when every
+shard has caught up.
+
+The workers are forked, so they share the rules and key extractors of the
+main process, and the dispatch functions are handed to them instead of
+being imported (which would be circular).
+"""
+import logging
+import multiprocessing
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import signal
+import zlib
+
+from batch_script import BatchScript
+from key_index import KeyIndex
+from redis_connection import create_redis_connection
+from write_ahead_buffer import WriteAheadBuffer
+
+# time (secs) a worker waits for a job before retrying its buffer
+_worker_poll_interval = 1.0
+_worker_join_timeout = 10.0
+
+def _create_worker_redis(args):
+    return create_redis_connection(
+        socket_path=args.redis_socket,
+        socket_timeout=args.redis_timeout,
+        connect_timeout=args.redis_connect_timeout,
+        max_connections=args.redis_max_connections,
+        cluster=args.cluster)
+
+def _shard_worker(shard_number,
+                  args,
+                  rules,
+                  job_queue,
+                  ack_queue,
+                  dispatch_entries,
+                  replay_buffer):
+    """
+    run in a worker process: dispatch (sequence, entries) jobs until we get
+    None
+    """
+    log = logging.getLogger("shard_{0}".format(shard_number))
+    # the main process decides when we stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    try:
+        redis = _create_worker_redis(args)
+    except Exception:
+        log.exception("Unable to connect to redis")
+        ack_queue.put((shard_number, 0, False, False, ))
+        return
+
+    write_buffer = None
+    if args.redis_buffer_size > 0:
+        write_buffer = WriteAheadBuffer(args.redis_buffer_size,
+                                        args.redis_retry_max_delay,
+                                        args.scan_chunk_size)
+    key_index = (KeyIndex(rules) if args.index else None)
+    batch_script = None
+    if args.atomic_batches:
+        batch_script = BatchScript(redis, rules, args.index)
+
+    log.info("worker starts")
+    sequence = 0
+    while True:
+        try:
+            job = job_queue.get(block=True, timeout=_worker_poll_interval)
+        except queue.Empty:
+            if write_buffer is None or not write_buffer.pending():
+                continue
+            succeeded = replay_buffer(redis, 
+                                      write_buffer, 
+                                      rules, 
+                                      key_index, 
+                                      batch_script)
+            if not succeeded or not write_buffer.pending():
+                ack_queue.put((shard_number, sequence, succeeded,
+                               write_buffer.pending(), ))
+            continue
+
+        if job is None:
+            break
+
+        sequence, entries = job
+        succeeded = dispatch_entries(redis,
+                                     entries,
+                                     None,
+                                     write_buffer,
+                                     key_index,
+                                     batch_script)
+        pending = False
+        if succeeded and write_buffer is not None and write_buffer.pending():
+            succeeded = replay_buffer(redis, 
+                                      write_buffer, 
+                                      rules, 
+                                      key_index, 
+                                      batch_script)
+            pending = write_buffer.pending()
+        ack_queue.put((shard_number, sequence, succeeded, pending, ))
+
+    if write_buffer is not None:
+        write_buffer.log_statistics()
+        if write_buffer.pending():
+            log.error("{0} buffered entries never reached redis".format(
+                      write_buffer.qsize()))
+    log.info("worker ends")
+
+class ShardPool(object):
+    """
+    hash dispatch entries by key to a set of worker processes
+    """
+    def __init__(self, args, rules, coalescer, dispatch_entries,
+                 replay_buffer):
+        self._log = logging.getLogger("ShardPool")
+        self._shard_count = args.shards
+        self._coalescer = coalescer
+        # fork: the workers inherit the rules and the dispatch functions
+        context = multiprocessing.get_context("fork")
+        self._ack_queue = context.Queue()
+        self._job_queues = list()
+        self._processes = list()
+        for shard_number in range(self._shard_count):
+            job_queue = context.Queue()
+            process = context.Process(target=_shard_worker,
+                                      name="shard_{0}".format(shard_number),
+                                      args=(shard_number,
+                                            args,
+                                            rules,
+                                            job_queue,
+                                            self._ack_queue,
+                                            dispatch_entries,
+                                            replay_buffer, ))
+            process.daemon = True
+            self._job_queues.append(job_queue)
+            self._processes.append(process)
+        self._sent_sequences = [0 for _ in range(self._shard_count)]
+        self._acked_sequences = [0 for _ in range(self._shard_count)]
+        self._buffer_pending = [False for _ in range(self._shard_count)]
+        self.failed = False
+        # set when a shard reports buffered entries; the caller resets it
+        self.buffered = False
+        self.job_count = 0
+
+    def start(self):
+        for process in self._processes:
+            process.start()
+        self._log.info("started {0} shard workers".format(self._shard_count))
+
+    def _shard_number(self, redis_key):
+        # not hash(): that is randomized per process
+        return zlib.crc32(redis_key.encode("utf-8")) % self._shard_count
+
+    def _read_acks(self):
+        while True:
+            try:
+                shard_number, sequence, succeeded, pending = \
+                    self._ack_queue.get_nowait()
+            except queue.Empty:
+                break
+            self._acked_sequences[shard_number] = sequence
+            self._buffer_pending[shard_number] = pending
+            if pending:
+                self.buffered = True
+            if not succeeded:
+                self._log.error("shard {0} failed at job {1}".format(
+                                shard_number, sequence))
+                self.failed = True
+
+        for process in self._processes:
+            if not process.is_alive() and not self.failed:
+                self._log.error("{0} exited with {1}".format(
+                                process.name, process.exitcode))
+                self.failed = True
+
+    def dispatch(self, entries):
+        """
+        send (redis_key, file_name, event_name) entries to their shards.
+        return False if a shard has failed
+        """
+        self._read_acks()
+        if self.failed:
+            return False
+
+        if self._coalescer is not None:
+            entries = self._coalescer.coalesce(entries)
+
+        shard_entries = dict()
+        for entry in entries:
+            shard_number = self._shard_number(entry[0])
+            try:
+                shard_entries[shard_number].append(entry)
+            except KeyError:
+                shard_entries[shard_number] = [entry, ]
+
+        for shard_number, entries in shard_entries.items():
+            self._sent_sequences[shard_number] += 1
+            self._job_queues[shard_number].put(
+                (self._sent_sequences[shard_number], entries, ))
+            self.job_count += 1
+        return True
+
+    def caught_up(self):
+        """
+        True if every shard has sent everything it was given to redis
+        """
+        self._read_acks()
+        return self._acked_sequences == self._sent_sequences and \
+               not any(self._buffer_pending)
+
+    def check(self):
+        """
+        return False if a shard has failed
+        """
+        self._read_acks()
+        return not self.failed
+
+    def stop(self):
+        for job_queue in self._job_queues:
+            job_queue.put(None)
+        for process in self._processes:
+            process.join(timeout=_worker_join_timeout)
+            if process.is_alive():
+                self._log.warn("terminating {0}".format(process.name))
+                process.terminate()
+        self._log.info("sent {0} jobs to {1} shards".format(
+                       self.job_count, self._shard_count))
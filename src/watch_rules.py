@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+watch_rules.py
+
+a watch rule ties a watched directory to the regular expression that
+identifies the key from a file name, and the prefix for the redis key.
+
+Rules come either from the commandline (one rule) or from a config file
+with one section per rule:
+
+    [transport]
+    watch = /path/to/watch/directory
+    key = (?P<key>[^_]+)_.*
+    prefix = transport
+    recursive = false
+
+recursive is optional and defaults to the --recursive commandline switch.
+In a recursive rule, the key regex is matched against the base name of 
+each file and the set members are paths relative to the watch directory.
+"""
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
+import os.path
+import re
+import sys
+
+from key_extractor import create_key_extractor
+from key_naming import default_key_template, \
+                       claimed_key_prefix, \
+                       make_redis_key, \
+                       split_key_template
+
+_up_to_date_timestamp = "up_to_date"
+_index = "index"
+_counts = "counts"
+_checkpoint = "checkpoint"
+
+class WatchRuleError(Exception):
+    pass
+
+class WatchRule(object):
+    """
+    one (directory, key regex, prefix) rule
+    """
+    def __init__(self, name, watch_path, key_regex, redis_prefix, 
+                 recursive=False, key_template=default_key_template):
+        if not "(?P<key>" in key_regex:
+            raise WatchRuleError("invalid key regex {0}".format(key_regex))
+
+        try:
+            self.key_regex = re.compile(key_regex)
+        except Exception:
+            instance = sys.exc_info()[1]
+            raise WatchRuleError("Unable to compile key_regex {0} {1}".format(
+                                 key_regex, instance))
+
+        self.name = name
+        self.watch_path = watch_path
+        self.redis_prefix = redis_prefix
+        self.recursive = recursive
+        self.key_template = key_template
+        self._key_head, self._key_tail = split_key_template(key_template,
+                                                            redis_prefix)
+        # replaced when the commandline asks for a faster extractor
+        self.key_extractor = create_key_extractor(self.key_regex)
+        self.up_to_date_timestamp_key = self.redis_key(_up_to_date_timestamp)
+        # the sorted set of active keys, and their member counts
+        self.index_key = self.redis_key(_index)
+        self.count_key = self.redis_key(_counts)
+        # the token of the local checkpoint that matches redis
+        self.checkpoint_key = self.redis_key(_checkpoint)
+        # keys under the prefix that are not file name sets
+        self.reserved_keys = [self.up_to_date_timestamp_key,
+                              self.index_key,
+                              self.count_key,
+                              self.checkpoint_key, ]
+        # set when the directory is added to the inotify watch manager
+        self.watch_descriptor = None
+        self.unmatched_count = 0
+
+    def redis_key(self, key):
+        return make_redis_key(self.key_template, self.redis_prefix, key)
+
+    def owns_key(self, redis_key):
+        """
+        True if redis_key is one of ours
+        """
+        return redis_key.startswith(self._key_head) and \
+               redis_key.endswith(self._key_tail) and \
+               len(redis_key) > len(self._key_head) + len(self._key_tail)
+
+    def owns_claimed_keys(self):
+        """
+        True if the SCAN pattern of the rule would take in claimed sets
+        """
+        return self._key_head.startswith(claimed_key_prefix) or \
+               claimed_key_prefix.startswith(self._key_head)
+
+    def shares_namespace(self, other):
+        """
+        True if some redis key could be owned by both rules: the SCAN
+        pattern of one would take in keys of the other
+        """
+        return (self._key_head.startswith(other._key_head) or \
+                other._key_head.startswith(self._key_head)) and \
+               (self._key_tail.endswith(other._key_tail) or \
+                other._key_tail.endswith(self._key_tail))
+
+    def __str__(self):
+        return "{0}: {1}{2} '{3}' -> {4}".format(
+            self.name,
+            self.watch_path,
+            (" (recursive)" if self.recursive else ""),
+            self.key_regex.pattern,
+            self.redis_prefix)
+
+def load_watch_rules(config_path, 
+                     recursive=False, 
+                     key_template=default_key_template):
+    """
+    read a list of WatchRule from the sections of a config file.
+    recursive is the default for sections that don't say
+    """
+    parser = configparser.RawConfigParser()
+    if len(parser.read(config_path)) == 0:
+        raise WatchRuleError("Unable to read config file {0}".format(
+                             config_path))
+
+    rules = list()
+    for section in parser.sections():
+        try:
+            rule = WatchRule(section,
+                             parser.get(section, "watch"),
+                             parser.get(section, "key"),
+                             parser.get(section, "prefix"),
+                             (parser.getboolean(section, "recursive") 
+                              if parser.has_option(section, "recursive") 
+                              else recursive),
+                             key_template)
+        except (configparser.Error, ValueError, ):
+            instance = sys.exc_info()[1]
+            raise WatchRuleError("invalid section [{0}] in {1}: {2}".format(
+                                 section, config_path, instance))
+        rules.append(rule)
+
+    check_watch_rules(rules)
+    return rules
+
+def _is_below(path, parent_path):
+    return path.startswith(parent_path.rstrip(os.sep) + os.sep)
+
+def check_watch_rules(rules):
+    """
+    rules must not share a directory or a namespace: with the default key
+    template, prefix 'a' would take in the keys of prefix 'a_b'.
+    The directories are compared as real paths, since inotify gives two
+    watches of one directory the same watch descriptor, and a rule may not
+    be inside the tree of another if either is recursive
+    """
+    if len(rules) == 0:
+        raise WatchRuleError("no watch rules")
+
+    real_paths = dict()
+    checked_rules = list()
+    for rule in rules:
+        real_path = os.path.realpath(rule.watch_path)
+        if real_path in real_paths:
+            raise WatchRuleError("duplicate watch directory {0}".format(
+                                 rule.watch_path))
+        for other_real_path, other_rule in real_paths.items():
+            if not (rule.recursive or other_rule.recursive):
+                continue
+            if _is_below(real_path, other_real_path) or \
+               _is_below(other_real_path, real_path):
+                raise WatchRuleError("watch directory {0} overlaps {1} " \
+                                     "(recursive)".format(
+                                     rule.watch_path,
+                                     other_rule.watch_path))
+        real_paths[real_path] = rule
+        if rule.owns_claimed_keys():
+            raise WatchRuleError("prefix {0} overlaps the claimed sets " \
+                                 "({1})".format(rule.redis_prefix,
+                                                claimed_key_prefix))
+        for other_rule in checked_rules:
+            if rule.shares_namespace(other_rule):
+                raise WatchRuleError("prefix {0} overlaps prefix {1}".format(
+                                     rule.redis_prefix,
+                                     other_rule.redis_prefix))
+        checked_rules.append(rule)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+write_ahead_buffer.py
+
+ride out a redis outage instead of exiting. When a dispatch fails with a
+connection error, its (redis_key, file_name, event_name) entries go into a
+bounded local buffer, and so does everything after them, so the order of
+events is kept. The buffer is replayed in order, in chunks, retrying with
+exponential backoff until redis answers again.
+
+SADD and SREM of the same members in the same order give the same result
+however often they are repeated, so replaying a chunk that redis had
+partly applied before the connection dropped does no harm.
+
+While the buffer is not empty, redis is behind the directory: the
+up-to-date timestamps are set to 0 before the first replayed chunk, and
+are not set again until the buffer has drained.
+
+This class only keeps state; the engines do the redis I/O.
+"""
+from collections import deque
+import itertools
+import logging
+import time
+
+import redis.exceptions
+from redis.exceptions import ConnectionError, TimeoutError
+
+_initial_retry_delay = 0.1
+# a cluster that is failing over a slot says so with CLUSTERDOWN, which
+# older redis-py versions don't know about
+_unreachable_errors = (ConnectionError,
+                       TimeoutError,
+                       getattr(redis.exceptions,
+                               "ClusterDownError",
+                               ConnectionError), )
+
+def is_connection_error(instance):
+    """
+    True if instance means redis was unreachable, rather than that it
+    refused a command
+    """
+    return isinstance(instance, _unreachable_errors)
+
+def all_connection_errors(failures):
+    """
+    True if every (file_name, event_name, exception) failure is a
+    connection error
+    """
+    return len(failures) > 0 and \
+           all(is_connection_error(instance) for _, _, instance in failures)
+
+class WriteAheadBuffer(object):
+    """
+    hold dispatch entries while redis is unreachable
+    """
+    def __init__(self, max_entries, max_retry_delay, chunk_size):
+        self._log = logging.getLogger("WriteAheadBuffer")
+        self._max_entries = max_entries
+        self._max_retry_delay = max_retry_delay
+        self._chunk_size = chunk_size
+        self._entries = deque()
+        self._retry_delay = _initial_retry_delay
+        self._next_retry_time = 0.0
+        self._outage_start_time = None
+        self.up_to_date_cleared = True
+        self.outage_count = 0
+        self.buffered_count = 0
+        self.high_water_mark = 0
+
+    def pending(self):
+        return len(self._entries) > 0
+
+    def qsize(self):
+        return len(self._entries)
+
+    def append(self, entries, instance=None):
+        """
+        buffer entries behind whatever is already buffered.
+        return False if the buffer is full: the entries are lost
+        """
+        if len(self._entries) == 0:
+            self.outage_count += 1
+            self._outage_start_time = time.time()
+            self._retry_delay = _initial_retry_delay
+            self._next_retry_time = time.time() + self._retry_delay
+            self.up_to_date_cleared = False
+            self._log.warn("redis unreachable ({0}): buffering events, " \
+                           "outage {1}".format(instance, self.outage_count))
+
+        if len(self._entries) + len(entries) > self._max_entries:
+            self._log.error("buffer full ({0} entries): " \
+                            "dropping {1} entries".format(len(self._entries),
+                                                          len(entries)))
+            return False
+
+        self._entries.extend(entries)
+        self.buffered_count += len(entries)
+        self.high_water_mark = max(self.high_water_mark, len(self._entries))
+        return True
+
+    def retry_due(self):
+        return time.time() >= self._next_retry_time
+
+    def next_chunk(self):
+        """
+        the oldest entries, up to the chunk size. They stay in the buffer
+        until chunk_sent is called
+        """
+        return list(itertools.islice(self._entries, self._chunk_size))
+
+    def chunk_sent(self, count):
+        for _ in range(count):
+            self._entries.popleft()
+        if len(self._entries) == 0:
+            self._log.warn("redis reachable again: outage {0} lasted " \
+                           "{1:.3f} secs".format(
+                           self.outage_count,
+                           time.time() - self._outage_start_time))
+
+    def discard(self):
+        """
+        forget what is buffered: a resync of the sets has superseded it
+        """
+        if len(self._entries) > 0:
+            self._log.warn("discarding {0} buffered entries: the sets have " \
+                           "been resynced".format(len(self._entries)))
+            self._entries.clear()
+        self.up_to_date_cleared = True
+
+    def retry_failed(self, instance):
+        self._retry_delay = min(self._retry_delay * 2, self._max_retry_delay)
+        self._next_retry_time = time.time() + self._retry_delay
+        self._log.info("redis still unreachable ({0}): {1} entries " \
+                       "buffered, retry in {2:.1f} secs".format(
+                       instance, len(self._entries), self._retry_delay))
+
+    def log_statistics(self):
+        self._log.info("{0} outages, {1} entries buffered, high water mark " \
+                       "{2}, {3} still buffered".format(self.outage_count,
+                                                        self.buffered_count,
+                                                        self.high_water_mark,
+                                                        len(self._entries)))
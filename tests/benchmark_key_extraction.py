@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark_key_extraction.py
+
+A program to compare the key extraction strategies of file_name_set_manager
+on names of the form <user>-<device>-<xact>_<seq>
+"""
+import argparse
+import logging
+import os
+import os.path
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir,
+                                "src"))
+from key_extractor import create_key_extractor
+
+_program_description = "compare key extraction strategies"
+
+_log_format_template = "%(asctime)s %(levelname)-8s %(name)-20s: %(message)s"
+_key_regex = r"(?P<key>\d+-\d+-\d+)_\d+"
+_user_ids = [1001, 2001, 3001, 4001, 5001]
+_device_ids = [1, 2, 3]
+_low_xact_id = 1000
+_high_xact_id = 10000
+
+def _initialize_stderr_logging():
+    """
+    log errors to stderr
+    """
+    log_level = logging.DEBUG
+    handler = logging.StreamHandler(stream=sys.stderr)
+    formatter = logging.Formatter(_log_format_template)
+    handler.setFormatter(formatter)
+    handler.setLevel(log_level)
+    logging.root.addHandler(handler)
+
+    logging.root.setLevel(log_level)
+
+def _parse_commandline():
+    """
+    organize program arguments
+    """
+    parser = argparse.ArgumentParser(description=_program_description)
+    parser.add_argument("--file-count",
+                        dest="file_count",
+                        type=int,
+                        default=1000000,
+                        help="number of file names to extract keys from")
+    parser.add_argument("--files-per-key",
+                        dest="files_per_key",
+                        type=int,
+                        default=100,
+                        help="number of consecutive files sharing a key")
+    parser.add_argument("--memo-size",
+                        dest="memo_size",
+                        type=int,
+                        default=64,
+                        help="size of the key memo")
+    return parser.parse_args()
+
+def _generate_file_names(args):
+    """
+    names arrive in runs that share a key, as they do from a producer
+    """
+    file_names = list()
+    while len(file_names) < args.file_count:
+        key = "{0}-{1}-{2}".format(random.choice(_user_ids),
+                                   random.choice(_device_ids),
+                                   random.randint(_low_xact_id, _high_xact_id))
+        for i in range(args.files_per_key):
+            file_names.append("{0}_{1:08}".format(key, i+1))
+    return file_names[:args.file_count]
+
+def _time_extractor(extractor, file_names):
+    extract = extractor.extract
+    start_time = time.time()
+    for file_name in file_names:
+        extract(file_name)
+    return time.time() - start_time
+
+def main():
+    """
+    main entry point for the program
+    The return value will be the returncode for the program
+    """
+    _initialize_stderr_logging()
+    log = logging.getLogger("main")
+    log.info("program starts")
+
+    args = _parse_commandline()
+    file_names = _generate_file_names(args)
+    key_regex = re.compile(_key_regex)
+    # the key is the first 3 fields, which aren't fixed width in general,
+    # so we build a fixed width set of names for the position strategy
+    fixed_width = len("1001-1-1000")
+
+    strategies = [
+        ("regex", create_key_extractor(key_regex), file_names),
+        ("regex+memo",
+         create_key_extractor(key_regex, memo_size=args.memo_size),
+         file_names),
+        ("delimiter", create_key_extractor(key_regex, delimiter="_"),
+         file_names),
+        ("position",
+         create_key_extractor(key_regex, position=(0, fixed_width)),
+         [file_name for file_name in file_names
+          if file_name.index("_") == fixed_width]),
+    ]
+
+    expected_keys = [key_regex.match(file_name).group("key")
+                     for file_name in file_names[:1000]]
+    for name, extractor, names in strategies:
+        if names is file_names:
+            keys = [extractor.extract(file_name)
+                    for file_name in file_names[:1000]]
+            if keys != expected_keys:
+                log.error("{0} extracted the wrong keys".format(name))
+                return 1
+        elapsed_time = _time_extractor(extractor, names)
+        log.info("{0:12} {1:10} names {2:8.3f} secs " \
+                 "{3:12.0f} names/sec".format(name,
+                                              len(names),
+                                              elapsed_time,
+                                              len(names) / elapsed_time))
+
+    log.info("program completes return code = 0")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
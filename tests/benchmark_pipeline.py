@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark_pipeline.py
+
+A program to benchmark the event pipeline of file_name_set_manager in
+process, without inotify or a live redis: synthetic event streams go
+straight into the dispatch path (key extraction, EventProcessor,
+_dispatch_table or a pipelined batch) against an in-memory redis stand-in,
+and the startup scans run over generated directories.
+
+Results are written as JSON, so runs can be compared between releases.
+
+'allocations per event' is measured with tracemalloc: the peak traced
+bytes during the run, and the net number of allocated memory blocks,
+each divided by the number of events.
+"""
+import argparse
+import json
+import logging
+import os
+import os.path
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir,
+                                "src"))
+from event_coalescer import EventCoalescer
+from event_names import inotify_close_write, \
+                        inotify_moved_to, \
+                        inotify_delete, \
+                        inotify_idle
+from event_processor import EventProcessor, dispatch_step
+from directory_scan import bulk_load_directory
+from reconcile import scan_directory_sets
+from watch_rules import WatchRule
+from file_name_set_manager_main import _dispatch_entries, \
+                                       _initial_directory_scan
+
+_program_description = "benchmark the file_name_set_manager event pipeline"
+
+_log_format_template = "%(asctime)s %(levelname)-8s %(name)-20s: %(message)s"
+_key_regex = r"(?P<key>\d+-\d+-\d+)_\d+"
+_redis_prefix = "bench"
+_watch_descriptor = 1
+_user_ids = [1001, 2001, 3001, 4001, 5001]
+_device_ids = [1, 2, 3]
+_low_xact_id = 1000
+_high_xact_id = 10000
+
+class _InMemoryPipeline(object):
+    """
+    buffer commands for _InMemoryRedis, like a non-transactional pipeline
+    """
+    def __init__(self, redis):
+        self._redis = redis
+        self._commands = list()
+
+    def sadd(self, *args):
+        self._commands.append((self._redis.sadd, args, ))
+        return self
+
+    def srem(self, *args):
+        self._commands.append((self._redis.srem, args, ))
+        return self
+
+    def execute(self, raise_on_error=True):
+        results = list()
+        for method, args in self._commands:
+            try:
+                results.append(method(*args))
+            except Exception:
+                if raise_on_error:
+                    raise
+                results.append(sys.exc_info()[1])
+        self._commands = list()
+        return results
+
+class _InMemoryRedis(object):
+    """
+    just enough of StrictRedis for the dispatch path
+    """
+    def __init__(self):
+        self._data = dict()
+
+    def pipeline(self, transaction=True):
+        return _InMemoryPipeline(self)
+
+    def sadd(self, key, *members):
+        members_set = self._data.setdefault(key, set())
+        count = len(members_set)
+        members_set.update(members)
+        return len(members_set) - count
+
+    def srem(self, key, *members):
+        members_set = self._data.get(key)
+        if members_set is None:
+            return 0
+        count = len(members_set)
+        members_set.difference_update(members)
+        if len(members_set) == 0:
+            del self._data[key]
+        return count - len(members_set)
+
+    def set(self, key, value):
+        self._data[key] = value
+
+def _initialize_stderr_logging():
+    """
+    log errors to stderr
+    """
+    log_level = logging.INFO
+    handler = logging.StreamHandler(stream=sys.stderr)
+    formatter = logging.Formatter(_log_format_template)
+    handler.setFormatter(formatter)
+    handler.setLevel(log_level)
+    logging.root.addHandler(handler)
+
+    logging.root.setLevel(log_level)
+
+def _parse_commandline():
+    """
+    organize program arguments
+    """
+    parser = argparse.ArgumentParser(description=_program_description)
+    parser.add_argument("-o", "--output",
+                        dest="output_path",
+                        default="benchmark_results.json",
+                        help="/path/to/results.json")
+    parser.add_argument("--event-count",
+                        dest="event_count",
+                        type=int,
+                        default=200000,
+                        help="number of synthetic events per run")
+    parser.add_argument("--batch-sizes",
+                        dest="batch_sizes",
+                        default="1,100,1000",
+                        help="comma separated batch sizes to benchmark")
+    parser.add_argument("--scan-sizes",
+                        dest="scan_sizes",
+                        default="10000,1000000,10000000",
+                        help="comma separated directory sizes for the " \
+                        "startup scan benchmark")
+    parser.add_argument("--scan-directory",
+                        dest="scan_directory",
+                        default=None,
+                        help="parent directory for the generated scan " \
+                        "directories (default: a temporary directory)")
+    parser.add_argument("--keep-scan-directories",
+                        dest="keep_scan_directories",
+                        action="store_true",
+                        default=False,
+                        help="keep the generated directories for the next run")
+    return parser.parse_args()
+
+def _construct_random_key():
+    return "{0}-{1}-{2}".format(random.choice(_user_ids),
+                                random.choice(_device_ids),
+                                random.randint(_low_xact_id, _high_xact_id))
+
+def _generate_events(event_count):
+    """
+    a producer writes the files of a key, and a consumer later deletes them
+    """
+    events = list()
+    while len(events) < event_count:
+        key = _construct_random_key()
+        file_names = ["{0}_{1:08}".format(key, i+1)
+                      for i in range(random.randint(1, 100))]
+        for file_name in file_names:
+            events.append((file_name,
+                           random.choice([inotify_close_write,
+                                          inotify_moved_to]),
+                           _watch_descriptor, ))
+        for file_name in file_names:
+            events.append((file_name, inotify_delete, _watch_descriptor, ))
+    events = events[:event_count]
+    events.append((None, inotify_idle, None, ))
+    return events
+
+def _create_rule():
+    rule = WatchRule("benchmark", "", _key_regex, _redis_prefix)
+    rule.watch_descriptor = _watch_descriptor
+    return rule
+
+def _run_events(events, batch_size, coalescer):
+    redis = _InMemoryRedis()
+    processor = EventProcessor([_create_rule(), ])
+    for i in range(0, len(events), batch_size):
+        for step, entries in processor.process_batch(events[i:i+batch_size]):
+            if step == dispatch_step:
+                if not _dispatch_entries(redis, entries, coalescer):
+                    raise ValueError("dispatch failed")
+
+def _benchmark_events(events, batch_size, coalesce):
+    log = logging.getLogger("_benchmark_events")
+    event_count = len(events)
+
+    coalescer = (EventCoalescer() if coalesce else None)
+    start_time = time.time()
+    _run_events(events, batch_size, coalescer)
+    elapsed_time = time.time() - start_time
+
+    # a second run under tracemalloc, which slows everything down
+    coalescer = (EventCoalescer() if coalesce else None)
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    _run_events(events, batch_size, coalescer)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks_after = sys.getallocatedblocks()
+
+    result = {"benchmark"           : "events",
+              "batch_size"          : batch_size,
+              "coalesce"            : coalesce,
+              "event_count"         : event_count,
+              "elapsed_secs"        : elapsed_time,
+              "events_per_sec"      : event_count / elapsed_time,
+              "peak_bytes_per_event": float(peak_bytes) / event_count,
+              "net_blocks_per_event": float(blocks_after - blocks_before) /
+                                      event_count, }
+    log.info("batch_size {0:5} coalesce {1!s:5} {2:12.0f} events/sec " \
+             "{3:8.1f} peak bytes/event".format(batch_size,
+                                                coalesce,
+                                                result["events_per_sec"],
+                                                result["peak_bytes_per_event"]))
+    return result
+
+def _populate_directory(path, file_count):
+    """
+    create file_count empty files in path, unless a previous run did
+    """
+    log = logging.getLogger("_populate_directory")
+    if os.path.isdir(path) and len(os.listdir(path)) == file_count:
+        return
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    log.info("creating {0} files in {1}".format(file_count, path))
+    created_count = 0
+    while created_count < file_count:
+        key = _construct_random_key()
+        for i in range(random.randint(1, 100)):
+            if created_count == file_count:
+                break
+            file_name = "{0}_{1:08}".format(key, i+1)
+            file_path = os.path.join(path, file_name)
+            if os.path.exists(file_path):
+                continue
+            open(file_path, "wb").close()
+            created_count += 1
+
+def _benchmark_scan(path, file_count):
+    log = logging.getLogger("_benchmark_scan")
+    rule = _create_rule()
+    results = list()
+
+    class _DiscardQueue(object):
+        def put(self, _):
+            pass
+
+    # the per file log lines of the queueing scan are part of its cost,
+    # but not to the console
+    logging.getLogger("_initial_directory_scan").propagate = False
+    start_time = time.time()
+    _initial_directory_scan(path, False, _watch_descriptor, _DiscardQueue())
+    results.append(("queued_scan", time.time() - start_time, ))
+    logging.getLogger("_initial_directory_scan").propagate = True
+
+    start_time = time.time()
+    bulk_load_directory(_InMemoryRedis(),
+                        path,
+                        rule.key_extractor,
+                        _redis_prefix,
+                        10000)
+    results.append(("bulk_scan", time.time() - start_time, ))
+
+    start_time = time.time()
+    scan_directory_sets(path, rule.key_extractor, _redis_prefix)
+    results.append(("reconcile_scan", time.time() - start_time, ))
+
+    for name, elapsed_time in results:
+        log.info("{0:15} {1:10} files {2:8.3f} secs".format(name,
+                                                           file_count,
+                                                           elapsed_time))
+    return [{"benchmark"    : name,
+             "file_count"   : file_count,
+             "elapsed_secs" : elapsed_time, }
+            for name, elapsed_time in results]
+
+def main():
+    """
+    main entry point for the program
+    The return value will be the returncode for the program
+    """
+    _initialize_stderr_logging()
+    log = logging.getLogger("main")
+    log.info("program starts")
+
+    args = _parse_commandline()
+    batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+    scan_sizes = [int(size) for size in args.scan_sizes.split(",")]
+
+    results = list()
+    events = _generate_events(args.event_count)
+    for batch_size in batch_sizes:
+        results.append(_benchmark_events(events, batch_size, False))
+        if batch_size > 1:
+            results.append(_benchmark_events(events, batch_size, True))
+
+    scan_parent = args.scan_directory
+    if scan_parent is None:
+        scan_parent = tempfile.mkdtemp(prefix="benchmark_pipeline_")
+    # we only remove what we made: the parent is the user's, if given
+    scan_paths = list()
+    try:
+        for file_count in scan_sizes:
+            path = os.path.join(scan_parent, "files_{0}".format(file_count))
+            scan_paths.append(path)
+            _populate_directory(path, file_count)
+            results.extend(_benchmark_scan(path, file_count))
+    finally:
+        if not args.keep_scan_directories:
+            if args.scan_directory is None:
+                shutil.rmtree(scan_parent)
+            else:
+                for path in scan_paths:
+                    shutil.rmtree(path, ignore_errors=True)
+
+    report = {"timestamp"       : time.time(),
+              "python_version"  : platform.python_version(),
+              "platform"        : platform.platform(),
+              "results"         : results, }
+    with open(args.output_path, "w") as output_file:
+        json.dump(report, output_file, indent=2, sort_keys=True)
+    log.info("results written to {0}".format(args.output_path))
+
+    log.info("program completes return code = 0")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,12 +8,17 @@ import argparse
 import logging
 import os
 import os.path
-import random
 import sys
-import time
 
 import redis
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir,
+                                "src"))
+from set_consumer import SetConsumer, \
+                         default_worker_count, \
+                         default_page_size
+
 class CommandlineError(Exception):
     pass
 
@@ -48,6 +53,20 @@ def _parse_commandline():
                         dest="notification_channel",  
                         default="file-name-set-manager-test-channel",
                         help="redis pub/sub channel for key notification") 
+    parser.add_argument("--claim-channel", 
+                        dest="claim_channel",
+                        help="redis pub/sub channel to announce our claims " \
+                        "on (the manager's --claim-channel)") 
+    parser.add_argument("--workers", 
+                        dest="worker_count",
+                        type=int,
+                        default=default_worker_count,
+                        help="threads removing files") 
+    parser.add_argument("--page-size", 
+                        dest="page_size",
+                        type=int,
+                        default=default_page_size,
+                        help="set members read at a time") 
     args = parser.parse_args()
 
     if args.watch_path is None:
@@ -69,27 +88,20 @@ def _create_redis_connection(host=None, port=None, db=None):
     log.info("connecting to {0}:{1} db={2}".format(host, port, db))
     return redis.StrictRedis(host=host, port=port, db=db)
 
-def _process_message(args, redis, message):
+def _process_message(consumer, message):
     log = logging.getLogger("_process_message")
     message_text = message["data"].decode("utf-8")
     redis_key, expected_count_str = message_text.split()
     expected_count = int(expected_count_str)
-    members = redis.smembers(redis_key)
-    if len(members) == expected_count:
-        log.info("received key {0} with {1} set members".format(redis_key, 
-                                                                len(members)))
+    report = consumer.drain(redis_key)
+    if report is None:
+        log.error("received key {0} with no set".format(redis_key))
+    elif report.member_count == expected_count:
+        log.info("received key {0} with {1} set members".format(
+                 redis_key, report.member_count))
     else:
         log.error("received key {0} with {1} set members expected {2}".format(
-                  redis_key, len(members), expected_count))
-
-    # we don't need this key anymore
-    redis.delete(redis_key) 
-
-    for member in members:
-        file_name = member.decode("utf-8")
-        path = os.path.join(args.watch_path, file_name)
-        log.info("removing {0}".format(path))
-        os.unlink(path)
+                  redis_key, report.member_count, expected_count))
 
 def main():
     """
@@ -103,15 +115,21 @@ def main():
     args = _parse_commandline()
 
     redis = _create_redis_connection()
+    consumer = SetConsumer(redis, 
+                           args.watch_path, 
+                           worker_count=args.worker_count,
+                           page_size=args.page_size,
+                           claim_channel=args.claim_channel)
     subscriber = redis.pubsub()
     subscriber.subscribe(args.notification_channel)
     for message in subscriber.listen():
         if message["type"] == "subscribe": 
             log.info("subscribed to {0}".format(message["channel"]))
         elif message["type"] == "message":
-            _process_message(args, redis, message)
+            _process_message(consumer, message)
         else:
             log.error("Unknown message {0}".format(message))
+    consumer.close()
 
     log.info("program completes return code = 0")
     return 0